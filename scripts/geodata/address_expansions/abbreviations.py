@@ -85,15 +85,13 @@ def abbreviate(gazetteer, s, language, abbreviate_prob=0.3, separate_prob=0.2, a
     i = 0
 
     def abbreviated_tokens(i, tokens, t, c, length, data, space_token=six.u(' ')):
-        data = [d.split(six.b('|')) for d in data]
-
         # local copy
         abbreviated = []
 
         n = len(t)
 
         # Append the original tokens with whitespace if there is any
-        if random.random() > abbreviate_prob or not any((int(is_canonical) and lang in (language, 'all') for lang, dictionary, is_canonical, canonical in data)):
+        if random.random() > abbreviate_prob or not any((d.is_canonical and d.language in (language, 'all') for d in data)):
             for j, (t_i, c_i) in enumerate(t):
                 abbreviated.append(tokens[i + j][0])
 
@@ -105,7 +103,6 @@ def abbreviate(gazetteer, s, language, abbreviate_prob=0.3, separate_prob=0.2, a
             if lang not in (language, 'all'):
                 continue
 
-            is_canonical = int(is_canonical)
             is_stopword = dictionary == 'stopword'
             is_prefix = dictionary.startswith('concatenated_prefixes')
             is_suffix = dictionary.startswith('concatenated_suffixes')
@@ -152,8 +149,7 @@ def abbreviate(gazetteer, s, language, abbreviate_prob=0.3, separate_prob=0.2, a
 
                 separated_abbreviations = []
                 phrase = gazetteer.trie.get(suffix.rstrip('.'))
-                suffix_data = [safe_decode(d).split(six.u('|')) for d in (phrase or [])]
-                for l, d, _, c in suffix_data:
+                for l, d, _, c in (phrase or []):
                     if l == lang and c == canonical:
                         separated_abbreviations.extend(gazetteer.canonicals.get((canonical, lang, d)))
 
@@ -1,6 +1,5 @@
 import random
 import re
-import six
 
 from itertools import izip
 
@@ -15,9 +14,8 @@ def canonicals_for_language(data, language):
     canonicals = set()
 
     for d in data:
-        lang, dictionary, is_canonical, canonical = d.split(six.b('|'))
-        if language is None or lang == language:
-            canonicals.add(canonical)
+        if language is None or d.language == language:
+            canonicals.add(d.canonical)
 
     return canonicals
 
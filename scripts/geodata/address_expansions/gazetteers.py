@@ -1,12 +1,16 @@
+import hashlib
 import os
 import six
+import struct
+import tempfile
 
-from collections import defaultdict, OrderedDict
+from array import array
+from collections import defaultdict, namedtuple, OrderedDict
 
-from geodata.address_expansions.address_dictionaries import address_phrase_dictionaries
+from geodata.address_expansions.address_dictionaries import address_phrase_dictionaries, gazetteer_types
 from geodata.encoding import safe_decode, safe_encode
 from geodata.i18n.unicode_paths import DATA_DIR
-from geodata.text.normalize import normalized_tokens, normalize_string
+from geodata.text.normalize import normalized_tokens, normalize_string, normalizer_version
 from geodata.text.tokenize import tokenize, token_types
 from geodata.text.phrases import PhraseFilter
 from geodata.enum import EnumValue
@@ -16,6 +20,14 @@ from marisa_trie import BytesTrie
 
 DICTIONARIES_DIR = os.path.join(DATA_DIR, 'dictionaries')
 
+# The built DictionaryPhraseTrie is saved here, keyed by a hash of the
+# dictionaries' phrases and the normalizer build. Set GEODATA_GAZETTEER_CACHE_DIR to an empty string
+# to always build in memory. Bump GAZETTEER_CACHE_VERSION when the way tries are built changes
+GAZETTEER_CACHE_DIR = os.environ.get('GEODATA_GAZETTEER_CACHE_DIR',
+                                     os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                                  'geodata', 'gazetteers'))
+GAZETTEER_CACHE_VERSION = 3
+
 PREFIX_KEY = u'\x02'
 SUFFIX_KEY = u'\x03'
 
@@ -26,18 +38,93 @@ POSSIBLE_ROMAN_NUMERALS = set(['i', 'ii', 'iii', 'iv', 'v', 'vi', 'vii', 'viii',
                                'm', 'mm', 'mmm', 'mmmm'])
 
 
-class DictionaryPhraseFilter(PhraseFilter):
-    serialize = safe_encode
-    deserialize = safe_decode
-
-    def __init__(self, *dictionaries):
-        self.dictionaries = dictionaries
-        self.canonicals = {}
-
-        kvs = defaultdict(OrderedDict)
+# Bit position of each dictionary in dictionary masks
+DICTIONARY_INDEX = {name: i for i, name in enumerate(sorted(gazetteer_types))}
+
+payload_id_struct = struct.Struct('<I')
+
+PhrasePayload = namedtuple('PhrasePayload', 'language, dictionary, is_canonical, canonical')
+
+
+class DictionaryPhraseTrie(object):
+    '''
+    One trie of the phrases in all the address dictionaries, shared by
+    every gazetteer.
+
+    Each key's values are ids into a table of PhrasePayload records, decoded
+    once from the 'lang|dictionary|is_canonical|canonical' strings when the
+    trie is loaded, so a phrase which is in several gazetteers is stored once
+    and matches don't need to split or decode anything. Gazetteers see the trie through a
+    DictionaryTrieView, which only shows the payloads from its dictionaries,
+    selected with a bitmask over DICTIONARY_INDEX.
+
+    The trie is built on first use and saved to cache_dir, from where other
+    processes memory-map it. Cached files are only used if they and cache_dir
+    belong to the current user and aren't writable by anyone else, and if
+    the trie matches the SHA-1 stored with the payloads.
+    '''
+    cache_dir = GAZETTEER_CACHE_DIR
+
+    def __init__(self):
+        self.trie = None
+        self.payloads = None
+        # Dictionary index of each payload
+        self.payload_dictionaries = None
+        # Dictionary mask of the keys under each prefix, for the prefix/suffix
+        # keys searched character by character (and the empty prefix)
+        self.prefix_masks = None
+
+    def load(self):
+        if self.trie is not None:
+            return self
+
+        path = self.cache_path()
+        if path is not None:
+            payloads = self.load_cached(path)
+            if payloads is not None:
+                self.set_data(BytesTrie().mmap(path + '.trie'), payloads)
+                return self
+
+        trie, payloads = self.build()
+        if path is not None:
+            trie = self.save(path, trie, payloads)
+        self.set_data(trie, payloads)
+        return self
+
+    @classmethod
+    def is_trusted(cls, path):
+        '''True if path belongs to this user and only this user can write to it'''
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+    @classmethod
+    def file_sha1(cls, path):
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def load_cached(self, path):
+        '''Payloads from the cache, or None if it's missing, untrusted or doesn't match the trie'''
+        if not all((self.is_trusted(p) for p in (self.cache_dir, path + '.trie', path + '.payloads'))):
+            return None
+
+        with open(path + '.payloads') as f:
+            trie_sha1, _, data = f.read().partition('\n')
+        if trie_sha1 != self.file_sha1(path + '.trie'):
+            return None
+        return data.split('\n') if data else []
+
+    def build(self):
+        # Ordered so payload ids are the same in every build of the same dictionaries
+        kvs = OrderedDict()
 
         for language in address_phrase_dictionaries.languages:
-            for dictionary_name in self.dictionaries:
+            for dictionary_name in address_phrase_dictionaries.language_dictionaries.get(language, []):
                 is_suffix_dictionary = 'suffixes' in dictionary_name
                 is_prefix_dictionary = 'prefixes' in dictionary_name
 
@@ -45,8 +132,6 @@ class DictionaryPhraseFilter(PhraseFilter):
                     canonical = phrases[0]
                     canonical_normalized = normalize_string(canonical)
 
-                    self.canonicals[(canonical, language, dictionary_name)] = phrases[1:]
-
                     for i, phrase in enumerate(phrases):
 
                         if phrase in POSSIBLE_ROMAN_NUMERALS:
@@ -59,11 +144,199 @@ class DictionaryPhraseFilter(PhraseFilter):
                         elif is_prefix_dictionary:
                             phrase = PREFIX_KEY + phrase
 
-                        kvs[phrase][(language, dictionary_name, canonical)] = is_canonical
+                        kvs.setdefault(phrase, OrderedDict())[(language, dictionary_name, canonical)] = is_canonical
+
+        payloads = []
+        payload_ids = {}
+        values = []
 
-        kvs = [(k, '|'.join([l, d, str(int(i)), safe_encode(c)])) for k, vals in kvs.iteritems() for (l, d, c), i in vals.iteritems()]
+        for k, vals in six.iteritems(kvs):
+            for (l, d, c), i in six.iteritems(vals):
+                payload = '|'.join([l, d, str(int(i)), safe_encode(c)])
+                payload_id = payload_ids.get(payload)
+                if payload_id is None:
+                    payload_id = payload_ids[payload] = len(payloads)
+                    payloads.append(payload)
+                values.append((k, payload_id_struct.pack(payload_id)))
 
-        self.trie = BytesTrie(kvs)
+        return BytesTrie(values), payloads
+
+    def save(self, path, trie, payloads):
+        '''Saves to the cache and returns the memory-mapped trie, or trie if the cache isn't usable'''
+        temp_paths = []
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir, 0o700)
+            if not self.is_trusted(self.cache_dir):
+                return trie
+
+            # Write to temp files and rename so concurrent builders never see a
+            # partial file. The payloads file holds the trie's SHA-1, so a trie
+            # replaced by another builder in between is caught by load_cached
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            temp_paths.append(temp_path)
+            os.close(fd)
+            trie.save(temp_path)
+            trie_sha1 = self.file_sha1(temp_path)
+            os.chmod(temp_path, 0o644)
+            os.rename(temp_path, path + '.trie')
+            temp_paths.remove(temp_path)
+
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            temp_paths.append(temp_path)
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join([trie_sha1] + payloads))
+            os.chmod(temp_path, 0o644)
+            os.rename(temp_path, path + '.payloads')
+            temp_paths.remove(temp_path)
+        except (IOError, OSError):
+            return trie
+        finally:
+            for temp_path in temp_paths:
+                try:
+                    os.unlink(temp_path)
+                except OSError:
+                    pass
+
+        return BytesTrie().mmap(path + '.trie')
+
+    def set_data(self, trie, payloads):
+        self.trie = trie
+
+        # Share the repeated language, dictionary and canonical strings
+        strings = {}
+
+        def decode_payload(payload):
+            lang, dictionary, is_canonical, canonical = safe_decode(payload).split(u'|', 3)
+            return PhrasePayload(strings.setdefault(lang, lang),
+                                 strings.setdefault(dictionary, dictionary),
+                                 is_canonical == u'1',
+                                 strings.setdefault(canonical, canonical))
+
+        self.payloads = [decode_payload(p) for p in payloads]
+        self.payload_dictionaries = array('B', [DICTIONARY_INDEX[p.dictionary] for p in self.payloads])
+
+        prefix_masks = defaultdict(int)
+        for i in set(self.payload_dictionaries):
+            prefix_masks[u''] |= 1 << i
+        for affix in (PREFIX_KEY, SUFFIX_KEY):
+            for key, value in trie.iteritems(affix):
+                bit = 1 << self.payload_dictionaries[payload_id_struct.unpack(value)[0]]
+                for j in six.moves.range(1, len(key) + 1):
+                    prefix_masks[key[:j]] |= bit
+        self.prefix_masks = dict(prefix_masks)
+
+    def cache_key(self):
+        h = hashlib.sha1()
+        h.update(str(GAZETTEER_CACHE_VERSION))
+        # is_canonical comes from normalize_string, so a new normalizer means new tries
+        h.update(normalizer_version())
+        for language in address_phrase_dictionaries.languages:
+            for dictionary_name in address_phrase_dictionaries.language_dictionaries.get(language, []):
+                h.update(safe_encode(u'\n{}/{}\n'.format(language, dictionary_name)))
+                for p in address_phrase_dictionaries.phrases.get((language, dictionary_name), []):
+                    h.update(safe_encode(u'|'.join(p)))
+                    h.update('\n')
+        return h.hexdigest()
+
+    def cache_path(self):
+        '''Cache path without extension, or None if caching is disabled'''
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, self.cache_key())
+
+    @classmethod
+    def dictionary_mask(cls, dictionaries):
+        mask = 0
+        for d in dictionaries:
+            if d in DICTIONARY_INDEX:
+                mask |= 1 << DICTIONARY_INDEX[d]
+        return mask
+
+    def payload_ids(self, key):
+        return [payload_id_struct.unpack(v)[0] for v in self.trie.get(key, ())]
+
+    def key_mask(self, key):
+        mask = 0
+        for i in self.payload_ids(key):
+            mask |= 1 << self.payload_dictionaries[i]
+        return mask
+
+    def values(self, key, mask):
+        payloads = self.payloads
+        payload_dictionaries = self.payload_dictionaries
+        return [payloads[i] for i in self.payload_ids(key) if mask >> payload_dictionaries[i] & 1]
+
+    def has_keys_with_prefix(self, prefix, mask):
+        if not prefix or prefix[0] in (PREFIX_KEY, SUFFIX_KEY):
+            return bool(self.prefix_masks.get(prefix, 0) & mask)
+        return any((self.key_mask(key) & mask for key in self.trie.iterkeys(prefix)))
+
+    def iterkeys(self, prefix, mask):
+        payload_dictionaries = self.payload_dictionaries
+        for key, value in self.trie.iteritems(prefix):
+            if mask >> payload_dictionaries[payload_id_struct.unpack(value)[0]] & 1:
+                yield key
+
+
+dictionary_phrase_trie = DictionaryPhraseTrie()
+
+
+class DictionaryTrieView(object):
+    '''
+    A DictionaryPhraseTrie restricted to some dictionaries, with the parts
+    of the marisa_trie.BytesTrie interface used by PhraseFilter and
+    DictionaryPhraseFilter
+    '''
+    def __init__(self, phrase_trie, dictionaries):
+        self.phrase_trie = phrase_trie
+        self.mask = phrase_trie.dictionary_mask(dictionaries)
+
+    def get(self, key, default=None):
+        return self.phrase_trie.values(key, self.mask) or default
+
+    def has_keys_with_prefix(self, prefix):
+        return self.phrase_trie.has_keys_with_prefix(prefix, self.mask)
+
+    def iterkeys(self, prefix=u''):
+        return self.phrase_trie.iterkeys(prefix, self.mask)
+
+
+class DictionaryPhraseFilter(PhraseFilter):
+    '''
+    Dictionary phrase matcher. The data for each match is a list of
+    PhrasePayload records, one per (language, dictionary, canonical).
+    '''
+    serialize = safe_encode
+    deserialize = safe_decode
+
+    phrase_trie = dictionary_phrase_trie
+
+    def __init__(self, *dictionaries):
+        '''
+        Gazetteers are views over the shared DictionaryPhraseTrie, which is
+        only loaded on first use, so creating one is cheap
+        '''
+        self.dictionaries = dictionaries
+        self.loaded_trie = None
+        self.loaded_canonicals = None
+
+    @property
+    def trie(self):
+        if self.loaded_trie is None:
+            self.loaded_trie = DictionaryTrieView(self.phrase_trie.load(), self.dictionaries)
+        return self.loaded_trie
+
+    @property
+    def canonicals(self):
+        if self.loaded_canonicals is None:
+            canonicals = {}
+            for language in address_phrase_dictionaries.languages:
+                for dictionary_name in self.dictionaries:
+                    for phrases in address_phrase_dictionaries.phrases.get((language, dictionary_name), []):
+                        canonicals[(phrases[0], language, dictionary_name)] = phrases[1:]
+            self.loaded_canonicals = canonicals
+        return self.loaded_canonicals
 
     def serialize(self, s):
         return s
@@ -108,15 +381,15 @@ class DictionaryPhraseFilter(PhraseFilter):
 
                 suffix_search, suffix_len = self.search_suffix(token)
                 if suffix_search and self.trie.get(token[(token_len - suffix_len):].rstrip('.')):
-                    yield ([(t, c)], token_types.PHRASE, suffix_len, map(safe_decode, suffix_search))
+                    yield ([(t, c)], token_types.PHRASE, suffix_len, suffix_search)
                     continue
                 prefix_search, prefix_len = self.search_prefix(token)
                 if prefix_search and self.trie.get(token[:prefix_len]):
-                    yield ([(t, c)], token_types.PHRASE, prefix_len, map(safe_decode, prefix_search))
+                    yield ([(t, c)], token_types.PHRASE, prefix_len, prefix_search)
                     continue
             else:
                 c = token_types.PHRASE
-            yield t, c, len(t), map(safe_decode, data)
+            yield t, c, len(t), data
 
     def gen_phrases(self, s, canonical_only=False, languages=None):
         tokens = tokenize(s)
@@ -137,9 +410,7 @@ class DictionaryPhraseFilter(PhraseFilter):
                 else:
                     phrase = None
                     for d in data:
-                        lang, dictionary, is_canonical, canonical = d.split(six.b('|'))
-
-                        if (bool(int(is_canonical)) or not canonical_only) and (languages is None or lang in languages or lang == 'all'):
+                        if (d.is_canonical or not canonical_only) and (languages is None or d.language in languages or d.language == 'all'):
                             phrase = phrase if phrase is not None else six.u(' ').join([t_i for t_i, c_i in t])
                             yield phrase
 
@@ -0,0 +1,153 @@
+'''
+Compiles address templates into plain Python render functions.
+
+AddressFormatter templates only use a small subset of Mustache: literal text,
+{{{component}}} (and occasionally {{component}}) variables and
+{{#first}} a || b {{/first}} sections where "first" is a lambda which selects
+the first non-empty alternative. Rendering those through pystache's generic
+engine means a context stack lookup, a node dispatch and a re-parse of every
+{{#first}} section for every address.
+
+compile_template walks pystache's own parse tree once (so whitespace and
+standalone tag handling are exactly pystache's) and generates a function
+which concatenates the component values directly. The output is identical to:
+
+    pystache.render(parsed_template, first=render_first, **components)
+
+where render_first renders the section text with the components, splits it
+on "||" and returns the first non-empty stripped piece. Templates using any
+other Mustache features fall back to pystache.
+'''
+import pystache
+import six
+
+from itertools import ifilter
+
+from pystache.defaults import DELIMITERS, TAG_ESCAPE
+from pystache.parser import ParsedTemplate
+
+from geodata.encoding import safe_decode
+
+FIRST_SECTION_KEY = 'first'
+FIRST_SEPARATOR = six.u('||')
+
+
+def render_first_of(text):
+    splits = (e.strip() for e in text.split(FIRST_SEPARATOR))
+    return next(ifilter(bool, splits), six.u(''))
+
+
+def component_value(components, key):
+    value = components.get(key, six.u(''))
+    if type(value) is not six.text_type:
+        value = six.text_type(value)
+    return value
+
+
+def escaped_component_value(components, key):
+    return six.text_type(TAG_ESCAPE(component_value(components, key)))
+
+
+def pystache_renderer(template):
+    '''Renderer for anything compile_template doesn't handle'''
+    if not isinstance(template, ParsedTemplate):
+        template = pystache.parse(safe_decode(template))
+
+    def render(components):
+        def render_first(text):
+            return render_first_of(pystache.render(text, **components))
+        return pystache.render(template, first=render_first, **components)
+
+    render.compiled = False
+    return render
+
+
+class _TemplateCompiler(object):
+    def __init__(self):
+        self.constants = {}
+        self.num_constants = 0
+
+    def constant(self, value):
+        name = '_c{}'.format(self.num_constants)
+        self.constants[name] = value
+        self.num_constants += 1
+        return name
+
+    def parts(self, parse_tree):
+        '''
+        Returns a list of Python expressions, one per template node, or None
+        if the template uses something other than variables and {{#first}}
+        '''
+        exprs = []
+        for el in parse_tree:
+            if isinstance(el, six.string_types):
+                if el:
+                    exprs.append(self.constant(safe_decode(el)))
+                continue
+
+            node_type = type(el).__name__
+            if node_type == '_CommentNode':
+                continue
+            elif node_type in ('_LiteralNode', '_EscapeNode'):
+                # Dotted names and implicit iterators resolve differently
+                if '.' in el.key:
+                    return None
+                func = 'component_value' if node_type == '_LiteralNode' else 'escaped_component_value'
+                exprs.append('{}(c, {})'.format(func, self.constant(el.key)))
+            elif node_type == '_SectionNode':
+                if el.key != FIRST_SECTION_KEY or tuple(el.delimiters) != tuple(DELIMITERS):
+                    return None
+                # pystache passes the raw section text to the lambda, which renders it
+                # as a standalone template, so compile a fresh parse of that text
+                section_text = el.template[el.index_begin:el.index_end]
+                section_parts = self.parts(pystache.parse(safe_decode(section_text))._parse_tree)
+                if section_parts is None:
+                    return None
+                exprs.append('first_value(c, {})'.format(self.join(section_parts)))
+            else:
+                return None
+
+        return exprs
+
+    def join(self, exprs):
+        if not exprs:
+            return 'u""'
+        elif len(exprs) == 1:
+            return exprs[0]
+        return 'u"".join(({},))'.format(', '.join(exprs))
+
+
+def first_value(components, text):
+    value = render_first_of(text)
+    # The lambda's return value is rendered again as a template. Component
+    # values almost never contain tags, in which case that's a no-op.
+    if six.u('{{') in value:
+        value = pystache_renderer(value)(components)
+    return value
+
+
+def compile_template(template):
+    '''
+    Returns a function of a components dict which renders the template.
+    template may be text or a pystache ParsedTemplate.
+    '''
+    if not isinstance(template, ParsedTemplate):
+        template = pystache.parse(safe_decode(template))
+
+    compiler = _TemplateCompiler()
+    exprs = compiler.parts(template._parse_tree)
+    if exprs is None:
+        return pystache_renderer(template)
+
+    source = 'def render(c):\n    return {}\n'.format(compiler.join(exprs))
+    namespace = {
+        'component_value': component_value,
+        'escaped_component_value': escaped_component_value,
+        'first_value': first_value,
+    }
+    namespace.update(compiler.constants)
+    six.exec_(compile(source, '<address template>', 'exec'), namespace)
+
+    render = namespace['render']
+    render.compiled = True
+    return render
@@ -9,12 +9,15 @@ import subprocess
 import yaml
 
 from collections import OrderedDict, defaultdict
-from itertools import ifilter
+from itertools import izip
 
 from geodata.address_formatting.aliases import Aliases
+from geodata.address_formatting.compiled import compile_template
+from geodata.caching import LRUCache
 from geodata.configs.utils import nested_get, recursive_merge
 from geodata.math.floats import isclose
 from geodata.math.sampling import weighted_choice, cdf
+from geodata.metrics import NULL_METRICS
 from geodata.text.tokenize import tokenize, tokenize_raw, token_types
 from geodata.encoding import safe_decode
 
@@ -25,6 +28,9 @@ this_dir = os.path.realpath(os.path.dirname(__file__))
 FORMATTER_CONFIG = os.path.join(this_dir, os.pardir, os.pardir, os.pardir,
                                 'resources', 'formatting', 'global.yaml')
 
+# How often (in records) the training data builders log formatter cache stats
+CACHE_STATS_INTERVAL = 100000
+
 
 class AddressFormatter(object):
     '''
@@ -48,6 +54,9 @@ class AddressFormatter(object):
 
     splitter = ' | '
 
+    # Times template revision and rendering, see geodata.metrics
+    metrics = NULL_METRICS
+
     separator_tag = 'SEP'
     field_separator_tag = 'FSEP'
 
@@ -181,7 +190,12 @@ class AddressFormatter(object):
 
     FIRST, BEFORE, AFTER, LAST = range(4)
 
-    def __init__(self, scratch_dir='/tmp', splitter=None):
+    DEFAULT_TEMPLATE_CACHE_SIZE = 100000
+    DEFAULT_PARSED_CACHE_SIZE = 50000
+
+    def __init__(self, scratch_dir='/tmp', splitter=None,
+                 template_cache_size=DEFAULT_TEMPLATE_CACHE_SIZE,
+                 parsed_cache_size=DEFAULT_PARSED_CACHE_SIZE):
         if splitter is not None:
             self.splitter = splitter
 
@@ -197,8 +211,17 @@ class AddressFormatter(object):
         self.setup_no_name_templates()
         self.setup_place_only_templates()
 
-        self.template_cache = {}
-        self.parsed_cache = {}
+        self.template_cache = LRUCache(template_cache_size, name='template')
+        self.parsed_cache = LRUCache(parsed_cache_size, name='parsed')
+        self.compiled_cache = LRUCache(parsed_cache_size, name='compiled')
+
+    def cache_stats(self):
+        return {cache.name: cache.stats() for cache in (self.template_cache, self.parsed_cache, self.compiled_cache)}
+
+    def log_cache_stats(self):
+        for name, stats in sorted(six.iteritems(self.cache_stats())):
+            print('AddressFormatter {} cache: size={size}/{max_size}, hits={hits}, misses={misses}, '
+                  'hit_rate={hit_rate:.3f}, evictions={evictions}, memory_estimate={memory_estimate}'.format(name, **stats))
 
     def clone_repo(self):
         subprocess.check_call(['rm', '-rf', self.formatter_repo_path])
@@ -230,7 +253,7 @@ class AddressFormatter(object):
 
                 post_format_replacements = value.get('postformat_replace')
                 if post_format_replacements:
-                    value['postformat_replace'] = [[pattern, replacement.replace('$', '\\')] for pattern, replacement in post_format_replacements]
+                    value['postformat_replace'] = [[re.compile(pattern), replacement.replace('$', '\\')] for pattern, replacement in post_format_replacements]
             else:
                 address_template = value
                 config[country] = self.add_postprocessing_tags(value, country, language=language)
@@ -249,6 +272,8 @@ class AddressFormatter(object):
         self.country_formats = config
 
     def load_config(self):
+        self.setup_regexes()
+
         config = yaml.load(open(FORMATTER_CONFIG))
         self.config = config.get('global', {})
         language_configs = config.get('languages', {})
@@ -267,6 +292,16 @@ class AddressFormatter(object):
             config_copy = copy.deepcopy(self.config)
             self.country_configs[country] = recursive_merge(config_copy, country_config)
 
+    def setup_regexes(self):
+        self.tag_token_regexes = {}
+        for component in self.component_order:
+            self.tag_token_regex(component)
+
+        self.first_template_regex = re.compile(six.u('{{#first}}.*?{{/first}}'), re.UNICODE)
+        self.repeat_template_separators_regex = re.compile('(?:[\s]*([,;\-]/{})[\s]*){{2,}}'.format(self.separator_tag))
+        self.template_separators_regex = re.compile(r'}\s*([,\-;])\s*')
+        self.template_separators_replacement = r'}} \1/{} '.format(self.separator_tag)
+
     def get_property(self, keys, country, language=None, default=None):
         if isinstance(keys, six.string_types):
             keys = keys.split('.')
@@ -411,6 +446,12 @@ class AddressFormatter(object):
     def tag_token(self, key):
         return '{{{{{{{key}}}}}}}'.format(key=key)
 
+    def tag_token_regex(self, key):
+        regex = self.tag_token_regexes.get(key)
+        if regex is None:
+            regex = self.tag_token_regexes[key] = re.compile(self.tag_token(key))
+        return regex
+
     def remove_components(self, template, tags):
         new_components = []
         tags = set(tags)
@@ -447,18 +488,17 @@ class AddressFormatter(object):
         template = template.rstrip()
 
         if not exact_order:
-            first_template_regex = re.compile(six.u('{{#first}}.*?{{/first}}'), re.UNICODE)
-            sans_firsts = first_template_regex.sub(six.u(''), template)
+            sans_firsts = self.first_template_regex.sub(six.u(''), template)
 
-            tag_match = re.compile(self.tag_token(tag)).search(sans_firsts)
+            tag_match = self.tag_token_regex(tag).search(sans_firsts)
 
             if before:
-                before_match = re.compile(self.tag_token(before)).search(sans_firsts)
+                before_match = self.tag_token_regex(before).search(sans_firsts)
                 if before_match and tag_match and before_match.start() > tag_match.start():
                     return template
 
             if after:
-                after_match = re.compile(self.tag_token(after)).search(sans_firsts)
+                after_match = self.tag_token_regex(after).search(sans_firsts)
                 if after_match and tag_match and tag_match.start() > after_match.start():
                     return template
 
@@ -564,15 +604,27 @@ class AddressFormatter(object):
 
         return template
 
+    def compiled_template(self, template_text):
+        renderer = self.compiled_cache.get(template_text)
+        if renderer is None:
+            template = self.parsed_cache.get(template_text)
+            if template is None:
+                template = pystache.parse(safe_decode(template_text))
+                self.parsed_cache[template_text] = template
+            renderer = compile_template(template)
+            self.compiled_cache[template_text] = renderer
+        return renderer
+
     def render_template(self, template, components, tagged=False):
-        def render_first(text):
-            text = pystache.render(text, **components)
-            splits = (e.strip() for e in text.split('||'))
-            selected = next(ifilter(bool, splits), '')
-            return selected
+        if isinstance(template, six.string_types):
+            renderer = self.compiled_template(template)
+        elif callable(template):
+            # Already compiled
+            renderer = template
+        else:
+            renderer = compile_template(template)
 
-        output = pystache.render(template, first=render_first,
-                                 **components).strip()
+        output = renderer(components).strip()
 
         values = self.whitespace_component_regex.split(output)
 
@@ -604,7 +656,7 @@ class AddressFormatter(object):
         post_format_replacements = template.get('postformat_replace')
         if post_format_replacements:
             for regex, replacement in post_format_replacements:
-                text = re.sub(regex, replacement, text)
+                text = regex.sub(replacement, text)
         return text
 
     def revised_template(self, template, components, country, language=None):
@@ -628,8 +680,9 @@ class AddressFormatter(object):
         if random.random() < invert_probability:
             cache_keys.append('inverted')
             cache_key = tuple(sorted(cache_keys))
-            if cache_key in self.template_cache:
-                template = self.template_cache[cache_key]
+            inverted_template = self.template_cache.get(cache_key)
+            if inverted_template is not None:
+                template = inverted_template
             else:
                 template = self.inverted(template)
                 self.template_cache[cache_key] = template
@@ -688,8 +741,9 @@ class AddressFormatter(object):
 
                 cache_key = tuple(sorted(cache_keys))
 
-                if cache_key in self.template_cache:
-                    template = self.template_cache[cache_key]
+                cached_template = self.template_cache.get(cache_key)
+                if cached_template is not None:
+                    template = cached_template
                     continue
 
                 other_token = self.tag_token(other)
@@ -742,10 +796,10 @@ class AddressFormatter(object):
         return template
 
     def remove_repeat_template_separators(self, template):
-        return re.sub('(?:[\s]*([,;\-]/{})[\s]*){{2,}}'.format(self.separator_tag), r' \1 ', template)
+        return self.repeat_template_separators_regex.sub(r' \1 ', template)
 
     def tag_template_separators(self, template):
-        template = re.sub(r'}\s*([,\-;])\s*', r'}} \1/{} '.format(self.separator_tag), template)
+        template = self.template_separators_regex.sub(self.template_separators_replacement, template)
         return template
 
     def strip_component(self, value, tagged=False):
@@ -885,32 +939,13 @@ class AddressFormatter(object):
                 components['place'] = place_formatted
         return self.render_template(self.intersection_template, components, tagged=tag_components)
 
-    def format_address(self, components, country, language,
-                       minimal_only=True, tag_components=True, replace_aliases=True):
-        if minimal_only and not self.minimal_components(components):
-            return None
-
+    def address_template_text(self, country, language):
         template = self.get_template(country, language=language)
-        if not template:
-            return None
-
         if not template or 'address_template' not in template:
             return None
-        template_text = template['address_template']
-
-        template_text = self.revised_template(template_text, components, country, language=language)
-        if template_text is None:
-            return None
-
-        if tag_components:
-            template_text = self.tag_template_separators(template_text)
-
-        if template_text in self.parsed_cache:
-            template = self.parsed_cache[template_text]
-        else:
-            template = pystache.parse(template_text)
-            self.parsed_cache[template_text] = template
+        return template['address_template']
 
+    def render_address(self, template, components, tag_components=True, replace_aliases=True):
         if replace_aliases:
             self.aliases.replace(components)
 
@@ -922,3 +957,68 @@ class AddressFormatter(object):
         text = self.remove_repeat_template_separators(text)
 
         return text
+
+    def format_address(self, components, country, language,
+                       minimal_only=True, tag_components=True, replace_aliases=True):
+        if minimal_only and not self.minimal_components(components):
+            return None
+
+        template_text = self.address_template_text(country, language)
+        if template_text is None:
+            return None
+
+        with self.metrics.timer('template_revision'):
+            template_text = self.revised_template(template_text, components, country, language=language)
+        if template_text is None:
+            return None
+
+        with self.metrics.timer('render'):
+            if tag_components:
+                template_text = self.tag_template_separators(template_text)
+
+            return self.render_address(template_text, components, tag_components=tag_components,
+                                       replace_aliases=replace_aliases)
+
+    def format_addresses(self, components_list, countries, languages,
+                         minimal_only=True, tag_components=True, replace_aliases=True):
+        '''
+        Batch version of format_address
+
+        Records are grouped by (country, language) so the country template
+        is resolved once per group, then by sampled template revision so
+        the separator tagging and compiled renderer lookup happen once per
+        revision. Returns a list of formatted addresses (or None) in the
+        same order as components_list.
+        '''
+        results = [None] * len(components_list)
+
+        groups = OrderedDict()
+        for i, (components, country, language) in enumerate(izip(components_list, countries, languages)):
+            if minimal_only and not self.minimal_components(components):
+                continue
+            groups.setdefault((country, language), []).append(i)
+
+        for (country, language), indices in six.iteritems(groups):
+            template_text = self.address_template_text(country, language)
+            if template_text is None:
+                continue
+
+            revisions = OrderedDict()
+            with self.metrics.timer('template_revision'):
+                for i in indices:
+                    revised = self.revised_template(template_text, components_list[i], country, language=language)
+                    if revised is None:
+                        continue
+                    revisions.setdefault(revised, []).append(i)
+
+            with self.metrics.timer('render'):
+                for revised, revision_indices in six.iteritems(revisions):
+                    if tag_components:
+                        revised = self.tag_template_separators(revised)
+                    renderer = self.compiled_template(revised)
+
+                    for i in revision_indices:
+                        results[i] = self.render_address(renderer, components_list[i], tag_components=tag_components,
+                                                         replace_aliases=replace_aliases)
+
+        return results
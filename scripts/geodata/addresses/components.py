@@ -29,10 +29,12 @@ from geodata.addresses.house_numbers import HouseNumber
 from geodata.addresses.metro_stations import MetroStation
 from geodata.addresses.numbering import Digits
 from geodata.addresses.po_boxes import POBox
+from geodata.addresses.profiling import StepProfiler
 from geodata.addresses.postcodes import PostCode
 from geodata.addresses.staircases import Staircase
 from geodata.addresses.units import Unit
 from geodata.boundaries.names import boundary_names
+from geodata.caching import LRUCache
 from geodata.configs.utils import nested_get, recursive_merge
 from geodata.coordinates.conversion import latlon_to_decimal
 from geodata.countries.constants import Countries
@@ -44,6 +46,7 @@ from geodata.language_id.disambiguation import *
 from geodata.language_id.sample import sample_random_language
 from geodata.math.floats import isclose
 from geodata.math.sampling import cdf, weighted_choice
+from geodata.metrics import NULL_METRICS
 from geodata.names.normalization import name_affixes
 from geodata.osm.components import osm_address_components
 from geodata.places.config import place_config
@@ -98,6 +101,55 @@ class AddressComponents(object):
      u'en')
 
     '''
+    # Times reverse geocoding, see geodata.metrics
+    metrics = NULL_METRICS
+
+    # Categorization depends only on the config and the polygons, so these
+    # are shared by all instances. Keyed by (country, containing polygon ids)
+    # and (country, polygon type, polygon id) respectively.
+    categorized_cache = LRUCache(50000, name='categorized')
+    polygon_component_cache = LRUCache(200000, name='polygon_component')
+
+    # Cached in place of None, which LRUCache treats as a miss
+    NO_COMPONENT = ''
+
+    # Set by enable_profiling
+    profiler = None
+
+    # Steps of expanded (and of the OpenAddresses formatter) timed when profiling
+    expanded_steps = (
+        'address_language',
+        'non_local_language',
+        'pick_language_suffix',
+        'abbreviate_admin_components',
+        'state_name',
+        'normalize_place_names',
+        'replace_country_name',
+        'country_specific_cleanup',
+        'is_in',
+        'format_brasilia_address',
+        'add_admin_boundaries',
+        'add_city_and_equivalent_points',
+        'add_neighborhoods',
+        'cleanup_street',
+        'spanish_street_name',
+        'strip_unit_phrases_for_language',
+        'cleanup_boundary_names',
+        'replace_name_affixes',
+        'replace_names',
+        'prune_duplicate_names',
+        'cleanup_house_number',
+        'remove_numeric_boundary_names',
+        'add_postcode_phrase',
+        'add_metro_station_phrase',
+        'normalize_sub_building_components',
+        'add_sub_building_components',
+        'add_house_number_phrase',
+        'dropout_places',
+        'drop_invalid_components',
+        'add_genitives',
+    )
+
     iso_alpha2_codes = set([c.alpha2.lower() for c in pycountry.countries])
     iso_alpha3_codes = set([c.alpha3.lower() for c in pycountry.countries])
 
@@ -183,6 +235,34 @@ class AddressComponents(object):
 
         self.setup_valid_scripts()
 
+    def enable_profiling(self, profiler=None):
+        '''
+        Times each of expanded_steps on this instance, see StepProfiler.
+        The timed wrappers are instance attributes, so other instances
+        (and this one, until this is called) run the plain methods.
+        '''
+        if self.profiler is not None:
+            return self.profiler
+        self.profiler = profiler or StepProfiler()
+        for step in self.expanded_steps:
+            setattr(self, step, self.profiler.wrap(step, getattr(self, step)))
+        self.expanded_with_location = self.profiler.wrap_expanded(self.expanded_with_location)
+        return self.profiler
+
+    def merge_profiles(self, profilers):
+        '''Adds the step profiles of worker processes to this one, if profiling'''
+        if self.profiler is None:
+            return
+        for profiler in profilers:
+            if profiler is not None:
+                self.profiler.merge(profiler)
+
+    def log_profile(self):
+        '''Prints and resets the step profile, if profiling'''
+        if self.profiler is not None:
+            self.profiler.log()
+            self.profiler.reset()
+
     def setup_valid_scripts(self):
         chars = get_chars_by_script()
         all_scripts = build_master_scripts_list(chars)
@@ -263,7 +343,8 @@ class AddressComponents(object):
             value.pop(key, None)
 
     def osm_reverse_geocoded_components(self, latitude, longitude):
-        return self.osm_admin_rtree.point_in_poly(latitude, longitude, return_all=True)
+        with self.metrics.timer('reverse_geocode'):
+            return self.osm_admin_rtree.point_in_poly(latitude, longitude, return_all=True)
 
     @classmethod
     def osm_country_and_languages(cls, osm_components):
@@ -274,27 +355,77 @@ class AddressComponents(object):
         return component.get('place', '').lower() in ('locality', 'village', 'hamlet')
 
     @classmethod
-    def categorize_osm_component(cls, country, props, containing_components):
+    def containing_ids(cls, containing_components):
+        return [(c['type'], c['id']) for c in containing_components if 'type' in c and 'id' in c]
+
+    @classmethod
+    def polygon_component(cls, country, props, containing_ids):
+        '''
+        Component for one polygon (or point) given the ids of the polygons
+        containing it. Unless the country has contained_by overrides, the
+        answer only depends on the polygon, so it's cached by id.
+        '''
+        if country in osm_address_components.countries_with_containing_overrides or 'type' not in props or 'id' not in props:
+            return osm_address_components.component_from_properties(country, props, containing=containing_ids)
 
-        containing_ids = [(c['type'], c['id']) for c in containing_components if 'type' in c and 'id' in c]
+        key = (country, props['type'], props['id'])
+        component = cls.polygon_component_cache.get(key)
+        if component is None:
+            component = osm_address_components.component_from_properties(country, props, containing=containing_ids)
+            cls.polygon_component_cache[key] = component if component is not None else cls.NO_COMPONENT
+        return component or None
 
-        return osm_address_components.component_from_properties(country, props, containing=containing_ids)
+    @classmethod
+    def categorize_osm_component(cls, country, props, containing_components):
+        return cls.polygon_component(country, props, cls.containing_ids(containing_components))
+
+    @classmethod
+    def osm_component_labels(cls, country, osm_components):
+        '''
+        Tuple of (component, admin_center_component) for each of
+        osm_components. Nearby records fall in the same set of polygons,
+        so results are cached by country and the polygon ids.
+        '''
+        key = None
+        if all(('type' in c and 'id' in c for c in osm_components)):
+            key = (country, tuple([(c['type'], c['id']) for c in osm_components]))
+            labels = cls.categorized_cache.get(key)
+            if labels is not None:
+                return labels
+
+        containing_ids = cls.containing_ids(osm_components)
+
+        labels = []
+        for props in osm_components:
+            component = cls.polygon_component(country, props, containing_ids)
+            admin_center_component = None
+            if component is not None and 'admin_center' in props:
+                admin_center = {k: v for k, v in six.iteritems(props['admin_center']) if k != 'admin_level'}
+                admin_center_component = osm_address_components.component_from_properties(country, admin_center, containing=containing_ids)
+            labels.append((component, admin_center_component))
+
+        labels = tuple(labels)
+        if key is not None:
+            cls.categorized_cache[key] = labels
+        return labels
 
     @classmethod
     def categorized_osm_components(cls, country, osm_components):
         components = []
-        for i, props in enumerate(osm_components):
+        for props, (component, admin_center_component) in zip(osm_components, cls.osm_component_labels(country, osm_components)):
             name = props.get('name')
             if not name:
                 continue
 
-            component = cls.categorize_osm_component(country, props, osm_components)
-
             if component is not None:
                 components.append((props, component))
 
         return components
 
+    @classmethod
+    def cache_stats(cls):
+        return {cache.name: cache.stats() for cache in (cls.categorized_cache, cls.polygon_component_cache)}
+
     @classmethod
     def address_language(cls, components, candidate_languages):
         '''
@@ -375,9 +506,9 @@ class AddressComponents(object):
         name_norm = six.u('').join([t for t, c in normalized_tokens(name, string_options=NORMALIZE_STRING_LOWERCASE,
                                                                     token_options=TOKEN_OPTIONS_DROP_PERIODS, whitespace=True)])
         for i, props in enumerate(osm_components):
-            containing_ids = [(c['type'], c['id']) for c in osm_components[i + 1:] if 'type' in c and 'id' in c]
+            containing_ids = cls.containing_ids(osm_components[i + 1:])
 
-            component = osm_address_components.component_from_properties(country, props, containing=containing_ids)
+            component = cls.polygon_component(country, props, containing_ids)
 
             component_names = set([n.lower() for n in cls.all_names(props, languages or [] )])
 
@@ -1068,8 +1199,10 @@ class AddressComponents(object):
 
         first_village = None
 
+        containing_ids = self.containing_ids(containing_components)
+
         for props, lat, lon, dist in self.places_index.nearest_points(latitude, longitude):
-            component = self.categorize_osm_component(country, props, containing_components)
+            component = self.polygon_component(country, props, containing_ids)
             if component is None:
                 continue
 
@@ -1139,11 +1272,10 @@ class AddressComponents(object):
 
             grouped_osm_components = defaultdict(list)
 
-            for i, props in enumerate(osm_components):
+            for props, (component, admin_center_component) in zip(osm_components, self.osm_component_labels(country, osm_components)):
                 if 'name' not in props:
                     continue
 
-                component = self.categorize_osm_component(country, props, osm_components)
                 if component is None:
                     continue
 
@@ -1154,7 +1286,6 @@ class AddressComponents(object):
                         props = props.get('admin_center', props)
                 elif 'admin_center' in props:
                     admin_center = {k: v for k, v in six.iteritems(props['admin_center']) if k != 'admin_level'}
-                    admin_center_component = self.categorize_osm_component(country, admin_center, osm_components)
                     if admin_center_component == component and admin_center.get('name') and admin_center['name'].lower() == props.get('name', '').lower():
                         props = props.copy()
                         props.update({k: v for k, v in six.iteritems(admin_center) if k not in props})
@@ -1271,7 +1402,8 @@ class AddressComponents(object):
         return norm_name == safe_decode(wiki_name).strip().lower()
 
     def neighborhood_components(self, latitude, longitude):
-        return self.neighborhoods_rtree.point_in_poly(latitude, longitude, return_all=True)
+        with self.metrics.timer('reverse_geocode'):
+            return self.neighborhoods_rtree.point_in_poly(latitude, longitude, return_all=True)
 
     def add_neighborhoods(self, address_components, neighborhoods,
                           country, language, non_local_language=None, language_suffix='', replace_city=False):
@@ -1836,26 +1968,144 @@ class AddressComponents(object):
         R-tree + point-in-polygon indices passed in at initialization and adds things
         like admin boundaries, neighborhoods,
         '''
+        location = self.expanded_location(latitude, longitude, osm_components=osm_components, neighborhoods=neighborhoods)
+        if location is None:
+            return None, None, None
+
+        return self.expanded_with_location(address_components, location, language=language,
+                                           dropout_places=dropout_places, population=population,
+                                           population_from_city=population_from_city, check_city_wikipedia=check_city_wikipedia,
+                                           add_sub_building_components=add_sub_building_components, hyphenation=hyphenation,
+                                           num_floors=num_floors, num_basements=num_basements, zone=zone)
+
+    def expanded_location(self, latitude, longitude, osm_components=None, neighborhoods=None):
+        '''
+        The reverse geocoded part of expanded: returns (latitude, longitude,
+        osm_components, neighborhoods, country, candidate_languages) or None
+        if the point can't be parsed or isn't in a known country.
+        '''
         try:
             latitude, longitude = latlon_to_decimal(latitude, longitude)
         except Exception:
-            return None, None, None
+            return None
 
         if osm_components is None:
             osm_components = self.osm_reverse_geocoded_components(latitude, longitude)
 
         country, candidate_languages = self.osm_country_and_languages(osm_components)
         if not (country and candidate_languages):
-            return None, None, None
+            return None
+
+        if neighborhoods is None:
+            neighborhoods = self.neighborhood_components(latitude, longitude)
+
+        return latitude, longitude, osm_components, neighborhoods, country, candidate_languages
+
+    def expanded_batch(self, records, **kwargs):
+        '''
+        Batch version of expanded
+
+        records is a list of (address_components, latitude, longitude) or
+        (address_components, latitude, longitude, options) tuples, where
+        options is a dict of keyword arguments to expanded for that record.
+        kwargs apply to every record.
+
+        The reverse geocoding is done up front, in spatial order so the
+        polygon caches stay warm, with repeated coordinates looked up once
+        and the country resolved once per containing polygon set. The
+        remaining steps then run record by record in input order, so the
+        random stream, and the output, is the same as calling expanded on
+        each record in turn. If options contains random_state (as returned
+        by random.getstate()), the random module is set to that state
+        before the record is expanded, e.g. to reproduce per-record seeds.
+
+        Returns a list of (address_components, country, language).
+        '''
+        parsed = []
+        for record in records:
+            if len(record) == 4:
+                address_components, latitude, longitude, options = record
+                options = dict(kwargs, **options)
+            else:
+                address_components, latitude, longitude = record
+                options = kwargs
+            try:
+                latitude, longitude = latlon_to_decimal(latitude, longitude)
+            except Exception:
+                latitude = longitude = None
+            parsed.append((address_components, latitude, longitude, options))
+
+        admin_lookups = {}
+        neighborhood_lookups = {}
+        country_lookups = {}
+
+        def spatial_order(i):
+            address_components, latitude, longitude, options = parsed[i]
+            return (int(latitude * 10), int(longitude * 10), latitude, longitude)
+
+        valid = [i for i, record in enumerate(parsed) if record[1] is not None]
+
+        locations = [None] * len(parsed)
+        for i in sorted(valid, key=spatial_order):
+            address_components, latitude, longitude, options = parsed[i]
+            point = (latitude, longitude)
+
+            osm_components = options.get('osm_components')
+            if osm_components is None:
+                osm_components = admin_lookups.get(point)
+                if osm_components is None:
+                    osm_components = admin_lookups[point] = self.osm_reverse_geocoded_components(latitude, longitude)
+
+            if all(('type' in c and 'id' in c for c in osm_components)):
+                ids = tuple([(c['type'], c['id']) for c in osm_components])
+                country_and_languages = country_lookups.get(ids)
+                if country_and_languages is None:
+                    country_and_languages = country_lookups[ids] = self.osm_country_and_languages(osm_components)
+                country, candidate_languages = country_and_languages
+            else:
+                country, candidate_languages = self.osm_country_and_languages(osm_components)
+
+            if not (country and candidate_languages):
+                continue
+
+            neighborhoods = options.get('neighborhoods')
+            if neighborhoods is None:
+                neighborhoods = neighborhood_lookups.get(point)
+                if neighborhoods is None:
+                    neighborhoods = neighborhood_lookups[point] = self.neighborhood_components(latitude, longitude)
+
+            locations[i] = (latitude, longitude, osm_components, neighborhoods, country, candidate_languages)
+
+        results = []
+        for (address_components, latitude, longitude, options), location in zip(parsed, locations):
+            if location is None:
+                results.append((None, None, None))
+                continue
+
+            options = {k: v for k, v in six.iteritems(options) if k not in ('osm_components', 'neighborhoods')}
+            random_state = options.pop('random_state', None)
+            if random_state is not None:
+                random.setstate(random_state)
+
+            results.append(self.expanded_with_location(address_components, location, **options))
+
+        return results
+
+    def expanded_with_location(self, address_components, location, language=None,
+                               dropout_places=True, population=None,
+                               population_from_city=False, check_city_wikipedia=False,
+                               add_sub_building_components=True, hyphenation=True,
+                               num_floors=None, num_basements=None, zone=None):
+        '''
+        The rest of expanded, given the result of expanded_location
+        '''
+        latitude, longitude, osm_components, neighborhoods, country, candidate_languages = location
 
         more_than_one_official_language = len(candidate_languages) > 1
 
         non_local_language = None
         language_suffix = ''
 
-        if neighborhoods is None:
-            neighborhoods = self.neighborhood_components(latitude, longitude)
-
         all_osm_components = osm_components + neighborhoods
 
         if not language:
@@ -1953,13 +2203,14 @@ class AddressComponents(object):
 
         return address_components, country, language
 
-    def limited(self, address_components, latitude, longitude):
+    def limited(self, address_components, latitude, longitude, osm_components=None, neighborhoods=None):
         try:
             latitude, longitude = latlon_to_decimal(latitude, longitude)
         except Exception:
             return None, None, None
 
-        osm_components = self.osm_reverse_geocoded_components(latitude, longitude)
+        if osm_components is None:
+            osm_components = self.osm_reverse_geocoded_components(latitude, longitude)
         country, candidate_languages = self.osm_country_and_languages(osm_components)
 
         if not (country and candidate_languages):
@@ -1987,7 +2238,8 @@ class AddressComponents(object):
 
         street = address_components.get(AddressFormatter.ROAD)
 
-        neighborhoods = self.neighborhood_components(latitude, longitude)
+        if neighborhoods is None:
+            neighborhoods = self.neighborhood_components(latitude, longitude)
 
         all_languages = set([l for l, d in candidate_languages])
 
@@ -0,0 +1,148 @@
+'''
+Per-step profiling for AddressComponents.expanded
+
+expanded chains a few dozen steps whose relative cost varies a lot by
+country (e.g. name affix replacement or sub-building components are only
+expensive in some places). StepProfiler records cumulative wall time and
+call counts for each step, overall and per country.
+
+Profiling is opt-in: AddressComponents.enable_profiling replaces the step
+methods on that instance with timed wrappers, so instances which aren't
+being profiled run the original methods with no added cost.
+
+With worker processes, each worker profiles its own share of the records.
+Profilers pickle to plain dicts, so the workers can send theirs back to
+the parent to merge into one report.
+'''
+import inspect
+import time
+
+from collections import defaultdict
+
+EXPANDED = 'expanded'
+
+
+class StepStats(object):
+    __slots__ = ('calls', 'seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+
+
+class StepProfiler(object):
+    top_countries = 20
+    top_steps_per_country = 10
+
+    def __init__(self):
+        self.steps = defaultdict(StepStats)
+        self.country_steps = defaultdict(lambda: defaultdict(StepStats))
+        # Country of the record being expanded, for steps without a country argument
+        self.country = None
+
+    def __getstate__(self):
+        return {
+            'steps': {step: (stats.calls, stats.seconds) for step, stats in self.steps.iteritems()},
+            'country_steps': {country: {step: (stats.calls, stats.seconds) for step, stats in steps.iteritems()}
+                              for country, steps in self.country_steps.iteritems()},
+        }
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.add_state(state)
+
+    def add_state(self, state):
+        self.add_totals(self.steps, state['steps'])
+        for country, totals in state['country_steps'].iteritems():
+            self.add_totals(self.country_steps[country], totals)
+
+    @classmethod
+    def add_totals(cls, steps, totals):
+        for step, (calls, seconds) in totals.iteritems():
+            stats = steps[step]
+            stats.calls += calls
+            stats.seconds += seconds
+
+    def merge(self, other):
+        '''Adds the calls and time recorded by another profiler, e.g. a worker's'''
+        self.add_state(other.__getstate__())
+
+    def add(self, step, country, seconds):
+        stats = self.steps[step]
+        stats.calls += 1
+        stats.seconds += seconds
+
+        stats = self.country_steps[country][step]
+        stats.calls += 1
+        stats.seconds += seconds
+
+    def wrap(self, step, method):
+        '''Timed version of a bound method, attributed to its country argument if it has one'''
+        try:
+            arg_names = inspect.getargspec(method).args
+        except TypeError:
+            arg_names = []
+        # Bound methods don't take self/cls positionally
+        country_pos = arg_names.index('country') - 1 if 'country' in arg_names else None
+
+        def timed(*args, **kw):
+            if country_pos is not None and country_pos < len(args):
+                country = args[country_pos]
+            else:
+                country = kw.get('country', self.country)
+            start = time.time()
+            try:
+                return method(*args, **kw)
+            finally:
+                self.add(step, country, time.time() - start)
+        return timed
+
+    def wrap_expanded(self, method):
+        '''Wraps expanded_with_location, whose location tuple holds the country'''
+        def timed(address_components, location, *args, **kw):
+            self.country = location[4]
+            start = time.time()
+            try:
+                return method(address_components, location, *args, **kw)
+            finally:
+                self.add(EXPANDED, self.country, time.time() - start)
+        return timed
+
+    def sorted_steps(self, steps):
+        return sorted(steps.iteritems(), key=lambda item: item[1].seconds, reverse=True)
+
+    def format_steps(self, steps, limit=None):
+        total = steps[EXPANDED].seconds if EXPANDED in steps else 0.0
+        lines = []
+        for step, stats in self.sorted_steps(steps)[:limit]:
+            lines.append('  {:<40} calls={:<10d} seconds={:<10.3f} avg_ms={:<8.4f} pct_of_expanded={:.1f}'.format(
+                step, stats.calls, stats.seconds, stats.seconds * 1000.0 / stats.calls if stats.calls else 0.0,
+                stats.seconds * 100.0 / total if total else 0.0))
+        return lines
+
+    def report(self):
+        if not self.steps:
+            return ''
+
+        lines = ['AddressComponents.expanded step profile (inclusive wall time):']
+        lines.extend(self.format_steps(self.steps))
+
+        def country_seconds(item):
+            country, steps = item
+            return steps[EXPANDED].seconds if EXPANDED in steps else sum((s.seconds for s in steps.itervalues()))
+
+        countries = sorted(self.country_steps.iteritems(), key=country_seconds, reverse=True)
+        for country, steps in countries[:self.top_countries]:
+            lines.append('country={}:'.format(country))
+            lines.extend(self.format_steps(steps, limit=self.top_steps_per_country))
+        return '\n'.join(lines)
+
+    def log(self):
+        report = self.report()
+        if report:
+            print(report)
+
+    def reset(self):
+        self.steps.clear()
+        self.country_steps.clear()
+        self.country = None
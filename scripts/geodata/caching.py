@@ -0,0 +1,83 @@
+import sys
+
+from lru import LRU
+
+
+class LRUCache(object):
+    '''
+    Size-bounded LRU cache with hit/miss/eviction counters
+
+    Wraps lru.LRU with a dict-like get/put interface. Memory is estimated
+    from the shallow sizes of keys and values as they're inserted, so for
+    nested values it's a lower bound, but it's good enough to compare cache
+    sizes against a worker's memory budget.
+    '''
+    def __init__(self, size, name=None):
+        self.size = size
+        self.name = name
+        self.cache = LRU(size)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.entry_bytes = 0
+        self.entries_sized = 0
+
+    def get(self, key, default=None):
+        value = self.cache.get(key, None)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def __contains__(self, key):
+        return self.cache.has_key(key)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if not self.cache.has_key(key):
+            if len(self.cache) >= self.size:
+                self.evictions += 1
+            self.entry_bytes += sys.getsizeof(key) + sys.getsizeof(value)
+            self.entries_sized += 1
+        self.cache[key] = value
+
+    def __len__(self):
+        return len(self.cache)
+
+    def clear(self):
+        self.cache.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def memory_estimate(self):
+        if not self.entries_sized:
+            return 0
+        return int(float(self.entry_bytes) / self.entries_sized * len(self.cache))
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def stats(self):
+        return {
+            'size': len(self.cache),
+            'max_size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate(),
+            'evictions': self.evictions,
+            'memory_estimate': self.memory_estimate(),
+        }
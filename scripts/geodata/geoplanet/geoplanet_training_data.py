@@ -1,5 +1,4 @@
 import argparse
-import csv
 import itertools
 import os
 import six
@@ -15,12 +14,16 @@ from geodata.address_expansions.abbreviations import abbreviate
 from geodata.address_expansions.equivalence import equivalent
 from geodata.address_expansions.gazetteers import *
 
-from geodata.address_formatting.formatter import AddressFormatter
+from geodata.address_formatting.formatter import AddressFormatter, CACHE_STATS_INTERVAL
 
 from geodata.countries.names import country_names
+from geodata.math.sampling import seed_record
+from geodata.metrics import NULL_METRICS
 from geodata.postal_codes.validation import postcode_regexes
 from geodata.names.normalization import name_affixes
 from geodata.places.config import place_config
+from geodata.subset import ALL_RECORDS
+from geodata.training_data_writer import training_data_writer
 
 from geodata.csv_utils import tsv_string, unicode_csv_reader
 
@@ -82,9 +85,19 @@ class GeoPlanetFormatter(object):
         'Suburb': AddressFormatter.SUBURB,
     }
 
-    def __init__(self, geoplanet_db):
+    def __init__(self, geoplanet_db, seed=None, shard_options=None, subset=None, metrics=None):
         self.db = sqlite3.connect(geoplanet_db)
 
+        # If set, random sampling is reseeded per postal code (see seed_record)
+        self.seed = seed
+
+        # If set, output is written as compressed shards, see training_data_writer
+        self.shard_options = shard_options
+
+        # Records to process, see geodata.subset. Postal codes have no
+        # coordinates, so bbox filters don't apply
+        self.subset = subset or ALL_RECORDS
+
         # These aren't too large and it's easier to have them in memory
         self.places = {row[0]: row[1:] for row in self.db.execute('select * from places')}
         self.aliases = defaultdict(list)
@@ -174,6 +187,12 @@ class GeoPlanetFormatter(object):
 
         self.formatter = AddressFormatter()
 
+        # Throughput and stage timings, see geodata.metrics
+        self.metrics = metrics or NULL_METRICS
+        if metrics is not None:
+            self.formatter.metrics = metrics
+            metrics.add_cache_source('formatter', self.formatter.cache_stats)
+
     def get_place_hierarchy(self, place_id):
         all_places = []
         original_place_id = place_id
@@ -195,7 +214,11 @@ class GeoPlanetFormatter(object):
     def format_postal_codes(self, tag_components=True):
         all_postal_codes = self.db.execute('select * from postal_codes')
         for postal_code_id, country, postal_code, language, place_type, parent_id in all_postal_codes:
+            self.metrics.record()
+            seed_record(self.seed, 'geoplanet_postal_codes', postal_code_id)
             country = country.lower()
+            if self.subset.skip('geoplanet_postal_codes', postal_code_id, country=country):
+                continue
             postcode_language = language
 
             language = self.language_codes[language]
@@ -315,11 +338,11 @@ class GeoPlanetFormatter(object):
 
     def build_training_data(self, out_dir, tag_components=True):
         if tag_components:
-            formatted_tagged_file = open(os.path.join(out_dir, GEOPLANET_FORMAT_DATA_TAGGED_FILENAME), 'w')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
+            filename = GEOPLANET_FORMAT_DATA_TAGGED_FILENAME
         else:
-            formatted_tagged_file = open(os.path.join(out_dir, GEOPLANET_FORMAT_DATA_FILENAME), 'w')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
+            filename = GEOPLANET_FORMAT_DATA_FILENAME
+        self.metrics.start('geoplanet')
+        writer = self.metrics.timed_writer(training_data_writer(os.path.join(out_dir, filename), self.shard_options))
 
         i = 0
 
@@ -336,18 +359,27 @@ class GeoPlanetFormatter(object):
             else:
                 row = (formatted_address,)
 
+            if not self.subset.accept_row(country, language):
+                continue
+
             writer.writerow(row)
             i += 1
             if i % 1000 == 0 and i > 0:
                 print('did {} formatted addresses'.format(i))
+                if i % CACHE_STATS_INTERVAL == 0:
+                    self.formatter.log_cache_stats()
+
+        writer.close()
+        self.metrics.finish()
 
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
-        sys.exit('Usage: python geoplanet_training_data.py geoplanet_db_path out_dir')
+        sys.exit('Usage: python geoplanet_training_data.py geoplanet_db_path out_dir [seed]')
 
     geoplanet_db_path = sys.argv[1]
     out_dir = sys.argv[2]
+    seed = sys.argv[3] if len(sys.argv) > 3 else None
 
-    geoplanet = GeoPlanetFormatter(geoplanet_db_path)
+    geoplanet = GeoPlanetFormatter(geoplanet_db_path, seed=seed)
     geoplanet.build_training_data(out_dir)
@@ -1,71 +1,44 @@
 import argparse
 import logging
 import os
-import subprocess
 import sys
 
 this_dir = os.path.realpath(os.path.dirname(__file__))
 sys.path.append(os.path.realpath(os.path.join(os.pardir, os.pardir)))
 
-from geodata.osm.osm_address_training_data import WAYS_LANGUAGE_DATA_FILENAME, ADDRESS_LANGUAGE_DATA_FILENAME, ADDRESS_FORMAT_DATA_LANGUAGE_FILENAME, TOPONYM_LANGUAGE_DATA_FILENAME
+from geodata.osm.formatter import FORMATTED_ADDRESS_DATA_LANGUAGE_FILENAME
+from geodata.osm.osm_address_training_data import WAYS_LANGUAGE_DATA_FILENAME, ADDRESS_LANGUAGE_DATA_FILENAME, TOPONYM_LANGUAGE_DATA_FILENAME
+from geodata.shuffle import shuffle_split, DEFAULT_MEMORY_BUDGET
+from geodata.training_data_writer import training_data_exists
 
-LANGUAGES_ALL_FILE = 'languages.all'
-LANGAUGES_RANDOM_FILE = 'languages.random'
 LANGUAGES_TRAIN_FILE = 'languages.train'
 LANGUAGES_CV_FILE = 'languages.cv'
 LANGUAGES_TEST_FILE = 'languages.test'
 
 
-def create_language_training_data(osm_dir, split_data=True, train_split=0.8, cv_split=0.1):
-    language_all_path = os.path.join(osm_dir, LANGUAGES_ALL_FILE)
+def create_language_training_data(osm_dir, split_data=True, train_split=0.8, cv_split=0.1,
+                                  seed=None, memory_budget=DEFAULT_MEMORY_BUDGET, temp_dir=None):
+    input_paths = [os.path.join(osm_dir, filename) for filename in (WAYS_LANGUAGE_DATA_FILENAME,
+                                                                    ADDRESS_LANGUAGE_DATA_FILENAME,
+                                                                    FORMATTED_ADDRESS_DATA_LANGUAGE_FILENAME,
+                                                                    TOPONYM_LANGUAGE_DATA_FILENAME)]
 
-    ways_path = os.path.join(osm_dir, WAYS_LANGUAGE_DATA_FILENAME)
-
-    if os.system(' '.join(['cat', ways_path, '>', language_all_path])) != 0:
-        raise SystemError('Could not find {}'.format(ways_path))
-
-    addresses_path = os.path.join(osm_dir, ADDRESS_LANGUAGE_DATA_FILENAME)
-
-    if os.system(' '.join(['cat', addresses_path, '>>', language_all_path])) != 0:
-        raise SystemError('Could not find {}'.format(addresses_path))
-
-    formatted_path = os.path.join(osm_dir, ADDRESS_FORMAT_DATA_LANGUAGE_FILENAME)
-
-    if os.system(' '.join(['cat', formatted_path, '>>', language_all_path])) != 0:
-        raise SystemError('Could not find {}'.format(formatted_path))
-
-    toponyms_path = os.path.join(osm_dir, TOPONYM_LANGUAGE_DATA_FILENAME)
-
-    if os.system(' '.join(['cat', toponyms_path, '>>', language_all_path])) != 0:
-        raise SystemError('Could not find {}'.format(toponyms_path))
-
-    languages_random_path = os.path.join(osm_dir, LANGAUGES_RANDOM_FILE)
-
-    if os.system(u' '.join(['shuf', '--random-source=/dev/urandom', language_all_path, '>', languages_random_path])) != 0:
-        raise SystemError('shuffle failed')
+    for path in input_paths:
+        if not training_data_exists(path):
+            raise SystemError('Could not find {}'.format(path))
 
     languages_train_path = os.path.join(osm_dir, LANGUAGES_TRAIN_FILE)
 
     if split_data:
-        languages_test_path = os.path.join(osm_dir, LANGUAGES_TEST_FILE)
-
-        num_lines = sum((1 for line in open(languages_random_path)))
-        train_lines = int(train_split * num_lines)
-
-        test_lines = num_lines - train_lines
-        cv_lines = int(test_lines * (cv_split / (1.0 - train_split))) + 1
-
-        subprocess.check_call(['split', '-l', str(train_lines), languages_random_path, os.path.join(osm_dir, 'language-split-')])
-        subprocess.check_call(['mv', os.path.join(osm_dir, 'language-split-aa'), languages_train_path])
-        subprocess.check_call(['mv', os.path.join(osm_dir, 'language-split-ab'), languages_test_path])
-
         languages_cv_path = os.path.join(osm_dir, LANGUAGES_CV_FILE)
-
-        subprocess.check_call(['split', '-l', str(cv_lines), languages_test_path, os.path.join(osm_dir, 'language-split-')])
-        subprocess.check_call(['mv', os.path.join(osm_dir, 'language-split-aa'), languages_cv_path])
-        subprocess.check_call(['mv', os.path.join(osm_dir, 'language-split-ab'), languages_test_path])
+        languages_test_path = os.path.join(osm_dir, LANGUAGES_TEST_FILE)
+        outputs = [(languages_train_path, train_split),
+                   (languages_cv_path, cv_split),
+                   (languages_test_path, 1.0 - train_split - cv_split)]
     else:
-        subprocess.check_call(['mv', languages_random_path, languages_train_path])
+        outputs = [(languages_train_path, 1.0)]
+
+    shuffle_split(input_paths, outputs, seed=seed, memory_budget=memory_budget, temp_dir=temp_dir)
 
 if __name__ == '__main__':
     # Handle argument parsing here
@@ -90,6 +63,19 @@ if __name__ == '__main__':
                         default=os.getcwd(),
                         help='OSM directory')
 
+    parser.add_argument('--seed',
+                        default=None,
+                        help='Random seed for the shuffle and split, for reproducible output')
+
+    parser.add_argument('-m', '--memory-budget',
+                        type=int,
+                        default=DEFAULT_MEMORY_BUDGET,
+                        help='Approximate number of bytes of lines to hold in memory while shuffling')
+
+    parser.add_argument('--temp-dir',
+                        default=None,
+                        help='Directory for shuffle buckets (default: the system temp directory)')
+
     args = parser.parse_args()
     if args.train_split + args.cv_split >= 1.0:
         raise ValueError('Train split + cross-validation split must be less than 1.0')
@@ -97,4 +83,5 @@ if __name__ == '__main__':
     if not os.path.exists(args.osm_dir):
         raise ValueError('OSM directory does not exist')
 
-    create_language_training_data(args.osm_dir, split_data=args.no_split, train_split=args.train_split, cv_split=args.cv_split)
+    create_language_training_data(args.osm_dir, split_data=args.no_split, train_split=args.train_split, cv_split=args.cv_split,
+                                  seed=args.seed, memory_budget=args.memory_budget, temp_dir=args.temp_dir)
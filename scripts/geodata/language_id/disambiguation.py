@@ -123,13 +123,11 @@ def disambiguate_language(text, languages, scripts_only=False):
     for t, c, l, data in street_types_gazetteer.filter(tokens):
         if c == token_types.PHRASE:
             valid = OrderedDict()
-            data = [safe_decode(d).split(u'|') for d in data]
             potentials = set([l for l, d, i, c in data if l in valid_languages])
             potential_defaults = set([l for l in potentials if valid_languages[l]])
 
             phrase_len = sum((len(t_i[0]) for t_i in t))
             for lang, dictionary, is_canonical, canonical in data:
-                is_canonical = int(is_canonical)
                 is_stopword = dictionary == 'stopword'
                 if lang not in valid_languages or (is_stopword and len(potentials) > 1):
                     continue
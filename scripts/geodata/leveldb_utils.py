@@ -0,0 +1,62 @@
+import six
+
+from leveldb import WriteBatch
+
+DEFAULT_WRITE_BATCH_SIZE = 10000
+
+
+class LevelDBWriteBuffer(object):
+    '''
+    Buffers puts to a LevelDB in memory and writes them out as a single
+    WriteBatch every batch_size unique keys. Repeated puts to the same key
+    before a flush are collapsed so only the last value is written.
+
+    Reads go through the buffer first, so callers can Get keys they've
+    just Put without flushing. Call flush() at checkpoints (end of a pass,
+    before compaction, etc.) to make sure everything is on disk.
+    '''
+    def __init__(self, db, batch_size=DEFAULT_WRITE_BATCH_SIZE, sync=False):
+        self.db = db
+        self.batch_size = batch_size
+        self.sync = sync
+        self.pending = {}
+
+        self.puts = 0
+        self.writes = 0
+
+    def Put(self, key, value):
+        self.pending[key] = value
+        self.puts += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def Get(self, key):
+        value = self.pending.get(key)
+        if value is not None:
+            return value
+        return self.db.Get(key)
+
+    def Delete(self, key):
+        self.flush()
+        self.db.Delete(key)
+
+    def CompactRange(self, *args, **kw):
+        self.flush()
+        self.db.CompactRange(*args, **kw)
+
+    def RangeIter(self, *args, **kw):
+        self.flush()
+        return self.db.RangeIter(*args, **kw)
+
+    def flush(self):
+        if not self.pending:
+            return
+        batch = WriteBatch()
+        for key, value in six.iteritems(self.pending):
+            batch.Put(key, value)
+        self.db.Write(batch, sync=self.sync)
+        self.writes += len(self.pending)
+        self.pending.clear()
+
+    def __len__(self):
+        return len(self.pending)
@@ -0,0 +1,114 @@
+import hashlib
+import math
+import struct
+
+from collections import deque
+
+LN2 = math.log(2)
+
+
+def bloom_num_bits(capacity, error_rate):
+    return max(8, int(math.ceil(-capacity * math.log(error_rate) / (LN2 ** 2))))
+
+
+class BloomFilter(object):
+    '''Fixed-capacity bloom filter over byte strings'''
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = bloom_num_bits(capacity, error_rate)
+        self.num_hashes = max(1, int(round(float(self.num_bits) / capacity * LN2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def bit_positions(self, key):
+        # Double hashing (Kirsch-Mitzenmacher), one md5 per key
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in xrange(self.num_hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self.bit_positions(key))
+
+    def add(self, key):
+        '''Adds key and returns True if it was (probably) already present'''
+        bits = self.bits
+        present = True
+        for i in self.bit_positions(key):
+            mask = 1 << (i & 7)
+            if not bits[i >> 3] & mask:
+                present = False
+                bits[i >> 3] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+    def memory(self):
+        return len(self.bits)
+
+
+class ScalableBloomFilter(object):
+    '''
+    Bloom filter which adds a larger, stricter filter each time the
+    current one fills up, so the overall false positive rate stays under
+    error_rate however many keys are added (Almeida et al., 2007).
+
+    If max_memory (bytes) is set and adding a filter would exceed it, the
+    oldest filters are dropped, so keys seen long ago may be let through
+    again. That bounds memory on arbitrarily large inputs at the cost of
+    only deduplicating within a (very large) recent window.
+    '''
+    growth_factor = 2
+    tightening_ratio = 0.9
+
+    def __init__(self, initial_capacity=1000000, error_rate=0.001, max_memory=None):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.max_memory = max_memory
+        self.filters = deque()
+        self.num_filters_added = 0
+        self.dropped_filters = 0
+        self.add_filter()
+
+    def add_filter(self):
+        n = self.num_filters_added
+        capacity = self.initial_capacity * (self.growth_factor ** n)
+        # First filter gets error_rate * (1 - r), the series sums to error_rate
+        error_rate = self.error_rate * (1.0 - self.tightening_ratio) * (self.tightening_ratio ** n)
+
+        if self.max_memory:
+            # Stop growing once a filter would take more than half the budget
+            while capacity > self.initial_capacity and bloom_num_bits(capacity, error_rate) // 8 > self.max_memory // 2:
+                capacity //= self.growth_factor
+
+        new_filter = BloomFilter(capacity, error_rate)
+
+        if self.max_memory:
+            while self.filters and self.memory() + new_filter.memory() > self.max_memory:
+                self.filters.popleft()
+                self.dropped_filters += 1
+
+        self.filters.append(new_filter)
+        self.num_filters_added += 1
+
+    def __contains__(self, key):
+        return any(key in f for f in self.filters)
+
+    def add(self, key):
+        '''Adds key and returns True if it was (probably) already present'''
+        current = self.filters[-1]
+        for f in self.filters:
+            if f is not current and key in f:
+                return True
+        if current.add(key):
+            return True
+        if current.is_full():
+            self.add_filter()
+        return False
+
+    def memory(self):
+        return sum((f.memory() for f in self.filters))
@@ -1,7 +1,11 @@
 import bisect
+import hashlib
 import random
+import six
+import struct
 import sys
 
+from geodata.encoding import safe_decode, safe_encode
 from geodata.math.floats import isclose, FLOAT_EPSILON
 
 
@@ -40,3 +44,25 @@ def zipfian_distribution(n, b=1.0):
     frequencies = [1. / (i ** b) for i in xrange(1, n + 1)]
     total = sum(frequencies)
     return [f / total for f in frequencies]
+
+
+def record_seed(global_seed, source, record_id):
+    """64-bit seed for one record, stable across processes, machines and runs"""
+    key = six.u('\x1f').join((safe_decode(global_seed), safe_decode(source), safe_decode(record_id)))
+    return struct.unpack('<Q', hashlib.sha1(safe_encode(key)).digest()[:8])[0]
+
+
+def seed_record(global_seed, source, record_id):
+    """
+    Reseed the global random module for the record identified by (source, record_id)
+
+    All of the sampling in the training data generators (weighted_choice,
+    component dropout, template revisions, abbreviations, etc.) goes through
+    the global random module. Reseeding it per record means each record's
+    random stream depends only on the global seed and the record itself, not
+    on which records were processed before it, so serial, multiprocess and
+    sharded runs produce identical output. With global_seed=None this is a no-op.
+    """
+    if global_seed is None:
+        return
+    random.seed(record_seed(global_seed, source, record_id))
@@ -0,0 +1,264 @@
+'''
+Throughput and stage timing metrics for the training data builders
+
+A BuilderMetrics instance is shared by a formatter, its AddressComponents
+and its AddressFormatter. Builders call start(name) at the beginning of a
+build, record() for each input record and finish() at the end. The
+expensive steps are wrapped in timer(stage):
+
+- reverse_geocode: point-in-polygon lookups (or join table lookups)
+- expansion: AddressComponents.expanded/limited
+- template_revision: AddressFormatter.revised_template
+- render: AddressFormatter.render_address
+- write: writing rows to the output
+
+Stage times are exclusive, i.e. time spent reverse geocoding inside
+expansion is only counted toward reverse_geocode.
+
+Every interval seconds, one JSON line with records/sec, stage times, cache
+hit rates and RSS is appended to the metrics file. Forked worker processes
+append their own lines, distinguished by pid.
+
+NULL_METRICS (the default everywhere) does nothing, so builders which
+aren't writing metrics pay only for a no-op method call per record.
+'''
+import json
+import os
+import six
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_METRICS_INTERVAL = 60.0
+
+# Only look at the clock every this many records
+CHECK_EVERY = 1000
+
+STAGES = ('reverse_geocode', 'expansion', 'template_revision', 'render', 'write')
+
+
+def current_rss():
+    '''Resident set size of this process in bytes, or None if unknown'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss():
+    '''Peak resident set size of this process in bytes, or None if unknown'''
+    if resource is None:
+        return None
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class StageTimer(object):
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.metrics.push_stage(self.stage)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.pop_stage()
+        return False
+
+
+class TimedWriter(object):
+    '''Wraps a training data writer, timing writes and counting rows'''
+    def __init__(self, writer, metrics):
+        self.writer = writer
+        self.metrics = metrics
+
+    def writerow(self, row):
+        with self.metrics.timer('write'):
+            self.writer.writerow(row)
+        self.metrics.rows += 1
+
+    def counted(self, rows):
+        for row in rows:
+            self.metrics.rows += 1
+            yield row
+
+    def writerows(self, rows):
+        with self.metrics.timer('write'):
+            self.writer.writerows(self.counted(rows))
+
+    def writelines(self, lines):
+        with self.metrics.timer('write'):
+            self.writer.writelines(self.counted(lines))
+
+    def close(self):
+        with self.metrics.timer('write'):
+            self.writer.close()
+
+
+class BuilderMetrics(object):
+    enabled = True
+
+    def __init__(self, filename, interval=DEFAULT_METRICS_INTERVAL):
+        self.filename = filename
+        self.interval = interval
+        # name => function returning {cache_name: stats dict}
+        self.cache_sources = {}
+        self.start(None)
+
+    def start(self, builder):
+        '''Resets the counters for a new build'''
+        self.builder = builder
+        self.records = 0
+        self.rows = 0
+        self.stage_seconds = {stage: 0.0 for stage in STAGES}
+        self.stack = []
+
+        self.start_time = self.last_report_time = time.time()
+        self.last_report_records = 0
+
+    def add_cache_source(self, name, func):
+        self.cache_sources[name] = func
+
+    def timer(self, stage):
+        return StageTimer(self, stage)
+
+    def push_stage(self, stage):
+        now = time.time()
+        if self.stack:
+            # Pause the enclosing stage
+            parent, parent_start = self.stack[-1]
+            self.stage_seconds[parent] = self.stage_seconds.get(parent, 0.0) + now - parent_start
+        self.stack.append((stage, now))
+
+    def pop_stage(self):
+        now = time.time()
+        stage, stage_start = self.stack.pop()
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + now - stage_start
+        if self.stack:
+            parent, parent_start = self.stack[-1]
+            self.stack[-1] = (parent, now)
+
+    def timed_writer(self, writer):
+        return TimedWriter(writer, self)
+
+    def record(self, n=1):
+        self.records += n
+        if self.records % CHECK_EVERY < n and time.time() - self.last_report_time >= self.interval:
+            self.report()
+
+    def cache_stats(self):
+        caches = {}
+        for source, func in six.iteritems(self.cache_sources):
+            stats = func()
+            if not stats:
+                continue
+            for name, cache_stats in six.iteritems(stats):
+                if cache_stats:
+                    caches['{}.{}'.format(source, name)] = cache_stats
+        return caches
+
+    def snapshot(self, final=False):
+        now = time.time()
+        elapsed = now - self.start_time
+        interval_elapsed = now - self.last_report_time
+        interval_records = self.records - self.last_report_records
+
+        return {
+            'time': now,
+            'pid': os.getpid(),
+            'builder': self.builder,
+            'final': final,
+            'elapsed': elapsed,
+            'records': self.records,
+            'rows': self.rows,
+            'records_per_sec': self.records / elapsed if elapsed > 0 else 0.0,
+            'interval_records_per_sec': interval_records / interval_elapsed if interval_elapsed > 0 else 0.0,
+            'stage_seconds': dict(self.stage_seconds),
+            'caches': self.cache_stats(),
+            'rss_bytes': current_rss(),
+            'max_rss_bytes': max_rss(),
+        }
+
+    def write(self, line):
+        # One write per line on an O_APPEND fd, so lines from forked
+        # workers don't interleave
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def report(self, final=False):
+        self.write(json.dumps(self.snapshot(final=final)) + '\n')
+        self.last_report_time = time.time()
+        self.last_report_records = self.records
+
+    def finish(self):
+        self.report(final=True)
+
+
+class NullMetrics(object):
+    enabled = False
+
+    def start(self, builder):
+        pass
+
+    def add_cache_source(self, name, func):
+        pass
+
+    def timer(self, stage):
+        return NULL_TIMER
+
+    def timed_writer(self, writer):
+        return writer
+
+    def record(self, n=1):
+        pass
+
+    def report(self, final=False):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def index_cache_stats(indexes):
+    '''Polygon LRU stats for a dict of name => PolygonIndex (or None)'''
+    return {name: index.cache_stats() for name, index in six.iteritems(indexes)
+            if index is not None and hasattr(index, 'cache_stats')}
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics-file',
+                        default=None,
+                        help='Append JSON lines with throughput, stage timings, cache hit rates and RSS to this file')
+
+    parser.add_argument('--metrics-interval',
+                        type=float,
+                        default=DEFAULT_METRICS_INTERVAL,
+                        help='Seconds between metrics lines')
+
+
+def metrics_from_args(args):
+    if not args.metrics_file:
+        return None
+    return BuilderMetrics(args.metrics_file, interval=args.metrics_interval)
@@ -1,11 +1,11 @@
 # -*- coding: utf-8 -*-
 
-import csv
 import ftfy
 import itertools
 import os
 import random
 import re
+import shutil
 import six
 import yaml
 
@@ -13,26 +13,33 @@ from geodata.addresses.units import Unit
 from geodata.address_expansions.abbreviations import abbreviate
 from geodata.address_expansions.address_dictionaries import address_phrase_dictionaries
 from geodata.address_expansions.gazetteers import street_types_gazetteer, unit_types_gazetteer, toponym_abbreviations_gazetteer
-from geodata.address_formatting.formatter import AddressFormatter
+from geodata.address_formatting.formatter import AddressFormatter, CACHE_STATS_INTERVAL
 from geodata.addresses.components import AddressComponents
 from geodata.countries.constants import Countries
 from geodata.countries.names import country_names
 from geodata.encoding import safe_decode, safe_encode
+from geodata.file_utils import ensure_dir
 from geodata.i18n.languages import get_country_languages
 from geodata.i18n.word_breaks import ideographic_scripts
 from geodata.language_id.disambiguation import UNKNOWN_LANGUAGE, get_string_script
-from geodata.math.sampling import cdf, weighted_choice
+from geodata.math.sampling import cdf, weighted_choice, seed_record
 from geodata.openaddresses.config import openaddresses_config
 from geodata.places.config import place_config
+from geodata.metrics import NULL_METRICS, index_cache_stats
 from geodata.postal_codes.phrases import PostalCodes
+from geodata.subset import ALL_RECORDS
+from geodata.text import normalize
 from geodata.text.tokenize import tokenize
 from geodata.text.token_types import token_types
 from geodata.text.utils import is_numeric, is_numeric_strict
+from geodata.training_data_writer import training_data_writer, DedupingWriter
+from geodata.workers import ForkedWorkerPool
 
 from geodata.csv_utils import tsv_string, unicode_csv_reader
 
 OPENADDRESSES_FORMAT_DATA_TAGGED_FILENAME = 'openaddresses_formatted_addresses_tagged.tsv'
 OPENADDRESSES_FORMAT_DATA_FILENAME = 'openaddresses_formatted_addresses.tsv'
+OPENADDRESSES_SHARDS_DIR = 'openaddresses_shards'
 
 null_regex = re.compile('^\s*(?:null|none)\s*$', re.I)
 unknown_regex = re.compile('\bunknown\b', re.I)
@@ -86,14 +93,36 @@ class OpenAddressesFormatter(object):
                                  re.I | re.UNICODE)
             unit_type_regexes[lang] = pattern
 
-    def __init__(self, components, country_rtree, debug=False):
+    def __init__(self, components, country_rtree, debug=False, seed=None, shard_options=None, dedupe_options=None,
+                 subset=None, metrics=None):
         self.components = components
         self.country_rtree = country_rtree
 
         self.debug = debug
 
+        # If set, random sampling is reseeded per row (see seed_record)
+        self.seed = seed
+
+        # If set, output is written as compressed shards, see training_data_writer
+        self.shard_options = shard_options
+        # If set, duplicate rows are dropped, see DedupingWriter
+        self.dedupe_options = dedupe_options
+
+        # Records to process, see geodata.subset
+        self.subset = subset or ALL_RECORDS
+
         self.formatter = AddressFormatter()
 
+        # Throughput and stage timings, see geodata.metrics
+        self.metrics = metrics or NULL_METRICS
+        if metrics is not None:
+            self.components.metrics = metrics
+            self.formatter.metrics = metrics
+            metrics.add_cache_source('formatter', self.formatter.cache_stats)
+            metrics.add_cache_source('components', self.components.cache_stats)
+            metrics.add_cache_source('polygons', self.polygon_cache_stats)
+            metrics.add_cache_source('text', normalize.cache_stats)
+
     class validators:
         @classmethod
         def validate_postcode(cls, postcode):
@@ -290,7 +319,7 @@ class OpenAddressesFormatter(object):
     def fix_component_encodings(cls, components):
         return {k: ftfy.fix_encoding(safe_decode(v)) for k, v in six.iteritems(components)}
 
-    def formatted_addresses(self, country_dir, path, configs, tag_components=True):
+    def formatted_addresses(self, country_dir, path, configs, tag_components=True, source_key=None):
         abbreviate_street_prob = float(self.get_property('abbreviate_street_probability', *configs))
         separate_street_prob = float(self.get_property('separate_street_probability', *configs) or 0.0)
         abbreviate_unit_prob = float(self.get_property('abbreviate_unit_probability', *configs))
@@ -348,13 +377,22 @@ class OpenAddressesFormatter(object):
         self.components.osm_admin_rtree.clear_cache()
         self.components.neighborhoods_rtree.clear_cache()
 
-        for row in reader:
+        # Per-row seeds should not depend on where the OpenAddresses directory lives
+        if source_key is None:
+            source_key = os.path.relpath(path, os.path.dirname(os.path.dirname(path)))
+
+        for row_num, row in enumerate(reader):
+            self.metrics.record()
+            seed_record(self.seed, source_key, row_num)
             try:
                 latitude = float(row[latitude_index])
                 longitude = float(row[longitude_index])
             except (ValueError, TypeError):
                 continue
 
+            if self.subset.skip(source_key, row_num, latitude, longitude, country=country_dir):
+                continue
+
             language = config_language
 
             components = {}
@@ -536,50 +574,51 @@ class OpenAddressesFormatter(object):
                 # or for which those names are flawed
                 osm_components = []
 
-                # Using population=0 instead of None means if there's no known population or
-                # we don't need to add OSM components, we assume the population of the town is
-                # very small and the place name shouldn't be used unqualified (i.e. needs information
-                # like state name to disambiguate it)
-                population = 0
-                unambiguous_city = False
-                if add_osm_boundaries or AddressFormatter.CITY not in components:
-                    osm_components = self.components.osm_reverse_geocoded_components(latitude, longitude)
-                    self.components.add_admin_boundaries(components, osm_components, country, language, latitude, longitude)
-                    categorized = self.components.categorized_osm_components(country, osm_components)
-                    for component, label in categorized:
-                        if label == AddressFormatter.CITY:
-                            unambiguous_city = self.components.unambiguous_wikipedia(component, language)
-                            if 'population' in component:
-                                population = component['population']
-                            break
+                with self.metrics.timer('expansion'):
+                    # Using population=0 instead of None means if there's no known population or
+                    # we don't need to add OSM components, we assume the population of the town is
+                    # very small and the place name shouldn't be used unqualified (i.e. needs information
+                    # like state name to disambiguate it)
+                    population = 0
+                    unambiguous_city = False
+                    if add_osm_boundaries or AddressFormatter.CITY not in components:
+                        osm_components = self.components.osm_reverse_geocoded_components(latitude, longitude)
+                        self.components.add_admin_boundaries(components, osm_components, country, language, latitude, longitude)
+                        categorized = self.components.categorized_osm_components(country, osm_components)
+                        for component, label in categorized:
+                            if label == AddressFormatter.CITY:
+                                unambiguous_city = self.components.unambiguous_wikipedia(component, language)
+                                if 'population' in component:
+                                    population = component['population']
+                                break
 
-                if AddressFormatter.CITY not in components and city_replacements:
-                    components.update({k: v for k, v in six.iteritems(city_replacements) if k not in components})
+                    if AddressFormatter.CITY not in components and city_replacements:
+                        components.update({k: v for k, v in six.iteritems(city_replacements) if k not in components})
 
-                # The neighborhood index is cheaper so can turn on for whole countries
-                neighborhood_components = []
-                if add_osm_neighborhoods:
-                    neighborhood_components = self.components.neighborhood_components(latitude, longitude)
-                    self.components.add_neighborhoods(components, neighborhood_components, country, language, replace_city=osm_neighborhood_overrides_city)
+                    # The neighborhood index is cheaper so can turn on for whole countries
+                    neighborhood_components = []
+                    if add_osm_neighborhoods:
+                        neighborhood_components = self.components.neighborhood_components(latitude, longitude)
+                        self.components.add_neighborhoods(components, neighborhood_components, country, language, replace_city=osm_neighborhood_overrides_city)
 
-                self.components.cleanup_boundary_names(components)
-                self.components.country_specific_cleanup(components, country)
+                    self.components.cleanup_boundary_names(components)
+                    self.components.country_specific_cleanup(components, country)
 
-                self.components.replace_name_affixes(components, language, country=country)
+                    self.components.replace_name_affixes(components, language, country=country)
 
-                self.components.replace_names(components)
+                    self.components.replace_names(components)
 
-                self.components.prune_duplicate_names(components)
+                    self.components.prune_duplicate_names(components)
 
-                self.components.remove_numeric_boundary_names(components)
-                self.components.add_house_number_phrase(components, language, country=country)
-                self.components.add_postcode_phrase(components, language, country=country)
+                    self.components.remove_numeric_boundary_names(components)
+                    self.components.add_house_number_phrase(components, language, country=country)
+                    self.components.add_postcode_phrase(components, language, country=country)
 
-                # Component dropout
-                all_osm_components = osm_components + neighborhood_components
-                components = place_config.dropout_components(components, all_osm_components, country=country, population=population, unambiguous_city=unambiguous_city)
+                    # Component dropout
+                    all_osm_components = osm_components + neighborhood_components
+                    components = place_config.dropout_components(components, all_osm_components, country=country, population=population, unambiguous_city=unambiguous_city)
 
-                self.components.add_genitives(components, language)
+                    self.components.add_genitives(components, language)
 
                 formatted = self.formatter.format_address(components, country, language=language,
                                                           minimal_only=False, tag_components=tag_components)
@@ -605,7 +644,12 @@ class OpenAddressesFormatter(object):
                                                                   minimal_only=False, tag_components=tag_components)
                         yield (language, country, formatted)
 
-    def build_training_data(self, base_dir, out_dir, tag_components=True, sources_only=None):
+    def training_data_sources(self, base_dir, sources_only=None):
+        '''
+        List of (source, path, configs) for each OpenAddresses file to process,
+        in config order. source is a tuple like (country_dir, filename) or
+        (country_dir, subdir, filename).
+        '''
         all_sources_valid = sources_only is None
         valid_sources = set()
         if not all_sources_valid:
@@ -618,19 +662,13 @@ class OpenAddressesFormatter(object):
                     raise AssertionError('Sources may only have at maximum 3 parts')
                 valid_sources.add(tuple(parts))
 
-        if tag_components:
-            formatted_tagged_file = open(os.path.join(out_dir, OPENADDRESSES_FORMAT_DATA_TAGGED_FILENAME), 'w')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
-        else:
-            formatted_tagged_file = open(os.path.join(out_dir, OPENADDRESSES_FORMAT_DATA_FILENAME), 'w')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
-
-        i = 0
+        sources = []
 
         for country_dir in sorted(openaddresses_config.country_configs.keys()):
             country_config = openaddresses_config.country_configs[country_dir]
-            # Clear country cache for each new country
-            self.country_rtree.clear_cache()
+
+            if self.subset.countries is not None and country_dir.lower() not in self.subset.countries:
+                continue
 
             for file_config in country_config.get('files', []):
                 filename = file_config['filename']
@@ -638,29 +676,9 @@ class OpenAddressesFormatter(object):
                 if not all_sources_valid and not ((country_dir, filename) in valid_sources or (country_dir,) in valid_sources):
                     continue
 
-                print(six.u('doing {}/{}').format(country_dir, filename))
-
                 path = os.path.join(base_dir, country_dir, filename)
                 configs = (file_config, country_config, openaddresses_config.config)
-                for language, country, formatted_address in self.formatted_addresses(country_dir, path, configs, tag_components=tag_components):
-                    if not formatted_address or not formatted_address.strip():
-                        continue
-
-                    formatted_address = tsv_string(formatted_address)
-                    if not formatted_address or not formatted_address.strip():
-                        continue
-
-                    if tag_components:
-                        row = (language, country, formatted_address)
-                    else:
-                        row = (formatted_address,)
-
-                    writer.writerow(row)
-                    i += 1
-                    if i % 1000 == 0 and i > 0:
-                        print('did {} formatted addresses'.format(i))
-                        if self.debug:
-                            break
+                sources.append(((country_dir, filename), path, configs))
 
             for subdir in sorted(country_config.get('subdirs', {}).keys()):
                 subdir_config = country_config['subdirs'][subdir]
@@ -671,28 +689,175 @@ class OpenAddressesFormatter(object):
                     if not all_sources_valid and not ((country_dir, subdir, filename) in valid_sources or (country_dir, subdir) in valid_sources or (country_dir,) in valid_sources):
                         continue
 
-                    print(six.u('doing {}/{}/{}').format(country_dir, subdir, filename))
-
                     path = os.path.join(base_dir, country_dir, subdir, filename)
-
                     configs = (file_config, subdir_config, country_config, openaddresses_config.config)
-                    for language, country, formatted_address in self.formatted_addresses(country_dir, path, configs, tag_components=tag_components):
-                        if not formatted_address or not formatted_address.strip():
-                            continue
+                    sources.append(((country_dir, subdir, filename), path, configs))
 
-                        formatted_address = tsv_string(formatted_address)
-                        if not formatted_address or not formatted_address.strip():
-                            continue
+        return sources
 
-                        if tag_components:
-                            row = (language, country, formatted_address)
-                        else:
-                            row = (formatted_address,)
+    def write_source_training_data(self, source, path, configs, writer, tag_components=True, i=0):
+        country_dir = source[0]
 
-                        writer.writerow(row)
+        print(six.u('doing {}').format(six.u('/').join(source)))
 
-                        i += 1
-                        if i % 1000 == 0 and i > 0:
-                            print('did {} formatted addresses'.format(i))
-                            if self.debug:
-                                break
+        for language, country, formatted_address in self.formatted_addresses(country_dir, path, configs, tag_components=tag_components,
+                                                                             source_key=six.u('/').join(source)):
+            if not formatted_address or not formatted_address.strip():
+                continue
+
+            formatted_address = tsv_string(formatted_address)
+            if not formatted_address or not formatted_address.strip():
+                continue
+
+            if tag_components:
+                row = (language, country, formatted_address)
+            else:
+                row = (formatted_address,)
+
+            if not self.subset.accept_row(country, language):
+                continue
+
+            writer.writerow(row)
+
+            i += 1
+            if i % 1000 == 0 and i > 0:
+                print('did {} formatted addresses'.format(i))
+                if i % CACHE_STATS_INTERVAL == 0:
+                    self.formatter.log_cache_stats()
+                if self.debug:
+                    break
+
+        return i
+
+    @classmethod
+    def shard_filename(cls, source):
+        parts = list(source[:-1]) + [os.path.splitext(source[-1])[0]]
+        return six.u('__').join(parts) + six.u('.tsv')
+
+    def build_source_shard(self, source_info, shard_dir, tag_components=True):
+        '''
+        Worker task: write the training data for one source to its own shard
+        file and return (source, shard path, number of rows).
+        '''
+        source, path, configs = source_info
+
+        # Each source may be in a different part of the world, don't keep
+        # the previous source's polygons around
+        self.country_rtree.clear_cache()
+
+        shard_path = os.path.join(shard_dir, safe_encode(self.shard_filename(source)))
+        shard_writer = training_data_writer(shard_path, dedupe_options=self.dedupe_options)
+        writer = self.metrics.timed_writer(shard_writer)
+        num_rows = self.write_source_training_data(source, path, configs, writer, tag_components=tag_components)
+        writer.close()
+
+        # Rows actually in the shard, not counting dropped duplicates
+        if isinstance(shard_writer, DedupingWriter):
+            num_rows = shard_writer.rows_written()
+
+        return source, shard_path, num_rows
+
+    def polygon_cache_stats(self):
+        return index_cache_stats({
+            'country': self.country_rtree,
+            'osm_admin': self.components.osm_admin_rtree,
+            'neighborhoods': self.components.neighborhoods_rtree,
+        })
+
+    def worker_finished(self):
+        # Sent back to the parent, which merges the workers' step profiles
+        return self.components.profiler
+
+    def reopen_indexes(self):
+        for index in (self.country_rtree, self.components.osm_admin_rtree,
+                      self.components.neighborhoods_rtree, self.components.places_index):
+            if index is not None and hasattr(index, 'reopen_index'):
+                index.reopen_index()
+
+    def build_training_data(self, base_dir, out_dir, tag_components=True, sources_only=None,
+                            num_workers=1, concatenate=True):
+        '''
+        With num_workers > 1, each source file is processed independently by
+        a forked worker process (sharing this formatter's indexes) and written
+        to its own shard under out_dir/OPENADDRESSES_SHARDS_DIR. Sources are
+        scheduled largest first so the total time is close to that of the
+        largest file. If concatenate is True, the shards are then combined
+        in config order into the same file the serial version writes.
+
+        Row caps are counted in config order, which the workers don't
+        follow, so they can't be combined with num_workers > 1.
+        '''
+        if num_workers > 1 and self.subset.has_row_caps():
+            raise ValueError('Row caps per country/language require num_workers=1')
+
+        if tag_components:
+            out_filename = os.path.join(out_dir, OPENADDRESSES_FORMAT_DATA_TAGGED_FILENAME)
+        else:
+            out_filename = os.path.join(out_dir, OPENADDRESSES_FORMAT_DATA_FILENAME)
+
+        sources = self.training_data_sources(base_dir, sources_only=sources_only)
+
+        self.metrics.start('openaddresses')
+
+        if num_workers > 1:
+            self.build_training_data_parallel(sources, out_dir, out_filename, tag_components=tag_components,
+                                              num_workers=num_workers, concatenate=concatenate)
+            self.metrics.finish()
+            self.components.log_profile()
+            return
+
+        writer = self.metrics.timed_writer(training_data_writer(out_filename, self.shard_options, self.dedupe_options))
+
+        i = 0
+        last_country_dir = None
+
+        for source, path, configs in sources:
+            country_dir = source[0]
+            if country_dir != last_country_dir:
+                # Clear country cache for each new country
+                self.country_rtree.clear_cache()
+                last_country_dir = country_dir
+
+            i = self.write_source_training_data(source, path, configs, writer, tag_components=tag_components, i=i)
+
+        writer.close()
+        self.metrics.finish()
+        self.components.log_profile()
+
+    def build_training_data_parallel(self, sources, out_dir, out_filename, tag_components=True,
+                                     num_workers=1, concatenate=True):
+        shard_dir = os.path.join(out_dir, OPENADDRESSES_SHARDS_DIR)
+        ensure_dir(shard_dir)
+
+        def source_size(source_info):
+            source, path, configs = source_info
+            return os.path.getsize(path) if os.path.exists(path) else 0
+
+        largest_first = sorted(sources, key=source_size, reverse=True)
+
+        pool = ForkedWorkerPool(self, num_workers)
+
+        shards = {}
+        total_rows = 0
+        for source, shard_path, num_rows in pool.imap_unordered('build_source_shard', largest_first,
+                                                                 shard_dir=shard_dir, tag_components=tag_components):
+            shards[source] = shard_path
+            total_rows += num_rows
+            print(six.u('finished {}, {} rows ({}/{} sources done)').format(six.u('/').join(source), num_rows, len(shards), len(sources)))
+
+        self.components.merge_profiles(pool.teardown_results)
+
+        print('did {} formatted addresses in {} shards'.format(total_rows, len(shards)))
+
+        if concatenate and (self.shard_options or self.dedupe_options is not None):
+            writer = self.metrics.timed_writer(training_data_writer(out_filename, self.shard_options, self.dedupe_options))
+            for source, path, configs in sources:
+                with open(shards[source]) as shard:
+                    writer.writelines(shard)
+            writer.close()
+        elif concatenate:
+            out = open(out_filename, 'w')
+            for source, path, configs in sources:
+                with open(shards[source]) as shard:
+                    shutil.copyfileobj(shard, out)
+            out.close()
@@ -24,6 +24,10 @@ from geodata.polygons.language_polys import LanguagePolygonIndex
 from geodata.neighborhoods.reverse_geocode import NeighborhoodReverseGeocoder
 from geodata.places.reverse_geocode import PlaceReverseGeocoder
 from geodata.polygons.reverse_geocode import OSMReverseGeocoder, OSMCountryReverseGeocoder
+from geodata.metrics import add_metrics_arguments, metrics_from_args
+from geodata.subset import add_subset_arguments, subset_from_args
+from geodata.text import normalize
+from geodata.training_data_writer import add_shard_arguments, shard_options_from_args, add_dedupe_arguments, dedupe_options_from_args
 
 
 if __name__ == '__main__':
@@ -70,8 +74,43 @@ if __name__ == '__main__':
                         default=os.getcwd(),
                         help='Output directory')
 
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes. Each source file is written to its own shard')
+
+    parser.add_argument('--seed',
+                        default=None,
+                        help='Global random seed. If set, each row is sampled from its own stream derived from the seed, source and row number, so output is the same regardless of --workers')
+
+    parser.add_argument('--no-concatenate',
+                        action='store_true',
+                        default=False,
+                        help='With --workers, leave the per-source shards as is instead of combining them into one file')
+
+    add_shard_arguments(parser)
+    add_dedupe_arguments(parser)
+    add_subset_arguments(parser)
+    add_metrics_arguments(parser)
+
+    parser.add_argument('--profile-expanded',
+                        action='store_true',
+                        default=False,
+                        help='Print cumulative time per AddressComponents.expanded step, overall and by country, after each builder')
+
+    parser.add_argument('--normalize-cache-size',
+                        type=int,
+                        default=0,
+                        help='Memoize string normalization and tokenization in an LRU cache of this many entries per process')
+
     args = parser.parse_args()
 
+    if args.workers > 1 and (args.max_rows_per_country is not None or args.max_rows_per_language is not None):
+        parser.error('--max-rows-per-country/--max-rows-per-language count rows in config order and require --workers=1')
+
+    if args.normalize_cache_size > 0:
+        normalize.enable_cache(args.normalize_cache_size)
+
     country_rtree = OSMCountryReverseGeocoder.load(args.country_rtree_dir)
 
     osm_rtree = None
@@ -88,6 +127,13 @@ if __name__ == '__main__':
 
     if args.openaddresses_dir and args.format:
         components = AddressComponents(osm_rtree, neighborhoods_rtree, places_index)
-
-        oa_formatter = OpenAddressesFormatter(components, country_rtree, debug=args.debug)
-        oa_formatter.build_training_data(args.openaddresses_dir, args.out_dir, tag_components=not args.untagged, sources_only=args.sources or None)
+        if args.profile_expanded:
+            components.enable_profiling()
+
+        oa_formatter = OpenAddressesFormatter(components, country_rtree, debug=args.debug, seed=args.seed,
+                                              shard_options=shard_options_from_args(args),
+                                              dedupe_options=dedupe_options_from_args(args),
+                                              subset=subset_from_args(args),
+                                              metrics=metrics_from_args(args))
+        oa_formatter.build_training_data(args.openaddresses_dir, args.out_dir, tag_components=not args.untagged, sources_only=args.sources or None,
+                                         num_workers=args.workers, concatenate=not args.no_concatenate)
@@ -104,6 +104,10 @@ class OSMAddressComponents(object):
 
             self.config[country_code] = data
 
+        # In other countries a polygon's component doesn't depend on what contains it
+        self.countries_with_containing_overrides = set([c for c, country_config in six.iteritems(self.config)
+                                                        if country_config.get('overrides', {}).get('contained_by')])
+
     def component(self, country, prop, value):
         component = self.global_keys_override.get(prop, {}).get(value, None)
         if component is not None:
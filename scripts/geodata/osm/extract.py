@@ -114,6 +114,20 @@ def osm_type_and_id(element_id):
 
     return id_type, element_id
 
+
+def osm_element_key(element_id):
+    '''
+    Inverse of osm_type_and_id for the "type:id" element ids produced by
+    parse_osm, e.g. "way:123" => WAY_OFFSET + 123
+    '''
+    id_type, element_id = element_id.split(':', 1)
+    element_id = long(element_id)
+    if id_type == WAY:
+        element_id += WAY_OFFSET
+    elif id_type == RELATION:
+        element_id += RELATION_OFFSET
+    return element_id
+
 apposition_regex = re.compile('(.*[^\s])[\s]*\([\s]*(.*[^\s])[\s]*\)$', re.I)
 
 html_parser = HTMLParser.HTMLParser()
@@ -18,7 +18,7 @@ sys.path.append(os.path.realpath(os.path.join(os.pardir, os.pardir)))
 from geodata.address_expansions.gazetteers import *
 from geodata.address_expansions.abbreviations import abbreviate
 from geodata.address_formatting.aliases import Aliases
-from geodata.address_formatting.formatter import AddressFormatter
+from geodata.address_formatting.formatter import AddressFormatter, CACHE_STATS_INTERVAL
 from geodata.addresses.blocks import Block
 from geodata.addresses.config import address_config
 from geodata.addresses.components import AddressComponents
@@ -34,6 +34,7 @@ from geodata.configs.utils import nested_get
 from geodata.countries.country_names import *
 from geodata.language_id.disambiguation import *
 from geodata.language_id.sample import INTERNET_LANGUAGE_DISTRIBUTION
+from geodata.math.sampling import seed_record
 from geodata.i18n.languages import *
 from geodata.intersections.query import Intersection, IntersectionQuery
 from geodata.address_formatting.formatter import AddressFormatter
@@ -42,15 +43,21 @@ from geodata.osm.definitions import osm_definitions
 from geodata.osm.extract import *
 from geodata.osm.intersections import OSMIntersectionReader
 from geodata.places.config import place_config
+from geodata.polygons.join_table import PolygonJoinTableWriter, join_table_source, open_current_join_table
 from geodata.polygons.language_polys import *
 from geodata.polygons.reverse_geocode import *
 from geodata.postal_codes.phrases import PostalCodes
 from geodata.i18n.unicode_paths import DATA_DIR
+from geodata.text import normalize
 from geodata.text.tokenize import tokenize, token_types
 from geodata.text.utils import is_numeric
 
 from geodata.csv_utils import *
 from geodata.file_utils import *
+from geodata.metrics import NULL_METRICS, index_cache_stats
+from geodata.subset import ALL_RECORDS
+from geodata.training_data_writer import training_data_writer
+from geodata.workers import ForkedWorkerPool, DEFAULT_CHUNK_SIZE, batch_iter
 
 
 OSM_PARSER_DATA_DEFAULT_CONFIG = os.path.join(this_dir, os.pardir, os.pardir, os.pardir,
@@ -66,6 +73,14 @@ INTERSECTIONS_TAGGED_FILENAME = 'intersections_tagged.tsv'
 WAYS_TAGGED_FILENAME = 'formatted_ways_tagged.tsv'
 WAYS_FILENAME = 'formatted_ways.tsv'
 
+JOIN_TABLE_SUFFIX = '.join'
+
+# Order of the id lists in reverse geocode join tables, see join_indexes
+JOIN_OSM_ADMIN = 0
+JOIN_NEIGHBORHOODS = 1
+JOIN_SUBDIVISIONS = 2
+JOIN_BUILDINGS = 3
+
 ALL_LANGUAGES = 'all'
 
 JAPANESE = 'ja'
@@ -155,9 +170,27 @@ class OSMAddressFormatter(object):
 
     boundary_component_priorities = {k: i for i, k in enumerate(AddressFormatter.BOUNDARY_COMPONENTS_ORDERED)}
 
-    def __init__(self, components, country_rtree, subdivisions_rtree=None, buildings_rtree=None, metro_stations_index=None):
+    def __init__(self, components, country_rtree, subdivisions_rtree=None, buildings_rtree=None, metro_stations_index=None, seed=None,
+                 join_dir=None, shard_options=None, dedupe_options=None, subset=None,
+                 metrics=None):
         # Instance of AddressComponents, contains structures for reverse geocoding, etc.
         self.components = components
+
+        # If set, builders write compressed shards, see training_data_writer
+        self.shard_options = shard_options
+        # If set, duplicate rows are dropped, see DedupingWriter
+        self.dedupe_options = dedupe_options
+
+        # Records to process, see geodata.subset
+        self.subset = subset or ALL_RECORDS
+
+        # If set, builders look up precomputed polygon ids for each node
+        # from the join table for their input file (see build_join_table)
+        self.join_dir = join_dir
+        self.join_table = None
+
+        # If set, random sampling is reseeded per record (see seed_record)
+        self.seed = seed
         self.country_rtree = country_rtree
 
         self.subdivisions_rtree = subdivisions_rtree
@@ -168,6 +201,165 @@ class OSMAddressFormatter(object):
         self.config = yaml.load(open(OSM_PARSER_DATA_DEFAULT_CONFIG))
         self.formatter = AddressFormatter()
 
+        # Throughput and stage timings, see geodata.metrics. May be shared
+        # with other formatters, like components, so it's only attached to
+        # components and the cache sources when a build starts
+        self.metrics = metrics or NULL_METRICS
+        self.formatter.metrics = self.metrics
+
+    def start_metrics(self, builder):
+        '''
+        Resets the metrics for a new build and points them at this
+        formatter. Stages run one at a time per process, so only the
+        running build records into the (possibly shared) components.
+        '''
+        self.components.metrics = self.metrics
+        self.metrics.start(builder)
+        self.metrics.add_cache_source('formatter', self.formatter.cache_stats)
+        self.metrics.add_cache_source('components', self.components.cache_stats)
+        self.metrics.add_cache_source('polygons', self.polygon_cache_stats)
+        self.metrics.add_cache_source('text', normalize.cache_stats)
+
+    def worker_finished(self):
+        # Sent back to the parent, which merges the workers' step profiles
+        return self.components.profiler
+
+    def indexes(self):
+        return [index for index in (self.country_rtree, self.subdivisions_rtree, self.buildings_rtree,
+                                    self.metro_stations_index, self.components.osm_admin_rtree,
+                                    self.components.neighborhoods_rtree, self.components.places_index)
+                if index is not None]
+
+    def reopen_indexes(self):
+        for index in self.indexes():
+            if hasattr(index, 'reopen_index'):
+                index.reopen_index()
+
+    def polygon_cache_stats(self):
+        return index_cache_stats({
+            'country': self.country_rtree,
+            'osm_admin': self.components.osm_admin_rtree,
+            'neighborhoods': self.components.neighborhoods_rtree,
+            'subdivisions': self.subdivisions_rtree,
+            'buildings': self.buildings_rtree,
+        })
+
+    def country_for_point(self, latitude, longitude):
+        country, candidate_languages = self.country_rtree.country_and_languages(latitude, longitude)
+        return country
+
+    def skip_node(self, source, node_id, latitude, longitude):
+        '''
+        True if node_id is outside the subset being built. Uses only the
+        country index, so it's cheap compared to formatting the node.
+        '''
+        if self.subset.includes_everything:
+            return False
+        try:
+            latitude, longitude = latlon_to_decimal(latitude, longitude)
+        except Exception:
+            latitude = longitude = None
+        return self.subset.skip(source, node_id, latitude, longitude, country_func=self.country_for_point)
+
+    def join_indexes(self):
+        return [self.components.osm_admin_rtree, self.components.neighborhoods_rtree,
+                self.subdivisions_rtree, self.buildings_rtree]
+
+    def join_table_filename(self, infile):
+        return os.path.join(self.join_dir, os.path.basename(infile) + JOIN_TABLE_SUFFIX)
+
+    def join_table_source(self, infile):
+        return join_table_source(infile, self.join_indexes())
+
+    def has_current_join_table(self, infile):
+        '''True if infile's join table exists and was built from this infile and these indexes'''
+        table = open_current_join_table(self.join_table_filename(infile), self.join_table_source(infile))
+        if table is None:
+            return False
+        table.close()
+        return True
+
+    def load_join_table(self, infile):
+        self.join_table = None
+        if self.join_dir:
+            filename = self.join_table_filename(infile)
+            self.join_table = open_current_join_table(filename, self.join_table_source(infile))
+            if self.join_table is None:
+                print('No current join table at {}, reverse geocoding each node'.format(filename))
+
+    def joined_ids(self, node_id):
+        if self.join_table is None or node_id is None:
+            return None
+        return self.join_table.get(osm_element_key(node_id))
+
+    def reverse_geocoded(self, joined, index_num, latitude, longitude):
+        '''
+        Properties of the polygons containing the point in one of the
+        join indexes, from the precomputed ids if there are any
+        '''
+        index = self.join_indexes()[index_num]
+        with self.metrics.timer('reverse_geocode'):
+            if joined is not None:
+                return index.properties_for_ids(joined[index_num])
+            return index.point_in_poly(latitude, longitude, return_all=True)
+
+    def reverse_geocoded_ids(self, points):
+        '''
+        Batch of (node_id, latitude, longitude) => list of (key, id_lists)
+        for the join table, in the same order.
+        '''
+        indexes = self.join_indexes()
+        # Visit the points in spatial order so consecutive lookups
+        # hit the same candidate polygons in the index caches
+        order = sorted(xrange(len(points)), key=lambda i: (round(points[i][1], 1), round(points[i][2], 1)))
+
+        results = [None] * len(points)
+        for i in order:
+            node_id, latitude, longitude = points[i]
+            id_lists = [index.point_in_poly_ids(latitude, longitude) if index is not None else []
+                        for index in indexes]
+            results[i] = (osm_element_key(node_id), id_lists)
+        return results
+
+    def join_points(self, infile):
+        for node_id, tags, deps in parse_osm(infile):
+            try:
+                latitude, longitude = latlon_to_decimal(tags['lat'], tags['lon'])
+            except Exception:
+                continue
+            yield node_id, latitude, longitude
+
+    def build_join_table(self, infile, num_workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+        '''
+        Reverse geocodes every node in infile against the join indexes once
+        and saves the containing polygon ids to the join table for infile,
+        which the formatted address, limited and place builders then use
+        instead of querying the indexes again.
+        '''
+        ensure_dir(self.join_dir)
+        filename = self.join_table_filename(infile)
+        writer = PolygonJoinTableWriter(filename, len(self.join_indexes()), source=self.join_table_source(infile))
+
+        batches = batch_iter(self.join_points(infile), chunk_size)
+
+        if num_workers > 1:
+            pool = ForkedWorkerPool(self, num_workers)
+            results = pool.imap('reverse_geocoded_ids', batches, chunk_size=1)
+        else:
+            results = (self.reverse_geocoded_ids(batch) for batch in batches)
+
+        i = 0
+        try:
+            for batch in results:
+                for key, id_lists in batch:
+                    writer.add(key, id_lists)
+                i += len(batch)
+                print('joined {} nodes'.format(i))
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+
     def namespaced_language(self, tags, candidate_languages):
         language = None
 
@@ -537,12 +729,15 @@ class OSMAddressFormatter(object):
                                                               tag_components=tag_components, minimal_only=minimal_only)
             formatted_addresses.append(formatted_address)
 
+        components_list = []
         for venue_name in venue_names:
             if venue_name:
                 address_components[AddressFormatter.HOUSE] = venue_name
-            formatted_address = self.formatter.format_address(address_components, country, language=language,
-                                                              tag_components=tag_components, minimal_only=minimal_only)
-            formatted_addresses.append(formatted_address)
+            components_list.append(dict(address_components))
+
+        n = len(components_list)
+        formatted_addresses.extend(self.formatter.format_addresses(components_list, [country] * n, [language] * n,
+                                                                   tag_components=tag_components, minimal_only=minimal_only))
         return formatted_addresses
 
     def formatted_places(self, address_components, country, language, tag_components=True):
@@ -672,7 +867,7 @@ class OSMAddressFormatter(object):
 
         return revised_address_components
 
-    def node_place_tags(self, tags, city_or_below=False):
+    def node_place_tags(self, tags, city_or_below=False, node_id=None):
         try:
             latitude, longitude = latlon_to_decimal(tags['lat'], tags['lon'])
         except Exception:
@@ -681,7 +876,8 @@ class OSMAddressFormatter(object):
         if 'name' not in tags:
             return (), None
 
-        osm_components = self.components.osm_reverse_geocoded_components(latitude, longitude)
+        joined = self.joined_ids(node_id)
+        osm_components = self.reverse_geocoded(joined, JOIN_OSM_ADMIN, latitude, longitude)
 
         country, candidate_languages = OSMCountryReverseGeocoder.country_and_languages_from_components(osm_components)
         if not (country and candidate_languages):
@@ -1000,7 +1196,7 @@ class OSMAddressFormatter(object):
 
             for t, c, l, vals in phrases:
                 for d in vals:
-                    lang, dictionary, is_canonical, canonical = safe_decode(d).split(six.u('|'))
+                    lang, dictionary, is_canonical, canonical = d
                     name = canonical
                     if random.random() < sample_probability:
                         names = address_config.sample_phrases.get((language, dictionary), {}).get(canonical, [])
@@ -1021,7 +1217,7 @@ class OSMAddressFormatter(object):
                             formatted_addresses.append(formatted_address)
         return formatted_addresses
 
-    def formatted_addresses(self, tags, tag_components=True):
+    def formatted_addresses(self, tags, tag_components=True, node_id=None):
         '''
         Formatted addresses
         -------------------
@@ -1040,6 +1236,9 @@ class OSMAddressFormatter(object):
         If there is more than one venue name (say name and alt_name),
         addresses using both names and the selected components are
         returned.
+
+        If the builder loaded a join table, node_id is used to look up
+        the precomputed containing polygons.
         '''
 
         try:
@@ -1047,7 +1246,8 @@ class OSMAddressFormatter(object):
         except Exception:
             return None, None, None
 
-        osm_components = self.components.osm_reverse_geocoded_components(latitude, longitude)
+        joined = self.joined_ids(node_id)
+        osm_components = self.reverse_geocoded(joined, JOIN_OSM_ADMIN, latitude, longitude)
 
         country, candidate_languages = self.components.osm_country_and_languages(osm_components)
         if not (country and candidate_languages):
@@ -1108,7 +1308,7 @@ class OSMAddressFormatter(object):
 
         building_venue_names = []
 
-        building_components = self.building_components(latitude, longitude)
+        building_components = self.reverse_geocoded(joined, JOIN_BUILDINGS, latitude, longitude)
 
         building_is_generic_place = False
         building_is_known_venue_type = False
@@ -1135,7 +1335,7 @@ class OSMAddressFormatter(object):
                     elif k == AddressFormatter.HOUSE:
                         building_venue_names.append((v, building_is_generic_place, building_is_known_venue_type))
 
-        subdivision_components = self.subdivision_components(latitude, longitude)
+        subdivision_components = self.reverse_geocoded(joined, JOIN_SUBDIVISIONS, latitude, longitude)
         if subdivision_components:
             zone = self.zone(subdivision_components)
 
@@ -1144,10 +1344,12 @@ class OSMAddressFormatter(object):
 
         revised_tags = self.fix_component_encodings(revised_tags)
 
-        address_components, country, language = self.components.expanded(revised_tags, latitude, longitude, language=language or namespaced_language,
-                                                                         num_floors=num_floors, num_basements=num_basements,
-                                                                         zone=zone, add_sub_building_components=add_sub_building_components,
-                                                                         population_from_city=True, check_city_wikipedia=True, osm_components=osm_components)
+        with self.metrics.timer('expansion'):
+            address_components, country, language = self.components.expanded(revised_tags, latitude, longitude, language=language or namespaced_language,
+                                                                             num_floors=num_floors, num_basements=num_basements,
+                                                                             zone=zone, add_sub_building_components=add_sub_building_components,
+                                                                             population_from_city=True, check_city_wikipedia=True, osm_components=osm_components,
+                                                                             neighborhoods=self.reverse_geocoded(joined, JOIN_NEIGHBORHOODS, latitude, longitude))
 
         languages = list(country_languages[country])
         venue_names = self.venue_names(tags, languages) or []
@@ -1265,7 +1467,7 @@ class OSMAddressFormatter(object):
 
         return OrderedDict.fromkeys(formatted_addresses).keys(), country, language
 
-    def formatted_address_limited(self, tags):
+    def formatted_address_limited(self, tags, node_id=None):
         try:
             latitude, longitude = latlon_to_decimal(tags['lat'], tags['lon'])
         except Exception:
@@ -1281,7 +1483,15 @@ class OSMAddressFormatter(object):
 
         admin_dropout_prob = float(nested_get(self.config, ('limited', 'admin_dropout_prob'), default=0.0))
 
-        address_components, country, language = self.components.limited(revised_tags, latitude, longitude, language=namespaced_language)
+        joined = self.joined_ids(node_id)
+        osm_components = neighborhoods = None
+        if joined is not None:
+            osm_components = self.reverse_geocoded(joined, JOIN_OSM_ADMIN, latitude, longitude)
+            neighborhoods = self.reverse_geocoded(joined, JOIN_NEIGHBORHOODS, latitude, longitude)
+
+        with self.metrics.timer('expansion'):
+            address_components, country, language = self.components.limited(revised_tags, latitude, longitude, language=namespaced_language,
+                                                                            osm_components=osm_components, neighborhoods=neighborhoods)
 
         if not address_components:
             return None, None, None
@@ -1304,7 +1514,37 @@ class OSMAddressFormatter(object):
 
         return formatted_address, country, language
 
-    def build_training_data(self, infile, out_dir, tag_components=True):
+    def training_data_rows(self, node, tag_components=True):
+        '''
+        (country, language, rows) of formatted address training data for
+        one (node_id, tags) pair, or None if no addresses could be formatted.
+        '''
+        node_id, tags = node
+        self.metrics.record()
+        seed_record(self.seed, 'osm_addresses', node_id)
+        if self.skip_node('osm_addresses', node_id, tags.get('lat'), tags.get('lon')):
+            return None
+
+        formatted_addresses, country, language = self.formatted_addresses(tags, tag_components=tag_components, node_id=node_id)
+        if not formatted_addresses:
+            return None
+
+        rows = []
+        for formatted_address in formatted_addresses:
+            if formatted_address and formatted_address.strip():
+                formatted_address = tsv_string(formatted_address)
+                if not formatted_address or not formatted_address.strip():
+                    continue
+
+                if tag_components:
+                    row = (language, country, formatted_address)
+                else:
+                    row = (formatted_address,)
+
+                rows.append(row)
+        return country, language, rows
+
+    def build_training_data(self, infile, out_dir, tag_components=True, num_workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
         '''
         Creates formatted address training data for supervised sequence labeling (or potentially 
         for unsupervised learning e.g. for word vectors) using addr:* tags in OSM.
@@ -1332,51 +1572,71 @@ class OSMAddressFormatter(object):
 
         This may be useful in learning word representations, statistical phrases, morphology
         or other models requiring only the sequence of words.
+
+        With num_workers > 1, nodes are parsed here and formatted in chunks by
+        forked worker processes which share this formatter's indexes. Rows
+        are written in input order.
         '''
         i = 0
 
         if tag_components:
-            formatted_tagged_file = open(os.path.join(out_dir, FORMATTED_ADDRESS_DATA_TAGGED_FILENAME), 'w')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
+            filename = FORMATTED_ADDRESS_DATA_TAGGED_FILENAME
         else:
-            formatted_file = open(os.path.join(out_dir, FORMATTED_ADDRESS_DATA_FILENAME), 'w')
-            writer = csv.writer(formatted_file, 'tsv_no_quote')
+            filename = FORMATTED_ADDRESS_DATA_FILENAME
+        self.start_metrics('osm_addresses')
+        self.subset.start()
+        writer = self.metrics.timed_writer(training_data_writer(os.path.join(out_dir, filename), self.shard_options, self.dedupe_options))
 
-        for node_id, value, deps in parse_osm(infile):
-            formatted_addresses, country, language = self.formatted_addresses(value, tag_components=tag_components)
-            if not formatted_addresses:
-                continue
+        self.load_join_table(infile)
+        nodes = ((node_id, value) for node_id, value, deps in parse_osm(infile))
 
-            for formatted_address in formatted_addresses:
-                if formatted_address and formatted_address.strip():
-                    formatted_address = tsv_string(formatted_address)
-                    if not formatted_address or not formatted_address.strip():
-                        continue
+        if num_workers > 1:
+            pool = ForkedWorkerPool(self, num_workers)
+            all_rows = pool.imap('training_data_rows', nodes, chunk_size=chunk_size, tag_components=tag_components)
+        else:
+            all_rows = (self.training_data_rows(node, tag_components=tag_components) for node in nodes)
 
-                    if tag_components:
-                        row = (language, country, formatted_address)
-                    else:
-                        row = (formatted_address,)
+        for result in all_rows:
+            if result is None:
+                continue
 
-                    writer.writerow(row)
+            country, language, rows = result
+            # Row caps are counted here rather than in the workers, which
+            # only see the countries that are full (see skip_node)
+            writer.writerows([row for row in rows if self.subset.accept_row(country, language)])
 
             i += 1
             if i % 1000 == 0 and i > 0:
                 print('did {} formatted addresses'.format(i))
+                if i % CACHE_STATS_INTERVAL == 0:
+                    self.formatter.log_cache_stats()
+
+        writer.close()
+        self.metrics.finish()
+        if num_workers > 1:
+            self.components.merge_profiles(pool.teardown_results)
+        self.components.log_profile()
 
     def build_place_training_data(self, infile, out_dir, tag_components=True):
         i = 0
 
         if tag_components:
-            formatted_tagged_file = open(os.path.join(out_dir, FORMATTED_PLACE_DATA_TAGGED_FILENAME), 'w')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
+            filename = FORMATTED_PLACE_DATA_TAGGED_FILENAME
         else:
-            formatted_tagged_file = open(os.path.join(out_dir, FORMATTED_PLACE_DATA_FILENAME), 'w')
-            writer = csv.writer(formatted_file, 'tsv_no_quote')
+            filename = FORMATTED_PLACE_DATA_FILENAME
+        self.start_metrics('osm_places')
+        self.subset.start()
+        writer = self.metrics.timed_writer(training_data_writer(os.path.join(out_dir, filename), self.shard_options, self.dedupe_options))
+
+        self.load_join_table(infile)
 
         for node_id, tags, deps in parse_osm(infile):
+            self.metrics.record()
+            seed_record(self.seed, 'osm_places', node_id)
+            if self.skip_node('osm_places', node_id, tags.get('lat'), tags.get('lon')):
+                continue
             tags['type'], tags['id'] = node_id.split(':')
-            place_tags, country = self.node_place_tags(tags)
+            place_tags, country = self.node_place_tags(tags, node_id=node_id)
 
             for address_components, language, is_default in place_tags:
                 addresses = self.formatted_places(address_components, country, language)
@@ -1394,13 +1654,18 @@ class OSMAddressFormatter(object):
                     else:
                         row = (address, )
 
-                    writer.writerow(row)
+                    if self.subset.accept_row(country, language):
+                        writer.writerow(row)
 
             i += 1
             if i % 1000 == 0 and i > 0:
                 print('did {} formatted places'.format(i))
+                if i % CACHE_STATS_INTERVAL == 0:
+                    self.formatter.log_cache_stats()
 
-        for tags, poly in iter(self.components.osm_admin_rtree):
+        for admin_index, (tags, poly) in enumerate(self.components.osm_admin_rtree):
+            self.metrics.record()
+            seed_record(self.seed, 'osm_admin_places', tags.get('id', admin_index))
             point = None
             if 'admin_center' in tags and 'lat' in tags['admin_center'] and 'lon' in tags['admin_center']:
                 admin_center = tags['admin_center']
@@ -1425,6 +1690,8 @@ class OSMAddressFormatter(object):
                 lon = point.x
             except Exception:
                 continue
+            if self.skip_node('osm_admin_places', tags.get('id', admin_index), lat, lon):
+                continue
             tags['lat'] = lat
             tags['lon'] = lon
             place_tags, country = self.node_place_tags(tags, city_or_below=True)
@@ -1444,11 +1711,18 @@ class OSMAddressFormatter(object):
                     else:
                         row = (address, )
 
-                    writer.writerow(row)
+                    if self.subset.accept_row(country, language):
+                        writer.writerow(row)
 
             i += 1
             if i % 1000 == 0 and i > 0:
                 print('did {} formatted places'.format(i))
+                if i % CACHE_STATS_INTERVAL == 0:
+                    self.formatter.log_cache_stats()
+
+        writer.close()
+        self.metrics.finish()
+        self.components.log_profile()
 
     def way_names(self, way, candidate_languages, base_name_tag='name', all_name_tags=frozenset(OSM_NAME_TAGS), all_base_name_tags=frozenset(OSM_BASE_NAME_TAGS)):
         names = defaultdict(list)
@@ -1512,16 +1786,19 @@ class OSMAddressFormatter(object):
         i = 0
 
         if tag_components:
-            formatted_tagged_file = open(os.path.join(out_dir, INTERSECTIONS_TAGGED_FILENAME), 'w')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
+            filename = INTERSECTIONS_TAGGED_FILENAME
         else:
-            formatted_file = open(os.path.join(out_dir, INTERSECTIONS_FILENAME), 'w')
-            writer = csv.writer(formatted_file, 'tsv_no_quote')
+            filename = INTERSECTIONS_FILENAME
+        self.start_metrics('osm_intersections')
+        self.subset.start()
+        writer = self.metrics.timed_writer(training_data_writer(os.path.join(out_dir, filename), self.shard_options, self.dedupe_options))
 
         all_name_tags = set(OSM_NAME_TAGS)
         all_base_name_tags = set(OSM_BASE_NAME_TAGS)
 
         for node_id, node_props, ways in OSMIntersectionReader.read_intersections(infile):
+            self.metrics.record()
+            seed_record(self.seed, 'osm_intersections', node_id)
             distinct_ways = set()
             valid_ways = []
             for way in ways:
@@ -1545,6 +1822,9 @@ class OSMAddressFormatter(object):
             if not (country and candidate_languages):
                 continue
 
+            if self.subset.skip('osm_intersections', node_id, latitude, longitude, country=country):
+                continue
+
             base_name_tag = None
             for t in all_base_name_tags:
                 if any((t in way for way in ways)):
@@ -1567,11 +1847,14 @@ class OSMAddressFormatter(object):
             if not way_names or len(way_names) < 2:
                 continue
 
-            language_components = {}
+            namespaced_languages = list(namespaced_languages)
 
-            for namespaced_language in namespaced_languages:
-                address_components, _, _ = self.components.expanded({}, latitude, longitude, language=namespaced_language or default_language)
-                language_components[namespaced_language] = address_components
+            # Same point in each language, so it's only reverse geocoded once
+            with self.metrics.timer('expansion'):
+                expanded = self.components.expanded_batch([({}, latitude, longitude, {'language': namespaced_language or default_language})
+                                                           for namespaced_language in namespaced_languages])
+            language_components = {namespaced_language: address_components
+                                   for namespaced_language, (address_components, _, _) in zip(namespaced_languages, expanded)}
 
             for way1, way2 in itertools.combinations(way_names, 2):
                 intersection_phrases = []
@@ -1608,11 +1891,18 @@ class OSMAddressFormatter(object):
                         else:
                             row = (formatted,)
 
-                        writer.writerow(row)
+                        if self.subset.accept_row(country, language):
+                            writer.writerow(row)
 
             i += 1
             if i % 1000 == 0 and i > 0:
                 print('did {} intersections'.format(i))
+                if i % CACHE_STATS_INTERVAL == 0:
+                    self.formatter.log_cache_stats()
+
+        writer.close()
+        self.metrics.finish()
+        self.components.log_profile()
 
     def build_ways_training_data(self, infile, out_dir, tag_components=True):
         '''
@@ -1625,16 +1915,19 @@ class OSMAddressFormatter(object):
         i = 0
 
         if tag_components:
-            formatted_tagged_file = open(os.path.join(out_dir, WAYS_TAGGED_FILENAME), 'w')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
+            filename = WAYS_TAGGED_FILENAME
         else:
-            formatted_file = open(os.path.join(out_dir, WAYS_FILENAME), 'w')
-            writer = csv.writer(formatted_file, 'tsv_no_quote')
+            filename = WAYS_FILENAME
+        self.start_metrics('osm_ways')
+        self.subset.start()
+        writer = self.metrics.timed_writer(training_data_writer(os.path.join(out_dir, filename), self.shard_options, self.dedupe_options))
 
         all_name_tags = set(OSM_NAME_TAGS)
         all_base_name_tags = set(OSM_BASE_NAME_TAGS)
 
         for key, value, deps in parse_osm(infile, allowed_types=WAYS_RELATIONS):
+            self.metrics.record()
+            seed_record(self.seed, 'osm_ways', key)
             latitude = value['lat']
             longitude = value['lon']
 
@@ -1647,6 +1940,9 @@ class OSMAddressFormatter(object):
             if not (country and candidate_languages):
                 continue
 
+            if self.subset.skip('osm_ways', key, latitude, longitude, country=country):
+                continue
+
             names = self.way_names(value, candidate_languages)
 
             if not names:
@@ -1684,12 +1980,19 @@ class OSMAddressFormatter(object):
 
                     if not formatted or not formatted.strip():
                         continue
-                    writer.writerow((lang, country, tsv_string(formatted)))
+                    if self.subset.accept_row(country, lang):
+                        writer.writerow((lang, country, tsv_string(formatted)))
 
             if i % 1000 == 0 and i > 0:
                 print('did {} ways'.format(i))
+                if i % CACHE_STATS_INTERVAL == 0:
+                    self.formatter.log_cache_stats()
             i += 1
 
+        writer.close()
+        self.metrics.finish()
+        self.components.log_profile()
+
     def build_limited_training_data(self, infile, out_dir):
         '''
         Creates a special kind of formatted address training data from OSM's addr:* tags
@@ -1705,11 +2008,18 @@ class OSMAddressFormatter(object):
         '''
         i = 0
 
-        f = open(os.path.join(out_dir, FORMATTED_ADDRESS_DATA_LANGUAGE_FILENAME), 'w')
-        writer = csv.writer(f, 'tsv_no_quote')
+        self.start_metrics('osm_limited')
+        self.subset.start()
+        writer = self.metrics.timed_writer(training_data_writer(os.path.join(out_dir, FORMATTED_ADDRESS_DATA_LANGUAGE_FILENAME), self.shard_options, self.dedupe_options))
+
+        self.load_join_table(infile)
 
         for node_id, value, deps in parse_osm(infile):
-            formatted_address, country, language = self.formatted_address_limited(value)
+            self.metrics.record()
+            seed_record(self.seed, 'osm_limited', node_id)
+            if self.skip_node('osm_limited', node_id, value.get('lat'), value.get('lon')):
+                continue
+            formatted_address, country, language = self.formatted_address_limited(value, node_id=node_id)
             if not formatted_address:
                 continue
 
@@ -1719,8 +2029,15 @@ class OSMAddressFormatter(object):
                     continue
 
                 row = (language, country, formatted_address)
-                writer.writerow(row)
+                if self.subset.accept_row(country, language):
+                    writer.writerow(row)
 
             i += 1
             if i % 1000 == 0 and i > 0:
                 print('did {} formatted addresses'.format(i))
+                if i % CACHE_STATS_INTERVAL == 0:
+                    self.formatter.log_cache_stats()
+
+        writer.close()
+        self.metrics.finish()
+        self.components.log_profile()
@@ -16,6 +16,7 @@ sys.path.append(os.path.realpath(os.path.join(os.pardir, os.pardir)))
 
 from geodata.coordinates.conversion import latlon_to_decimal
 from geodata.file_utils import ensure_dir
+from geodata.leveldb_utils import LevelDBWriteBuffer, DEFAULT_WRITE_BATCH_SIZE
 from geodata.osm.extract import *
 from geodata.encoding import safe_decode, safe_encode
 
@@ -23,7 +24,7 @@ DEFAULT_INTERSECTIONS_FILENAME = 'intersections.json'
 
 
 class OSMIntersectionReader(object):
-    def __init__(self, filename, db_dir):
+    def __init__(self, filename, db_dir, write_batch_size=DEFAULT_WRITE_BATCH_SIZE):
         self.filename = filename
 
         self.node_ids = array.array('l')
@@ -36,8 +37,8 @@ class OSMIntersectionReader(object):
         ensure_dir(ways_dir)
         nodes_dir = os.path.join(db_dir, 'nodes')
         ensure_dir(nodes_dir)
-        self.way_props = LevelDB(ways_dir)
-        self.node_props = LevelDB(nodes_dir)
+        self.way_props = LevelDBWriteBuffer(LevelDB(ways_dir), batch_size=write_batch_size)
+        self.node_props = LevelDBWriteBuffer(LevelDB(nodes_dir), batch_size=write_batch_size)
 
         # These form a graph and should always have the same length
         self.intersection_edges_nodes = array.array('l')
@@ -86,6 +87,8 @@ class OSMIntersectionReader(object):
                 self.logger.info('doing {}s, at {}'.format(element_id.split(':')[0], i))
             i += 1
 
+        self.node_props.flush()
+
         for i, count in enumerate(node_counts):
             if count > 1:
                 self.node_ids.append(node_ids[i])
@@ -103,17 +106,24 @@ class OSMIntersectionReader(object):
                 props = {safe_decode(k): safe_decode(v) for k, v in six.iteritems(props)}
                 way_id = long(element_id.split(':')[-1])
                 props['id'] = way_id
+                is_intersection_way = False
                 for node_id in deps:
                     node_index = self.binary_search(self.node_ids, node_id)
                     if node_index is not None:
                         self.intersection_edges_nodes.append(node_id)
                         self.intersection_edges_ways.append(way_id)
-                        self.way_props.Put(safe_encode(way_id), json.dumps(props))
+                        is_intersection_way = True
+
+                # Only need to store the way once, not once per intersecting node
+                if is_intersection_way:
+                    self.way_props.Put(safe_encode(way_id), json.dumps(props))
 
             if i % 1000 == 0 and i > 0:
                 self.logger.info('second pass, doing {}s, at {}'.format(element_id.split(':')[0], i))
             i += 1
 
+        self.way_props.flush()
+
         i = 0
 
         indices = numpy.argsort(self.intersection_edges_nodes)
@@ -176,6 +186,11 @@ if __name__ == '__main__':
                         required=True,
                         help='Path to temporary db')
 
+    parser.add_argument('--write-batch-size',
+                        type=int,
+                        default=DEFAULT_WRITE_BATCH_SIZE,
+                        help='Number of unique keys to buffer per LevelDB write batch')
+
     parser.add_argument('-o', '--out-dir',
                         default=os.getcwd(),
                         required=True,
@@ -185,5 +200,5 @@ if __name__ == '__main__':
 
     logging.basicConfig(level=logging.INFO)
 
-    reader = OSMIntersectionReader(args.input, args.db_dir)
+    reader = OSMIntersectionReader(args.input, args.db_dir, write_batch_size=args.write_batch_size)
     reader.create_intersections(os.path.join(args.out_dir, DEFAULT_INTERSECTIONS_FILENAME))
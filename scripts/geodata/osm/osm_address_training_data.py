@@ -23,6 +23,9 @@ python osm_address_training_data.py -a -l $(OSM_DIR)/planet-addresses.osm --coun
 Formatted addresses (tagged):
 python osm_address_training_data.py -a $(OSM_DIR)/planet-addresses.osm -f --country-rtree-dir=$(COUNTRY_RTREE_DIR) --neighborhoods-rtree-dir=$(NEIGHBORHOODS_RTREE_DIR) --rtree-dir=$(RTREE_DIR) -o $(OUT_DIR)
 
+Formatted addresses (tagged, in parallel using 8 worker processes):
+python osm_address_training_data.py -a $(OSM_DIR)/planet-addresses.osm -f --workers=8 --country-rtree-dir=$(COUNTRY_RTREE_DIR) --neighborhoods-rtree-dir=$(NEIGHBORHOODS_RTREE_DIR) --rtree-dir=$(RTREE_DIR) -o $(OUT_DIR)
+
 Formatted addresses (untagged):
 python osm_address_training_data.py -a $(OSM_DIR)/planet-addresses.osm  -f -u --country-rtree-dir=$(COUNTRY_RTREE_DIR) --neighborhoods-rtree-dir=$(NEIGHBORHOODS_RTREE_DIR)  --rtree-dir=$(RTREE_DIR) -o $(OUT_DIR)
 
@@ -31,6 +34,13 @@ python osm_address_training_data -x $(OSM_DIR)/intersections.json -f --country-r
 
 Toponyms:
 python osm_address_training_data.py -b $(OSM_DIR)/planet-borders.osm --country-rtree-dir=$(COUNTRY_RTREE_DIR) -o $(OUT_DIR)
+
+Alternatively, several training sets can be built by one command, which loads
+the indexes once and runs up to --parallel-stages builders at a time in forked
+processes sharing those indexes. At most --max-heavy-stages of the formatted
+address builders, which grow large polygon and template caches, run at once:
+
+python osm_address_training_data.py -s $(OSM_DIR)/planet-ways.osm -v $(OSM_DIR)/planet-venues.osm -b $(OSM_DIR)/planet-borders.osm -a $(OSM_DIR)/planet-addresses.osm -f -l --parallel-stages=4 --max-heavy-stages=2 --country-rtree-dir=$(COUNTRY_RTREE_DIR) --neighborhoods-rtree-dir=$(NEIGHBORHOODS_RTREE_DIR) --rtree-dir=$(RTREE_DIR) --places-index-dir=$(PLACES_INDEX_DIR) -o $(OUT_DIR)
 '''
 
 import argparse
@@ -62,6 +72,7 @@ from geodata.addresses.components import AddressComponents
 from geodata.coordinates.conversion import *
 from geodata.language_id.disambiguation import *
 from geodata.language_id.sample import sample_random_language
+from geodata.math.sampling import seed_record
 from geodata.i18n.languages import *
 from geodata.metro_stations.reverse_geocode import MetroStationReverseGeocoder
 from geodata.neighborhoods.reverse_geocode import NeighborhoodReverseGeocoder
@@ -71,6 +82,11 @@ from geodata.places.reverse_geocode import PlaceReverseGeocoder
 from geodata.polygons.language_polys import *
 from geodata.polygons.reverse_geocode import *
 from geodata.i18n.unicode_paths import DATA_DIR
+from geodata.metrics import add_metrics_arguments, metrics_from_args
+from geodata.subset import add_subset_arguments, subset_from_args
+from geodata.text import normalize
+from geodata.training_data_writer import add_shard_arguments, shard_options_from_args, add_dedupe_arguments, dedupe_options_from_args
+from geodata.workers import DEFAULT_CHUNK_SIZE, StageScheduler
 
 from geodata.csv_utils import *
 from geodata.file_utils import *
@@ -182,7 +198,7 @@ def get_language_names(country_rtree, key, value, tag_prefix='name'):
     return country, name_language
 
 
-def build_ways_training_data(country_rtree, infile, out_dir, abbreviate_streets=True):
+def build_ways_training_data(country_rtree, infile, out_dir, abbreviate_streets=True, seed=None):
     '''
     Creates a training set for language classification using most OSM ways
     (streets) under a fairly lengthy osmfilter definition which attempts to
@@ -198,6 +214,7 @@ def build_ways_training_data(country_rtree, infile, out_dir, abbreviate_streets=
     writer = csv.writer(f, 'tsv_no_quote')
 
     for key, value, deps in parse_osm(infile, allowed_types=WAYS_RELATIONS):
+        seed_record(seed, 'osm_ways_by_language', key)
         country, name_language = get_language_names(country_rtree, key, value, tag_prefix='name')
         if not name_language:
             continue
@@ -494,8 +511,54 @@ if __name__ == '__main__':
                         default=os.getcwd(),
                         help='Output directory')
 
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes for formatted addresses. Indexes are loaded once and shared with the workers')
+
+    parser.add_argument('--seed',
+                        default=None,
+                        help='Global random seed. If set, each record is sampled from its own stream derived from the seed and record id, so output is the same regardless of --workers')
+
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        default=DEFAULT_CHUNK_SIZE,
+                        help='Number of nodes sent to a worker at a time')
+
+    parser.add_argument('--join-dir',
+                        default=None,
+                        help='Directory for reverse geocode join tables. If set, address and place nodes are reverse geocoded once into a table per input file, which the formatted address builders share')
+
+    parser.add_argument('--parallel-stages',
+                        type=int,
+                        default=1,
+                        help='Number of training sets to build concurrently, each in its own process')
+
+    parser.add_argument('--max-heavy-stages',
+                        type=int,
+                        default=1,
+                        help='Maximum number of formatted address training sets to build concurrently')
+
+    add_shard_arguments(parser)
+    add_dedupe_arguments(parser)
+    add_subset_arguments(parser)
+    add_metrics_arguments(parser)
+
+    parser.add_argument('--profile-expanded',
+                        action='store_true',
+                        default=False,
+                        help='Print cumulative time per AddressComponents.expanded step, overall and by country, after each builder')
+
+    parser.add_argument('--normalize-cache-size',
+                        type=int,
+                        default=0,
+                        help='Memoize string normalization and tokenization in an LRU cache of this many entries per process')
+
     args = parser.parse_args()
 
+    if args.normalize_cache_size > 0:
+        normalize.enable_cache(args.normalize_cache_size)
+
     country_rtree = OSMCountryReverseGeocoder.load(args.country_rtree_dir)
 
     osm_rtree = None
@@ -522,14 +585,6 @@ if __name__ == '__main__':
     if args.buildings_rtree_dir:
         buildings_rtree = OSMBuildingReverseGeocoder.load(args.buildings_rtree_dir)
 
-    # Can parallelize
-    if args.streets_file and not args.format:
-        build_ways_training_data(country_rtree, args.streets_file, args.out_dir, abbreviate_streets=not args.unabbreviated)
-    if args.borders_file:
-        build_toponym_training_data(country_rtree, args.borders_file, args.out_dir)
-    if args.venues_file:
-        build_venue_training_data(country_rtree, args.venues_file, args.out_dir)
-
     if args.address_file or args.intersections_file:
         if osm_rtree is None:
             parser.error('--rtree-dir required for formatted addresses')
@@ -538,26 +593,79 @@ if __name__ == '__main__':
         elif places_index is None:
             parser.error('--places-index-dir required for formatted addresses')
 
-    if args.address_file and args.format:
+    def reopen_indexes():
+        for index in (country_rtree, osm_rtree, neighborhoods_rtree, places_index,
+                      metro_stations_index, subdivisions_rtree, buildings_rtree):
+            if hasattr(index, 'reopen_index'):
+                index.reopen_index()
+
+    scheduler = StageScheduler(max_parallel=args.parallel_stages,
+                               resource_limits={'memory': args.max_heavy_stages},
+                               setup=reopen_indexes)
+
+    # Language training sets, only use the country index
+    if args.streets_file and not args.format:
+        scheduler.add_stage('ways', build_ways_training_data, args=(country_rtree, args.streets_file, args.out_dir),
+                            kwargs=dict(abbreviate_streets=not args.unabbreviated, seed=args.seed))
+    if args.borders_file:
+        scheduler.add_stage('toponyms', build_toponym_training_data, args=(country_rtree, args.borders_file, args.out_dir))
+    if args.venues_file:
+        scheduler.add_stage('venues', build_venue_training_data, args=(country_rtree, args.venues_file, args.out_dir))
+
+    # Formatted address training sets, share one set of components/formatters
+    heavy = {'memory': 1}
+    tag_components = not args.untagged
+
+    formatted_inputs = (args.address_file, args.place_nodes_file, args.intersections_file, args.streets_file)
+    if (args.format and any(formatted_inputs)) or (args.address_file and args.limited_addresses):
         components = AddressComponents(osm_rtree, neighborhoods_rtree, places_index)
-        osm_formatter = OSMAddressFormatter(components, country_rtree, subdivisions_rtree, buildings_rtree, metro_stations_index)
-        osm_formatter.build_training_data(args.address_file, args.out_dir, tag_components=not args.untagged)
+        if args.profile_expanded:
+            components.enable_profiling()
+        # One metrics file, each build reports under its own builder name
+        metrics = metrics_from_args(args)
+        osm_formatter = OSMAddressFormatter(components, country_rtree, subdivisions_rtree, buildings_rtree, metro_stations_index, seed=args.seed,
+                                            join_dir=args.join_dir, shard_options=shard_options_from_args(args),
+                                            dedupe_options=dedupe_options_from_args(args),
+                                            subset=subset_from_args(args),
+                                            metrics=metrics)
+
+    # Reverse geocode the nodes once for all the builders reading the same file
+    address_deps = place_deps = ()
+    if args.join_dir:
+        if args.address_file and (args.format or args.limited_addresses) and not osm_formatter.has_current_join_table(args.address_file):
+            scheduler.add_stage('address_join', osm_formatter.build_join_table, args=(args.address_file,),
+                                kwargs=dict(num_workers=args.workers, chunk_size=args.chunk_size), resources=heavy)
+            address_deps = ('address_join',)
+        if args.place_nodes_file and args.format and not osm_formatter.has_current_join_table(args.place_nodes_file):
+            scheduler.add_stage('place_join', osm_formatter.build_join_table, args=(args.place_nodes_file,),
+                                kwargs=dict(num_workers=args.workers, chunk_size=args.chunk_size), resources=heavy)
+            place_deps = ('place_join',)
+
+    if args.address_file and args.format:
+        scheduler.add_stage('formatted_addresses', osm_formatter.build_training_data, args=(args.address_file, args.out_dir),
+                            kwargs=dict(tag_components=tag_components, num_workers=args.workers, chunk_size=args.chunk_size),
+                            depends_on=address_deps, resources=heavy)
     if args.address_file and args.limited_addresses:
-        components = AddressComponents(osm_rtree, neighborhoods_rtree, places_index)
-        osm_formatter = OSMAddressFormatter(components, country_rtree, subdivisions_rtree, buildings_rtree, metro_stations_index, splitter=u' ')
-        osm_formatter.build_limited_training_data(args.address_file, args.out_dir)
+        limited_formatter = OSMAddressFormatter(components, country_rtree, subdivisions_rtree, buildings_rtree, metro_stations_index, splitter=u' ', seed=args.seed,
+                                                join_dir=args.join_dir, shard_options=shard_options_from_args(args),
+                                                dedupe_options=dedupe_options_from_args(args),
+                                                subset=subset_from_args(args),
+                                                metrics=metrics)
+        scheduler.add_stage('limited_addresses', limited_formatter.build_limited_training_data, args=(args.address_file, args.out_dir),
+                            depends_on=address_deps, resources=heavy)
 
     if args.place_nodes_file and args.format:
-        components = AddressComponents(osm_rtree, neighborhoods_rtree, places_index)
-        osm_formatter = OSMAddressFormatter(components, country_rtree, subdivisions_rtree, buildings_rtree, metro_stations_index)
-        osm_formatter.build_place_training_data(args.place_nodes_file, args.out_dir, tag_components=not args.untagged)
+        scheduler.add_stage('places', osm_formatter.build_place_training_data, args=(args.place_nodes_file, args.out_dir),
+                            kwargs=dict(tag_components=tag_components), depends_on=place_deps, resources=heavy)
 
     if args.intersections_file and args.format:
-        components = AddressComponents(osm_rtree, neighborhoods_rtree, places_index)
-        osm_formatter = OSMAddressFormatter(components, country_rtree, subdivisions_rtree, buildings_rtree, metro_stations_index)
-        osm_formatter.build_intersections_training_data(args.intersections_file, args.out_dir, tag_components=not args.untagged)
+        scheduler.add_stage('intersections', osm_formatter.build_intersections_training_data, args=(args.intersections_file, args.out_dir),
+                            kwargs=dict(tag_components=tag_components), resources=heavy)
 
     if args.streets_file and args.format:
-        components = AddressComponents(osm_rtree, neighborhoods_rtree, places_index)
-        osm_formatter = OSMAddressFormatter(components, country_rtree, subdivisions_rtree, buildings_rtree, metro_stations_index)
-        osm_formatter.build_ways_training_data(args.streets_file, args.out_dir, tag_components=not args.untagged)
+        scheduler.add_stage('formatted_ways', osm_formatter.build_ways_training_data, args=(args.streets_file, args.out_dir),
+                            kwargs=dict(tag_components=tag_components), resources=heavy)
+
+    timings = scheduler.run()
+    for name, seconds in timings.iteritems():
+        print('{}: {:.1f}s'.format(name, seconds))
@@ -11,12 +11,14 @@ from collections import defaultdict, OrderedDict
 from leveldb import LevelDB
 
 from geodata.distance.haversine import haversine_distance
+from geodata.leveldb_utils import LevelDBWriteBuffer, DEFAULT_WRITE_BATCH_SIZE
 
 
 class PointIndex(object):
     include_only_properties = None
     persistent_index = False
     cache_size = 0
+    write_batch_size = DEFAULT_WRITE_BATCH_SIZE
 
     POINTS_DB_DIR = 'points'
 
@@ -64,7 +66,8 @@ class PointIndex(object):
             points_db_path = os.path.join(save_dir or '.', self.POINTS_DB_DIR)
 
         if not points_db:
-            self.points_db = LevelDB(points_db_path)
+            # New index being built, buffer the writes
+            self.points_db = LevelDBWriteBuffer(LevelDB(points_db_path), batch_size=self.write_batch_size)
         else:
             self.points_db = points_db
 
@@ -121,7 +124,12 @@ class PointIndex(object):
     def get_properties(self, i):
         return json.loads(self.points_db.Get(self.properties_key(i)))
 
+    def flush_points_db(self):
+        if isinstance(self.points_db, LevelDBWriteBuffer):
+            self.points_db.flush()
+
     def compact_points_db(self):
+        self.flush_points_db()
         self.points_db.CompactRange('\x00', '\xff')
 
     def save(self):
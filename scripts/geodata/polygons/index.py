@@ -13,6 +13,7 @@ from shapely.geometry import Point, Polygon, MultiPolygon
 from shapely.prepared import prep
 from shapely.geometry.geo import mapping
 
+from geodata.leveldb_utils import LevelDBWriteBuffer, DEFAULT_WRITE_BATCH_SIZE
 from geodata.polygons.area import polygon_bounding_box_area
 
 DEFAULT_POLYS_FILENAME = 'polygons.geojson'
@@ -26,6 +27,7 @@ class PolygonIndex(object):
     persistent_polygons = False
     cache_size = 0
     fix_invalid_polygons = False
+    write_batch_size = DEFAULT_WRITE_BATCH_SIZE
 
     INDEX_FILENAME = None
     POLYGONS_DB_DIR = 'polygons'
@@ -71,7 +73,8 @@ class PolygonIndex(object):
             polygons_db_path = os.path.join(save_dir or '.', self.POLYGONS_DB_DIR)
 
         if not polygons_db:
-            self.polygons_db = LevelDB(polygons_db_path)
+            # New index being built, buffer the writes
+            self.polygons_db = LevelDBWriteBuffer(LevelDB(polygons_db_path), batch_size=self.write_batch_size)
         else:
             self.polygons_db = polygons_db
 
@@ -88,6 +91,26 @@ class PolygonIndex(object):
     def setup(self):
         pass
 
+    def reopen_index(self):
+        '''
+        Called in forked worker processes. Indexes which read from file
+        handles with a shared offset should reopen them here.
+        '''
+        pass
+
+    def cache_stats(self):
+        '''Hit/miss counts for the polygon LRU, or None if polygons aren't cached'''
+        if not (self.persistent_polygons and self.cache_size > 0):
+            return None
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'size': len(self.polygons),
+            'max_size': self.cache_size,
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'hit_rate': float(self.cache_hits) / lookups if lookups else 0.0,
+        }
+
     def clear_cache(self, garbage_collect=True):
         if self.persistent_polygons and self.cache_size > 0:
             self.polygons.clear()
@@ -241,7 +264,12 @@ class PolygonIndex(object):
 
         return index
 
+    def flush_polygons_db(self):
+        if isinstance(self.polygons_db, LevelDBWriteBuffer):
+            self.polygons_db.flush()
+
     def compact_polygons_db(self):
+        self.flush_polygons_db()
         self.polygons_db.CompactRange('\x00', '\xff')
 
     def save(self):
@@ -377,6 +405,18 @@ class PolygonIndex(object):
         point = Point(lon, lat)
         return self.polygons_contain(candidates, point, return_all=return_all)
 
+    def point_in_poly_ids(self, lat, lon):
+        '''
+        Ids of all the polygons containing the point, in the same order as
+        point_in_poly(lat, lon, return_all=True)
+        '''
+        candidates = self.get_candidate_polygons(lat, lon)
+        point = Point(lon, lat)
+        return [i for i in candidates if self.get_polygon(i).contains(point)]
+
+    def properties_for_ids(self, ids):
+        return [self.get_properties(i) for i in ids]
+
 
 class RTreePolygonIndex(PolygonIndex):
     INDEX_FILENAME = 'rtree'
@@ -390,6 +430,11 @@ class RTreePolygonIndex(PolygonIndex):
     def get_candidate_polygons(self, lat, lon):
         return OrderedDict.fromkeys(self.index.intersection((lon, lat, lon, lat))).keys()
 
+    def reopen_index(self):
+        # libspatialindex seeks and reads on its file handles, which would
+        # share offsets with the parent and other forked workers
+        self.index = rtree.index.Index(self.index_path)
+
     def save_index(self):
         # need to close index before loading it
         self.index.close()
@@ -0,0 +1,221 @@
+'''
+Precomputed point-in-polygon joins
+
+A join table maps integer record keys (e.g. encoded OSM node ids) to the
+ids of the polygons containing that record's coordinates in each of several
+polygon indexes, so training data builders which see the same records can
+reverse geocode them once and look the results up afterward.
+
+File layout (little-endian):
+
+    header:  magic (8 bytes), num_indexes (uint32), reserved (uint32),
+             num_records (uint64), table_offset (uint64),
+             source size (uint64), source mtime (uint64),
+             index checksum (uint64)
+    data:    for each record, for each index: count (uint32), count polygon ids (uint32)
+    table:   num_records sorted keys (uint64), then num_records data offsets (uint64)
+
+The reader mmaps the file and binary searches the key table, so many forked
+processes can share one copy of it through the page cache.
+
+The source fields identify the input file and the polygon indexes the
+table was built from (see join_table_source), so a table for an older
+extract with the same name, or for rebuilt indexes, is not reused. The
+table is written to a temp file and renamed into place when complete.
+'''
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+
+from array import array
+
+JOIN_TABLE_MAGIC = b'GEOJOIN2'
+
+HEADER_FORMAT = '<8sIIQQQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+KEY_FORMAT = '<Q'
+KEY_SIZE = struct.calcsize(KEY_FORMAT)
+
+COUNT_FORMAT = '<I'
+COUNT_SIZE = struct.calcsize(COUNT_FORMAT)
+
+
+def join_table_source(infile, indexes):
+    '''
+    (size, mtime, index checksum) identifying the input file and the
+    polygon indexes (by number of polygons) a join table is built from
+    '''
+    st = os.stat(infile)
+    counts = ','.join([str(len(index)) if index is not None else '-' for index in indexes])
+    checksum = struct.unpack('<Q', hashlib.sha1(counts).digest()[:8])[0]
+    return (st.st_size, int(st.st_mtime), checksum)
+
+
+def uint64_array():
+    # Python 2's array has no 'Q', but 'L' is 64 bits on LP64 platforms
+    if array('L').itemsize == KEY_SIZE:
+        return array('L')
+    return []
+
+
+class PolygonJoinTableWriter(object):
+    '''
+    Writes a join table. Records may be added in any key order, though
+    input sorted by key (as OSM extracts are) avoids a sort in close().
+    '''
+    def __init__(self, filename, num_indexes, source=(0, 0, 0)):
+        self.filename = filename
+        self.num_indexes = num_indexes
+        self.source = source
+
+        fd, self.temp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                                  prefix=os.path.basename(filename), suffix='.tmp')
+        self.f = os.fdopen(fd, 'wb')
+        self.f.write(b'\x00' * HEADER_SIZE)
+        self.offset = HEADER_SIZE
+
+        self.keys = uint64_array()
+        self.offsets = uint64_array()
+        self.keys_sorted = True
+
+    def add(self, key, id_lists):
+        if len(id_lists) != self.num_indexes:
+            raise ValueError('Expected {} id lists, got {}'.format(self.num_indexes, len(id_lists)))
+
+        if self.keys and key <= self.keys[-1]:
+            self.keys_sorted = False
+        self.keys.append(key)
+        self.offsets.append(self.offset)
+
+        parts = []
+        for ids in id_lists:
+            parts.append(struct.pack(COUNT_FORMAT, len(ids)))
+            parts.append(struct.pack('<{}I'.format(len(ids)), *ids))
+        data = b''.join(parts)
+        self.f.write(data)
+        self.offset += len(data)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def write_uint64s(self, values, batch_size=1000000):
+        for i in xrange(0, len(values), batch_size):
+            batch = values[i:i + batch_size]
+            self.f.write(struct.pack('<{}Q'.format(len(batch)), *batch))
+
+    def abort(self):
+        '''Discards a partially written table'''
+        self.f.close()
+        if os.path.exists(self.temp_filename):
+            os.unlink(self.temp_filename)
+
+    def close(self):
+        num_records = len(self.keys)
+        keys = self.keys
+        offsets = self.offsets
+        if not self.keys_sorted:
+            order = sorted(xrange(num_records), key=keys.__getitem__)
+            keys = [keys[i] for i in order]
+            offsets = [offsets[i] for i in order]
+            for i in xrange(1, num_records):
+                if keys[i] == keys[i - 1]:
+                    self.abort()
+                    raise ValueError('Duplicate key in join table: {}'.format(keys[i]))
+
+        table_offset = self.offset
+        self.write_uint64s(keys)
+        self.write_uint64s(offsets)
+
+        self.f.seek(0)
+        self.f.write(struct.pack(HEADER_FORMAT, JOIN_TABLE_MAGIC, self.num_indexes, 0, num_records, table_offset,
+                                 *self.source))
+        self.f.close()
+        os.chmod(self.temp_filename, 0o644)
+        os.rename(self.temp_filename, self.filename)
+
+        self.keys = []
+        self.offsets = []
+
+
+class PolygonJoinTable(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, 'rb')
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.data) < HEADER_SIZE:
+            self.close()
+            raise ValueError('{} is not a join table'.format(filename))
+
+        header = struct.unpack_from(HEADER_FORMAT, self.data, 0)
+        magic, self.num_indexes, _, self.num_records, self.table_offset = header[:5]
+        self.source = header[5:]
+        if magic != JOIN_TABLE_MAGIC:
+            self.close()
+            raise ValueError('{} is not a join table'.format(filename))
+
+        self.offsets_offset = self.table_offset + self.num_records * KEY_SIZE
+
+    def key_at(self, i):
+        return struct.unpack_from(KEY_FORMAT, self.data, self.table_offset + i * KEY_SIZE)[0]
+
+    def find(self, key):
+        lo = 0
+        hi = self.num_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_records and self.key_at(lo) == key:
+            return lo
+        return None
+
+    def get(self, key):
+        '''
+        Returns a list of polygon id lists, one per index, for key or
+        None if the key isn't in the table.
+        '''
+        i = self.find(key)
+        if i is None:
+            return None
+
+        offset = struct.unpack_from(KEY_FORMAT, self.data, self.offsets_offset + i * KEY_SIZE)[0]
+        id_lists = []
+        for j in xrange(self.num_indexes):
+            count = struct.unpack_from(COUNT_FORMAT, self.data, offset)[0]
+            offset += COUNT_SIZE
+            id_lists.append(list(struct.unpack_from('<{}I'.format(count), self.data, offset)))
+            offset += count * COUNT_SIZE
+        return id_lists
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __len__(self):
+        return self.num_records
+
+    def close(self):
+        self.data.close()
+        self.f.close()
+
+
+def open_current_join_table(filename, source):
+    '''
+    The join table at filename if it exists and was built from source (see
+    join_table_source), otherwise None
+    '''
+    if not os.path.exists(filename):
+        return None
+    try:
+        table = PolygonJoinTable(filename)
+    except (ValueError, mmap.error, struct.error):
+        return None
+    if tuple(table.source) != tuple(source):
+        table.close()
+        return None
+    return table
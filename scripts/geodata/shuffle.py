@@ -0,0 +1,145 @@
+'''
+Streaming shuffle and train/cv/test split for large line-oriented files
+
+Reads the inputs once. Each line is assigned to an output split by a seeded
+hash of its contents (so identical lines always land in the same split and
+can't leak from train into test), then scattered to one of several bucket
+files for that split at random. Each bucket is small enough to shuffle in
+memory, so the outputs are written bucket by bucket, and no more than about
+memory_budget bytes of lines are held at once. A bucket which still turns out
+to be too big is scattered again into smaller buckets before shuffling.
+'''
+import hashlib
+import os
+import random
+import shutil
+import struct
+import tempfile
+
+from geodata.encoding import safe_encode
+from geodata.training_data_writer import training_data_lines, training_data_size
+
+DEFAULT_MEMORY_BUDGET = 2 * 1024 * 1024 * 1024
+
+# Python strings and the list holding them take a few times the raw line size
+IN_MEMORY_OVERHEAD = 3.0
+
+# More open bucket files than this (over all splits) risks hitting the fd limit
+MAX_BUCKETS = 256
+
+# Per open bucket file, reduced if all the buffers would not fit in memory_budget
+BUCKET_WRITE_BUFFER = 64 * 1024
+
+
+def split_for_line(line, salt, cumulative):
+    h = struct.unpack('<Q', hashlib.md5(salt + line).digest()[:8])[0]
+    value = float(h) / 2 ** 64
+    for i, c in enumerate(cumulative):
+        if value < c:
+            return i
+    return len(cumulative) - 1
+
+
+def num_buckets(num_bytes, memory_budget, max_buckets=MAX_BUCKETS):
+    return max(1, min(max_buckets, int(num_bytes * IN_MEMORY_OVERHEAD / memory_budget) + 1))
+
+
+def bucket_buffer_size(num_files, memory_budget):
+    return max(1, min(BUCKET_WRITE_BUFFER, memory_budget // num_files))
+
+
+def write_shuffled_bucket(filename, out, rand, memory_budget):
+    '''
+    Writes the lines of the bucket file filename to out in random order
+    and deletes it. Returns the number of lines written.
+    '''
+    size = os.path.getsize(filename)
+    if size * IN_MEMORY_OVERHEAD > memory_budget:
+        n = num_buckets(size, memory_budget)
+        buffer_size = bucket_buffer_size(n, memory_budget)
+        sub_buckets = [open('{}.{}'.format(filename, b), 'wb', buffer_size) for b in xrange(n)]
+        with open(filename) as f:
+            for line in f:
+                sub_buckets[rand.randrange(n)].write(line)
+        os.unlink(filename)
+        for f in sub_buckets:
+            f.close()
+
+        # A single line (or very unlucky draws) can't be split any further
+        if all((os.path.getsize(f.name) < size for f in sub_buckets)):
+            return sum((write_shuffled_bucket(f.name, out, rand, memory_budget) for f in sub_buckets))
+        filenames = [f.name for f in sub_buckets]
+    else:
+        filenames = [filename]
+
+    num_lines = 0
+    for filename in filenames:
+        with open(filename) as f:
+            lines = f.readlines()
+        os.unlink(filename)
+        rand.shuffle(lines)
+        out.writelines(lines)
+        num_lines += len(lines)
+        del lines
+    return num_lines
+
+
+def shuffle_split(input_filenames, outputs, seed=None, memory_budget=DEFAULT_MEMORY_BUDGET, temp_dir=None):
+    '''
+    Shuffles the lines of input_filenames into outputs, a list of
+    (filename, fraction) pairs whose fractions sum to 1. Returns the
+    number of lines written to each output.
+
+    With the same seed and inputs, the output is identical from run to run.
+    '''
+    if seed is None:
+        seed = random.randint(0, 2 ** 32)
+        print('shuffling with seed={}'.format(seed))
+
+    fractions = [fraction for filename, fraction in outputs]
+    cumulative = []
+    total = 0.0
+    for fraction in fractions:
+        total += fraction
+        cumulative.append(total)
+
+    salt = safe_encode(seed) + b'\x1f'
+    rand = random.Random(seed)
+
+    total_bytes = sum((training_data_size(filename) for filename in input_filenames))
+
+    bucket_dir = tempfile.mkdtemp(prefix='shuffle-', dir=temp_dir)
+    try:
+        max_buckets = max(1, MAX_BUCKETS // len(fractions))
+        bucket_filenames = [[os.path.join(bucket_dir, '{}.{}'.format(i, b))
+                             for b in xrange(num_buckets(total_bytes * fraction, memory_budget, max_buckets=max_buckets))]
+                            for i, fraction in enumerate(fractions)]
+        buffer_size = bucket_buffer_size(sum((len(filenames) for filenames in bucket_filenames)), memory_budget)
+        buckets = [[open(filename, 'wb', buffer_size) for filename in filenames]
+                   for filenames in bucket_filenames]
+
+        for filename in input_filenames:
+            print('scattering {}'.format(filename))
+            for line in training_data_lines(filename):
+                if not line.endswith('\n'):
+                    line += '\n'
+                split_buckets = buckets[split_for_line(line, salt, cumulative)]
+                split_buckets[rand.randrange(len(split_buckets))].write(line)
+
+        for split_buckets in buckets:
+            for f in split_buckets:
+                f.close()
+
+        counts = []
+        for (out_filename, fraction), split_buckets in zip(outputs, buckets):
+            out = open(out_filename, 'w')
+            num_lines = 0
+            for f in split_buckets:
+                num_lines += write_shuffled_bucket(f.name, out, rand, memory_budget)
+            out.close()
+            print('wrote {} lines to {}'.format(num_lines, out_filename))
+            counts.append(num_lines)
+
+        return counts
+    finally:
+        shutil.rmtree(bucket_dir, ignore_errors=True)
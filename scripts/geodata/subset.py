@@ -0,0 +1,209 @@
+'''
+Subsets of the training data builders' input, for quick iteration
+
+A Subset decides, as early and as cheaply as possible, whether a builder
+should do any work for a record:
+
+- sample_rate: keep a Bernoulli sample of records, decided by a hash of
+  (seed, source, record id) so the same records are kept from run to run
+  and regardless of worker count
+- bbox: only records whose coordinates fall inside
+  (min_lat, min_lon, max_lat, max_lon)
+- countries: only records in these countries
+- max_rows_per_country/max_rows_per_language: stop writing rows for a
+  country or language once it has this many. Countries which are full are
+  skipped before reverse geocoding, languages are only known per row.
+  Rows must be counted in one process, in input order, so that the caps
+  mean the same thing regardless of worker count. The countries which are
+  full are kept in shared memory, so worker processes forked after start
+  skip them too.
+
+Builders check sampled/in_bbox/country before reverse geocoding (see skip)
+and accept_row before writing each row. Each output file has its own caps,
+so builders writing several outputs call start before each one. The default Subset includes
+everything, and its checks return immediately.
+'''
+import multiprocessing
+
+from collections import defaultdict
+
+from geodata.math.sampling import record_seed
+
+MAX_RECORD_SEED = float(2 ** 64)
+
+
+class SharedCountrySet(object):
+    '''
+    Set of ISO 3166-1 alpha-2 country codes in shared memory. Processes
+    forked after it's created see every country added by the others.
+    Anything other than a two-letter code is never in the set.
+    '''
+    num_letters = 26
+
+    def __init__(self):
+        self.flags = multiprocessing.RawArray('b', self.num_letters * self.num_letters)
+
+    @classmethod
+    def index(cls, country):
+        if country is None or len(country) != 2:
+            return None
+        a = ord(country[0]) - ord('a')
+        b = ord(country[1]) - ord('a')
+        if not (0 <= a < cls.num_letters and 0 <= b < cls.num_letters):
+            return None
+        return a * cls.num_letters + b
+
+    def add(self, country):
+        i = self.index(country)
+        if i is not None:
+            self.flags[i] = 1
+
+    def __contains__(self, country):
+        i = self.index(country)
+        return i is not None and self.flags[i] != 0
+
+
+class Subset(object):
+    def __init__(self, sample_rate=None, bbox=None, countries=None,
+                 max_rows_per_country=None, max_rows_per_language=None, seed=None):
+        if sample_rate is not None and not (0.0 < sample_rate <= 1.0):
+            raise ValueError('sample_rate must be in (0, 1], got {}'.format(sample_rate))
+        if bbox is not None and len(bbox) != 4:
+            raise ValueError('bbox must be (min_lat, min_lon, max_lat, max_lon)')
+
+        self.sample_rate = sample_rate if sample_rate is not None and sample_rate < 1.0 else None
+        self.bbox = bbox
+        self.countries = set([c.lower() for c in countries]) if countries else None
+        self.max_rows_per_country = max_rows_per_country
+        self.max_rows_per_language = max_rows_per_language
+        self.seed = seed or ''
+
+        self.start()
+
+        self.includes_everything = not (self.sample_rate or self.bbox or self.needs_country() or max_rows_per_language)
+
+    def start(self):
+        '''Resets the row caps and counts, for a new output file'''
+        self.country_rows = defaultdict(int)
+        self.language_rows = defaultdict(int)
+        self.skipped_records = 0
+        self.skipped_rows = 0
+        # New for each output, a stage forked from the same parent may
+        # be using the previous one
+        self.full_countries = SharedCountrySet() if self.max_rows_per_country is not None else None
+
+    def has_row_caps(self):
+        return self.max_rows_per_country is not None or self.max_rows_per_language is not None
+
+    def needs_country(self):
+        return self.countries is not None or self.max_rows_per_country is not None
+
+    def needs_location(self):
+        return self.bbox is not None or self.needs_country()
+
+    def sampled(self, source, record_id):
+        if self.sample_rate is None:
+            return True
+        return record_seed(self.seed, source, record_id) / MAX_RECORD_SEED < self.sample_rate
+
+    def in_bbox(self, latitude, longitude):
+        if self.bbox is None:
+            return True
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        return min_lat <= latitude <= max_lat and min_lon <= longitude <= max_lon
+
+    def country_allowed(self, country):
+        if country is None:
+            return self.countries is None
+        country = country.lower()
+        if self.countries is not None and country not in self.countries:
+            return False
+        if self.max_rows_per_country is not None and (self.country_rows[country] >= self.max_rows_per_country or
+                                                      country in self.full_countries):
+            return False
+        return True
+
+    def skip(self, source, record_id, latitude=None, longitude=None, country=None, country_func=None):
+        '''
+        True if the builder should skip this record. If the country isn't
+        known yet, country_func(latitude, longitude) is called to look it
+        up, but only when filtering on country.
+        '''
+        if self.includes_everything:
+            return False
+
+        skip = False
+        if not self.sampled(source, record_id):
+            skip = True
+        elif latitude is not None and longitude is not None and not self.in_bbox(latitude, longitude):
+            skip = True
+        elif self.needs_country():
+            if country is None and country_func is not None and latitude is not None and longitude is not None:
+                country = country_func(latitude, longitude)
+            skip = not self.country_allowed(country)
+
+        if skip:
+            self.skipped_records += 1
+        return skip
+
+    def accept_row(self, country, language):
+        '''Counts a row toward its caps, or returns False if either is full'''
+        if self.includes_everything:
+            return True
+
+        if country is not None:
+            country = country.lower()
+        if not self.country_allowed(country) or (self.max_rows_per_language is not None and
+                                                 self.language_rows[language] >= self.max_rows_per_language):
+            self.skipped_rows += 1
+            return False
+
+        self.country_rows[country] += 1
+        self.language_rows[language] += 1
+        if self.max_rows_per_country is not None and self.country_rows[country] >= self.max_rows_per_country:
+            self.full_countries.add(country)
+        return True
+
+
+ALL_RECORDS = Subset()
+
+
+def parse_bbox(value):
+    return tuple([float(v) for v in value.split(',')])
+
+
+def add_subset_arguments(parser):
+    parser.add_argument('--sample-rate',
+                        type=float,
+                        default=None,
+                        help='Only process this fraction of records, chosen by a hash of the record id (and --seed)')
+
+    parser.add_argument('--bbox',
+                        type=parse_bbox,
+                        default=None,
+                        help='Only process records within min_lat,min_lon,max_lat,max_lon')
+
+    parser.add_argument('--countries',
+                        type=lambda value: value.split(','),
+                        default=None,
+                        help='Only process records in these comma-separated ISO 3166-1 alpha-2 countries')
+
+    parser.add_argument('--max-rows-per-country',
+                        type=int,
+                        default=None,
+                        help='Stop writing rows for a country after this many')
+
+    parser.add_argument('--max-rows-per-language',
+                        type=int,
+                        default=None,
+                        help='Stop writing rows for a language after this many')
+
+
+def subset_from_args(args):
+    subset = Subset(sample_rate=args.sample_rate, bbox=args.bbox, countries=args.countries,
+                    max_rows_per_country=args.max_rows_per_country,
+                    max_rows_per_language=args.max_rows_per_language,
+                    seed=getattr(args, 'seed', None))
+    if subset.includes_everything:
+        return None
+    return subset
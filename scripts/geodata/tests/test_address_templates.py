@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import sys
+import unittest
+
+import pystache
+
+this_dir = os.path.realpath(os.path.dirname(__file__))
+sys.path.append(os.path.realpath(os.path.join(os.pardir, os.pardir)))
+
+from geodata.address_formatting.compiled import compile_template, pystache_renderer
+
+
+templates = [
+    '{{{house}}}\n{{{road}}} {{{house_number}}}\n{{{postcode}}} {{#first}} {{{city}}} || {{{town}}} || {{{state}}} {{/first}}\n{{{country}}}',
+    '{{{house_number}}} {{{road}}}, {{{unit}}}\n{{#first}} {{{city}}} || {{{state_district}}} {{/first}}, {{{state}}} {{{postcode}}}\n',
+    '  {{#first}}\n{{{suburb}}} ||\n{{{city}}}\n{{/first}}\n{{{country}}}  ',
+    '{{road}} & {{{house}}} {{! comment }}',
+    '{{#first}} {{/first}}{{{missing}}}',
+]
+
+components_list = [
+    {'house': 'Anticafé', 'house_number': '2', 'road': 'Calle de la Unión', 'postcode': '28013', 'city': 'Madrid', 'country': 'España'},
+    {'road': 'Rue <Saint> & "Paul"', 'house': 'A || B', 'town': '', 'state': 'Île-de-France'},
+    {'suburb': '   ', 'city': 'Brooklyn', 'unit': 3, 'state_district': 'Kings'},
+    {'city': '{{{country}}}', 'country': 'USA'},
+    {},
+]
+
+
+class TestCompiledTemplates(unittest.TestCase):
+    def test_same_as_pystache(self):
+        for template in templates:
+            compiled = compile_template(template)
+            self.assertTrue(compiled.compiled)
+            expected = pystache_renderer(template)
+            for components in components_list:
+                self.assertEqual(compiled(components), expected(components))
+
+    def test_unsupported_falls_back(self):
+        template = '{{#road}}{{{road}}}{{/road}} {{^city}}none{{/city}}'
+        renderer = compile_template(template)
+        self.assertFalse(renderer.compiled)
+        self.assertEqual(renderer({'road': 'Main St'}), pystache.render(template, road='Main St'))
+
+
+if __name__ == '__main__':
+    unittest.main()
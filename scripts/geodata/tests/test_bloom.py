@@ -0,0 +1,56 @@
+import unittest
+
+from geodata.math.bloom import BloomFilter, ScalableBloomFilter
+
+
+def keys(start, end):
+    return (b'key{}'.format(i) for i in xrange(start, end))
+
+
+class TestBloomFilter(unittest.TestCase):
+    def false_positive_rate(self, bloom, start, end):
+        return float(sum((1 for key in keys(start, end) if key in bloom))) / (end - start)
+
+    def test_membership(self):
+        bloom = BloomFilter(10000, 0.01)
+        for key in keys(0, 10000):
+            bloom.add(key)
+        self.assertTrue(all((key in bloom for key in keys(0, 10000))))
+        self.assertTrue(all((bloom.add(key) for key in keys(0, 10000))))
+
+    def test_false_positive_rate(self):
+        for error_rate in (0.01, 0.001):
+            bloom = BloomFilter(10000, error_rate)
+            for key in keys(0, 10000):
+                bloom.add(key)
+            # Generous margin over the expected rate, the check is deterministic anyway
+            self.assertLess(self.false_positive_rate(bloom, 10000, 110000), error_rate * 1.5)
+
+    def test_scalable_growth(self):
+        bloom = ScalableBloomFilter(initial_capacity=1000, error_rate=0.01)
+        for key in keys(0, 20000):
+            bloom.add(key)
+
+        self.assertGreater(len(bloom.filters), 1)
+        capacities = [f.capacity for f in bloom.filters]
+        self.assertEqual(capacities, [1000 * bloom.growth_factor ** i for i in xrange(len(capacities))])
+        error_rates = [f.error_rate for f in bloom.filters]
+        self.assertEqual(error_rates, sorted(error_rates, reverse=True))
+        self.assertLess(sum(error_rates), 0.01)
+
+        self.assertTrue(all((key in bloom for key in keys(0, 20000))))
+        self.assertLess(self.false_positive_rate(bloom, 20000, 70000), 0.01)
+
+    def test_scalable_max_memory(self):
+        bloom = ScalableBloomFilter(initial_capacity=1000, error_rate=0.01, max_memory=16 * 1024)
+        for key in keys(0, 50000):
+            bloom.add(key)
+
+        self.assertLessEqual(bloom.memory(), 16 * 1024)
+        self.assertGreater(bloom.dropped_filters, 0)
+        # The most recent keys are still deduplicated
+        self.assertTrue(all((key in bloom for key in keys(49000, 50000))))
+
+
+if __name__ == '__main__':
+    unittest.main()
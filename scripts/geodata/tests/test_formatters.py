@@ -0,0 +1,123 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from geodata.addresses.components import AddressComponents
+from geodata.addresses.profiling import EXPANDED, StepProfiler
+from geodata.metrics import NULL_METRICS
+from geodata.openaddresses.formatter import OpenAddressesFormatter
+from geodata.osm.formatter import OSMAddressFormatter, FORMATTED_ADDRESS_DATA_TAGGED_FILENAME
+from geodata.subset import Subset
+from geodata.workers import ForkedWorkerPool
+
+
+class StubComponents(AddressComponents):
+    '''AddressComponents profiling, without loading any indexes or data'''
+    def __init__(self):
+        self.osm_admin_rtree = None
+        self.neighborhoods_rtree = None
+        self.places_index = None
+        self.profiler = StepProfiler()
+        self.logged_calls = []
+
+    def log_profile(self):
+        self.logged_calls.append(self.profiler.steps[EXPANDED].calls)
+        super(StubComponents, self).log_profile()
+
+
+class StubAddressFormatter(object):
+    metrics = None
+
+    def cache_stats(self):
+        return {}
+
+    def log_cache_stats(self):
+        pass
+
+
+class CountingOSMFormatter(OSMAddressFormatter):
+    '''
+    Every node is in one country and formats to one address. Only counts
+    the nodes which get as far as formatting, none of the indexes are loaded.
+    '''
+    def __init__(self, country, subset):
+        self.country = country
+        self.subset = subset
+        self.components = StubComponents()
+        self.formatter = StubAddressFormatter()
+        self.metrics = NULL_METRICS
+        self.shard_options = None
+        self.dedupe_options = None
+        self.join_dir = None
+        self.join_table = None
+        self.seed = None
+        self.country_rtree = None
+        self.subdivisions_rtree = None
+        self.buildings_rtree = None
+        self.metro_stations_index = None
+
+        # Shared with the forked workers
+        self.formatted = multiprocessing.Value('i', 0)
+
+    def country_for_point(self, latitude, longitude):
+        return self.country
+
+    def formatted_addresses(self, tags, tag_components=True, node_id=None):
+        with self.formatted.get_lock():
+            self.formatted.value += 1
+        self.components.profiler.add(EXPANDED, self.country, 0.001)
+        return [tags['addr:street']], self.country, 'en'
+
+
+class TestOSMRowCaps(unittest.TestCase):
+    num_nodes = 200
+    max_rows = 5
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.infile = os.path.join(self.out_dir, 'addresses.osm')
+        with open(self.infile, 'w') as f:
+            f.write('<osm>\n')
+            for i in range(self.num_nodes):
+                f.write('<node id="{}" lat="48.8" lon="2.3"><tag k="addr:street" v="Rue {}"/></node>\n'.format(i + 1, i))
+            f.write('</osm>\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def build(self, num_workers, chunk_size=1):
+        formatter = CountingOSMFormatter('fr', Subset(max_rows_per_country=self.max_rows))
+        formatter.build_training_data(self.infile, self.out_dir, tag_components=True,
+                                      num_workers=num_workers, chunk_size=chunk_size)
+        with open(os.path.join(self.out_dir, FORMATTED_ADDRESS_DATA_TAGGED_FILENAME)) as f:
+            lines = f.readlines()
+        return formatter, lines
+
+    def test_serial(self):
+        formatter, lines = self.build(1)
+        self.assertEqual(len(lines), self.max_rows)
+        self.assertEqual(formatter.formatted.value, self.max_rows)
+        self.assertEqual(formatter.components.logged_calls, [self.max_rows])
+
+    def test_workers_skip_full_countries(self):
+        num_workers = 2
+        formatter, lines = self.build(num_workers)
+        self.assertEqual(len(lines), self.max_rows)
+        # Only chunks already sent to the workers when the country filled up are formatted
+        max_in_flight = num_workers * ForkedWorkerPool.pending_chunks_per_worker
+        self.assertLessEqual(formatter.formatted.value, self.max_rows + max_in_flight + num_workers)
+        # One report in the parent, with every worker's calls
+        self.assertEqual(formatter.components.logged_calls, [formatter.formatted.value])
+
+
+class TestOpenAddressesRowCaps(unittest.TestCase):
+    def test_workers_with_row_caps(self):
+        formatter = OpenAddressesFormatter.__new__(OpenAddressesFormatter)
+        formatter.subset = Subset(max_rows_per_language=10)
+        self.assertRaises(ValueError, formatter.build_training_data, '', '', num_workers=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
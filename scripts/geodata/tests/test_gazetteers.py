@@ -0,0 +1,213 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from marisa_trie import BytesTrie
+
+from geodata.address_expansions.gazetteers import *
+
+
+def phrase_trie_data(keys_payloads, payloads):
+    '''BytesTrie of key => payload ids, as DictionaryPhraseTrie.build returns it'''
+    return BytesTrie([(key, payload_id_struct.pack(i)) for key, i in keys_payloads]), payloads
+
+
+class CountingPhraseTrie(DictionaryPhraseTrie):
+    '''A DictionaryPhraseTrie over a few phrases, which counts its builds'''
+    phrase_payloads = ['en|street_types|1|street', 'fr|street_types|1|rue']
+
+    def __init__(self, cache_dir, keys_payloads=((u'st', 0), (u'rue', 1))):
+        super(CountingPhraseTrie, self).__init__()
+        self.cache_dir = cache_dir
+        self.keys_payloads = keys_payloads
+        self.builds = 0
+
+    def build(self):
+        self.builds += 1
+        return phrase_trie_data(self.keys_payloads, self.phrase_payloads)
+
+
+class FailingTrie(object):
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write('partial')
+        raise IOError('disk full')
+
+
+class TestGazetteerCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, 'gazetteers')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def cache_files(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def check_loaded(self, phrase_trie):
+        self.assertEqual(phrase_trie.values(u'st', phrase_trie.dictionary_mask(['street_types'])),
+                         [PhrasePayload(u'en', u'street_types', True, u'street')])
+        self.assertEqual(phrase_trie.values(u'rue', phrase_trie.dictionary_mask(['street_types'])),
+                         [PhrasePayload(u'fr', u'street_types', True, u'rue')])
+
+    def test_load_cached(self):
+        phrase_trie = CountingPhraseTrie(self.cache_dir).load()
+        self.assertEqual(phrase_trie.builds, 1)
+        self.check_loaded(phrase_trie)
+
+        path = phrase_trie.cache_path()
+        self.assertEqual(self.cache_files(), sorted([os.path.basename(path) + '.payloads', os.path.basename(path) + '.trie']))
+        self.assertEqual(os.stat(self.cache_dir).st_mode & 0o777, 0o700)
+
+        cached = CountingPhraseTrie(self.cache_dir).load()
+        self.assertEqual(cached.builds, 0)
+        self.check_loaded(cached)
+
+    def test_tampered_trie(self):
+        path = CountingPhraseTrie(self.cache_dir).load().cache_path()
+
+        # A valid trie, but not the one whose SHA-1 is in the payloads file
+        trie, payloads = phrase_trie_data([(u'st', 1), (u'rue', 0)], CountingPhraseTrie.phrase_payloads)
+        trie.save(path + '.trie')
+
+        phrase_trie = CountingPhraseTrie(self.cache_dir).load()
+        self.assertEqual(phrase_trie.builds, 1)
+        self.check_loaded(phrase_trie)
+
+        # And the rebuilt trie replaced it
+        self.assertEqual(CountingPhraseTrie(self.cache_dir).load().builds, 0)
+
+    def test_untrusted_cache_dir(self):
+        CountingPhraseTrie(self.cache_dir).load()
+        files = self.cache_files()
+        os.chmod(self.cache_dir, 0o770)
+
+        phrase_trie = CountingPhraseTrie(self.cache_dir, keys_payloads=((u'st', 0), (u'rue', 1), (u'av', 0))).load()
+        self.assertEqual(phrase_trie.builds, 1)
+        self.check_loaded(phrase_trie)
+        # Nothing new written to the group-writable directory
+        self.assertEqual(self.cache_files(), files)
+
+        phrase_trie = CountingPhraseTrie(self.cache_dir).load()
+        self.assertEqual(phrase_trie.builds, 1)
+
+    def test_untrusted_cache_file(self):
+        path = CountingPhraseTrie(self.cache_dir).load().cache_path()
+        os.chmod(path + '.payloads', 0o666)
+        self.assertEqual(CountingPhraseTrie(self.cache_dir).load().builds, 1)
+
+    def test_failed_save(self):
+        phrase_trie = CountingPhraseTrie(self.cache_dir)
+        os.makedirs(self.cache_dir, 0o700)
+        trie = FailingTrie()
+        _, payloads = phrase_trie.build()
+        self.assertIs(phrase_trie.save(phrase_trie.cache_path(), trie, payloads), trie)
+        # The temp file was removed and nothing else was written
+        self.assertEqual(self.cache_files(), [])
+
+    def test_cache_disabled(self):
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            phrase_trie = CountingPhraseTrie('').load()
+        finally:
+            os.chdir(cwd)
+        self.assertIsNone(phrase_trie.cache_path())
+        self.assertEqual(phrase_trie.builds, 1)
+        self.check_loaded(phrase_trie)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    def test_cache_dir_env(self):
+        env = dict(os.environ, GEODATA_GAZETTEER_CACHE_DIR='')
+        cache_dir = subprocess.check_output([sys.executable, '-c',
+                                             'from geodata.address_expansions.gazetteers import *; '
+                                             'print(repr(DictionaryPhraseTrie.cache_dir))'],
+                                            env=env, stderr=open(os.devnull, 'w'))
+        self.assertEqual(cache_dir.strip().splitlines()[-1], repr(''))
+
+
+
+class TestDictionaryTrieView(unittest.TestCase):
+    payloads = [
+        'en|street_types|1|street',
+        'en|toponyms|0|saint',
+        'en|street_types|0|avenue',
+        'en|directionals|1|south',
+        'de|concatenated_suffixes_separable|1|strasse',
+        'de|concatenated_prefixes_separable|1|nord',
+    ]
+
+    keys_payloads = [
+        (u'st', 0),
+        (u'st', 1),
+        (u'ave', 2),
+        (u's', 3),
+        (SUFFIX_KEY + u'essarts', 4),
+        (PREFIX_KEY + u'nord', 5),
+    ]
+
+    def setUp(self):
+        self.phrase_trie = DictionaryPhraseTrie()
+        self.phrase_trie.set_data(*phrase_trie_data(self.keys_payloads, self.payloads))
+        self.streets = DictionaryTrieView(self.phrase_trie, ['street_types', 'concatenated_suffixes_separable'])
+        self.others = DictionaryTrieView(self.phrase_trie, ['toponyms', 'directionals', 'concatenated_prefixes_separable'])
+
+    def test_get(self):
+        self.assertEqual(self.streets.get(u'st'), [PhrasePayload(u'en', u'street_types', True, u'street')])
+        self.assertEqual(self.others.get(u'st'), [PhrasePayload(u'en', u'toponyms', False, u'saint')])
+        self.assertEqual(self.others.get(u's'), [PhrasePayload(u'en', u'directionals', True, u'south')])
+        self.assertIsNone(self.streets.get(u's'))
+        self.assertEqual(self.others.get(u'ave', 'missing'), 'missing')
+        self.assertIsNone(self.streets.get(PREFIX_KEY + u'nord'))
+
+    def test_has_keys_with_prefix(self):
+        self.assertTrue(self.streets.has_keys_with_prefix(SUFFIX_KEY + u'ess'))
+        self.assertFalse(self.others.has_keys_with_prefix(SUFFIX_KEY + u'ess'))
+        self.assertTrue(self.others.has_keys_with_prefix(PREFIX_KEY + u'no'))
+        self.assertFalse(self.streets.has_keys_with_prefix(PREFIX_KEY + u'no'))
+        self.assertFalse(self.streets.has_keys_with_prefix(PREFIX_KEY))
+        self.assertFalse(self.others.has_keys_with_prefix(SUFFIX_KEY + u'x'))
+
+        self.assertTrue(self.streets.has_keys_with_prefix(u'a'))
+        self.assertFalse(self.others.has_keys_with_prefix(u'a'))
+        self.assertTrue(self.others.has_keys_with_prefix(u's'))
+
+        self.assertTrue(self.streets.has_keys_with_prefix(u''))
+        self.assertFalse(DictionaryTrieView(self.phrase_trie, ['surnames']).has_keys_with_prefix(u''))
+
+    def test_iterkeys(self):
+        self.assertEqual(sorted(self.streets.iterkeys()), sorted([u'st', u'ave', SUFFIX_KEY + u'essarts']))
+        self.assertEqual(sorted(self.others.iterkeys()), sorted([u'st', u's', PREFIX_KEY + u'nord']))
+        self.assertEqual(sorted(self.others.iterkeys(u's')), [u's', u'st'])
+        self.assertEqual(list(self.streets.iterkeys(PREFIX_KEY)), [])
+
+    def test_prefix_masks(self):
+        # Same as checking every key under the prefix
+        for key, payload_id in self.keys_payloads:
+            if key[0] not in (PREFIX_KEY, SUFFIX_KEY):
+                continue
+            for j in range(1, len(key) + 1):
+                prefix = key[:j]
+                mask = 0
+                for k in self.phrase_trie.trie.iterkeys(prefix):
+                    mask |= self.phrase_trie.key_mask(k)
+                self.assertEqual(self.phrase_trie.prefix_masks[prefix], mask)
+
+    def test_phrase_filter(self):
+        class StreetTypes(DictionaryPhraseFilter):
+            phrase_trie = self.phrase_trie
+
+        street_types = StreetTypes('street_types', 'concatenated_suffixes_separable')
+        self.assertEqual(street_types.search_suffix(u'hauptstrasse'),
+                         ([PhrasePayload(u'de', u'concatenated_suffixes_separable', True, u'strasse')], len(u'strasse')))
+        self.assertEqual(street_types.search_prefix(u'nordweg'), (None, 0))
+        self.assertEqual(StreetTypes('concatenated_prefixes_separable').search_prefix(u'nordweg'),
+                         ([PhrasePayload(u'de', u'concatenated_prefixes_separable', True, u'nord')], len(u'nord')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+import geodata.text.tokenize
+
+from geodata.text.normalize import *
+from geodata.text.tokenize import *
+
+
+test_strings = [
+    '',
+    ' ',
+    'St.-Barthélemy',
+    '123 Main St. (rear)',
+    'Rue de la Paix (2e étage) (bâtiment B), Paris',
+    '((nested) parens) after',
+    'unbalanced ) close ( open',
+    'Fußgängerzone 3a',
+    '東京都渋谷区 1-2-3',
+    '  multiple   spaces\tand\ttabs  ',
+    'ул. Тверская, д. 7',
+]
+
+
+class TestBatchTokenize(unittest.TestCase):
+    def test_tokenize_many(self):
+        self.assertEqual(tokenize_many(test_strings), [tokenize(s) for s in test_strings])
+        self.assertEqual(tokenize_many([]), [])
+
+
+class TestTokenView(unittest.TestCase):
+    def test_token_view(self):
+        for s in test_strings:
+            view = token_view(s)
+            self.assertEqual(list(view), tokenize(s))
+            self.assertEqual([view.raw(i) for i in range(len(view))], list(tokenize_raw(s)))
+            self.assertEqual(list(view.without_parentheticals()), remove_parens(tokenize(s)))
+
+    def test_token_view_without_tokenize_many(self):
+        class OldTokenize(object):
+            tokenize = staticmethod(geodata.text.tokenize._tokenize.tokenize)
+
+        expected = [list(token_view(s)) for s in test_strings]
+        _tokenize = geodata.text.tokenize._tokenize
+        geodata.text.tokenize._tokenize = OldTokenize
+        try:
+            self.assertEqual([list(token_view(s)) for s in test_strings], expected)
+        finally:
+            geodata.text.tokenize._tokenize = _tokenize
+
+    def test_normalized_token_view(self):
+        for s in test_strings:
+            normalized = normalize_string(s)
+            view = token_view(normalized).without_parentheticals()
+            self.assertEqual([(normalize_token(normalized, view.raw(i)), view.token_type(i)) for i in range(len(view))],
+                             normalized_tokens(s))
+
+
+class TestBatchNormalize(unittest.TestCase):
+    def test_normalize_strings(self):
+        self.assertEqual(normalize_strings(test_strings), [normalize_string(s) for s in test_strings])
+
+    def test_normalized_tokens_many(self):
+        for strip_parentheticals in (True, False):
+            for whitespace in (True, False):
+                kw = dict(strip_parentheticals=strip_parentheticals, whitespace=whitespace)
+                self.assertEqual(normalized_tokens_many(test_strings, **kw),
+                                 [list(normalized_tokens(s, **kw)) for s in test_strings])
+        self.assertEqual(normalized_tokens_many([]), [])
+
+
+
+class TestNormalizeCache(unittest.TestCase):
+    def setUp(self):
+        enable_cache(1000)
+
+    def tearDown(self):
+        disable_cache()
+
+    def test_same_results(self):
+        disable_cache()
+        expected_strings = [normalize_string(s) for s in test_strings]
+        enable_cache(1000)
+        for i in range(2):
+            self.assertEqual([normalize_string(s) for s in test_strings], expected_strings)
+
+        for kw in (dict(), dict(whitespace=True), dict(strip_parentheticals=False)):
+            disable_cache()
+            expected = [normalized_tokens(s, **kw) for s in test_strings]
+            enable_cache(1000)
+            for i in range(2):
+                self.assertEqual([list(normalized_tokens(s, **kw)) for s in test_strings], expected)
+
+    def test_immutable_results(self):
+        s = test_strings[3]
+        tokens = normalized_tokens(s)
+        self.assertIsInstance(tokens, tuple)
+        self.assertIs(normalized_tokens(s), tokens)
+        self.assertIsNot(normalized_tokens(s, whitespace=True), tokens)
+
+    def cache_counts(self):
+        stats = cache_stats()['normalize']
+        return stats['hits'], stats['misses']
+
+    def test_cache_stats(self):
+        s = test_strings[2]
+        self.assertEqual(self.cache_counts(), (0, 0))
+        normalize_string(s)
+        normalize_string(s)
+        self.assertEqual(self.cache_counts(), (1, 1))
+        # Tokens miss, the normalized string is already cached
+        normalized_tokens(s)
+        self.assertEqual(self.cache_counts(), (2, 2))
+        normalized_tokens(s)
+        self.assertEqual(self.cache_counts(), (3, 2))
+
+        disable_cache()
+        self.assertEqual(cache_stats(), {})
+
+    def test_fork(self):
+        s = test_strings[4]
+        tokens = normalized_tokens(s)
+        normalized_tokens(s)
+        self.assertEqual(self.cache_counts(), (1, 2))
+
+        pid = os.fork()
+        if pid == 0:
+            ok = self.cache_counts() == (0, 0)
+            ok = ok and normalized_tokens(s) == tokens and self.cache_counts() == (1, 0)
+            os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        # The child's lookups don't count in the parent
+        self.assertEqual(self.cache_counts(), (1, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+from geodata.text.phrases import PhraseFilter
+from geodata.text.token_types import token_types
+from geodata.text.tokenize import tokenize, token_view
+
+
+phrases = {
+    'st': 'street',
+    'st louis': 'city',
+    'a b': 'ab',
+    'a b c d': 'abcd',
+    'main': 'main',
+}
+
+
+def words(s):
+    return [(t, token_types.WORD) for t in s.split()]
+
+
+def phrase(s, data):
+    return (True, words(s), [data])
+
+
+def token(t):
+    return (False, (t, token_types.WORD), [])
+
+
+class TestPhraseFilter(unittest.TestCase):
+    def setUp(self):
+        self.phrase_filter = PhraseFilter(phrases)
+
+    def filtered(self, tokens):
+        return [(is_phrase, list(t) if is_phrase else t, data)
+                for is_phrase, t, data in self.phrase_filter.filter(tokens)]
+
+    def test_prefix_of_longer_phrase(self):
+        self.assertEqual(self.filtered(words('st louis st')), [phrase('st louis', 'city'), phrase('st', 'street')])
+        self.assertEqual(self.filtered(words('st charles')), [phrase('st', 'street'), token('charles')])
+        self.assertEqual(self.filtered(words('louis st')), [token('louis'), phrase('st', 'street')])
+
+    def test_backtracking(self):
+        # "a b c" is a prefix of "a b c d" but not a phrase, so the longest match is "a b"
+        self.assertEqual(self.filtered(words('a b c x')), [phrase('a b', 'ab'), token('c'), token('x')])
+        self.assertEqual(self.filtered(words('x a b c')), [token('x'), phrase('a b', 'ab'), token('c')])
+        self.assertEqual(self.filtered(words('a b c d')), [phrase('a b c d', 'abcd')])
+        self.assertEqual(self.filtered(words('a x')), [token('a'), token('x')])
+
+    def test_adjacent_phrases(self):
+        self.assertEqual(self.filtered(words('main st main')),
+                         [phrase('main', 'main'), phrase('st', 'street'), phrase('main', 'main')])
+        self.assertEqual(self.filtered(words('a b a b c d st')),
+                         [phrase('a b', 'ab'), phrase('a b c d', 'abcd'), phrase('st', 'street')])
+
+    def test_no_match(self):
+        self.assertEqual(self.filtered(words('foo bar')), [token('foo'), token('bar')])
+        self.assertEqual(self.filtered([]), [])
+        self.assertEqual(self.filtered(()), [])
+
+    def test_tuple_input(self):
+        for s in ('st louis st', 'a b c x', 'main st main', 'foo bar'):
+            self.assertEqual(self.filtered(tuple(words(s))), self.filtered(words(s)))
+
+    def test_token_view_input(self):
+        s = 'a b c, st louis main st'
+        self.assertEqual(self.filtered(token_view(s)), self.filtered(tokenize(s)))
+        self.assertEqual([(is_phrase, [t for t, c in tokens] if is_phrase else tokens[0], data)
+                          for is_phrase, tokens, data in self.filtered(token_view(s))],
+                         [(True, ['a', 'b'], ['ab']), (False, 'c', []), (False, ',', []),
+                          (True, ['st', 'louis'], ['city']), (True, ['main'], ['main']), (True, ['st'], ['street'])])
+        self.assertEqual(self.filtered(token_view('')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
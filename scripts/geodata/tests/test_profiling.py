@@ -0,0 +1,41 @@
+import pickle
+import unittest
+
+from geodata.addresses.profiling import *
+
+
+class TestStepProfiler(unittest.TestCase):
+    def profiler(self, *calls):
+        profiler = StepProfiler()
+        for step, country, seconds in calls:
+            profiler.add(step, country, seconds)
+        return profiler
+
+    def totals(self, steps):
+        return {step: (stats.calls, stats.seconds) for step, stats in steps.iteritems()}
+
+    def test_pickle(self):
+        profiler = self.profiler((EXPANDED, 'us', 0.5), ('state_name', 'us', 0.25), (EXPANDED, None, 1.0))
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            copy = pickle.loads(pickle.dumps(profiler, protocol))
+            self.assertEqual(self.totals(copy.steps), self.totals(profiler.steps))
+            self.assertEqual(self.totals(copy.country_steps[None]), {EXPANDED: (1, 1.0)})
+            self.assertEqual(copy.report(), profiler.report())
+
+    def test_merge(self):
+        profiler = self.profiler((EXPANDED, 'us', 0.5), ('state_name', 'us', 0.25))
+        profiler.merge(self.profiler((EXPANDED, 'us', 1.5), (EXPANDED, 'fr', 2.0)))
+        profiler.merge(StepProfiler())
+
+        self.assertEqual(self.totals(profiler.steps), {EXPANDED: (3, 4.0), 'state_name': (1, 0.25)})
+        self.assertEqual(self.totals(profiler.country_steps['us']), {EXPANDED: (2, 2.0), 'state_name': (1, 0.25)})
+        self.assertEqual(self.totals(profiler.country_steps['fr']), {EXPANDED: (1, 2.0)})
+
+        report = profiler.report().split('\n')
+        self.assertEqual(report.count('country=fr:'), 1)
+        # Sorted by total time, fr first
+        self.assertLess(report.index('country=fr:'), report.index('country=us:'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import unittest
+
+from geodata.subset import *
+
+
+class TestSubset(unittest.TestCase):
+    def test_country_caps(self):
+        subset = Subset(max_rows_per_country=2)
+        self.assertFalse(subset.skip('test', 1, country='US'))
+        self.assertTrue(subset.accept_row('US', 'en'))
+        self.assertTrue(subset.accept_row('us', 'es'))
+        self.assertFalse(subset.accept_row('us', 'en'))
+        self.assertTrue(subset.accept_row('ca', 'en'))
+
+        self.assertTrue(subset.skip('test', 2, country='us'))
+        self.assertFalse(subset.skip('test', 3, country='ca'))
+        self.assertIn('us', subset.full_countries)
+        self.assertNotIn('ca', subset.full_countries)
+
+        subset.start()
+        self.assertFalse(subset.skip('test', 4, country='us'))
+        self.assertNotIn('us', subset.full_countries)
+
+    def test_language_caps(self):
+        subset = Subset(max_rows_per_language=1)
+        self.assertIsNone(subset.full_countries)
+        self.assertTrue(subset.accept_row('us', 'en'))
+        self.assertFalse(subset.accept_row('gb', 'en'))
+        self.assertTrue(subset.accept_row('us', 'es'))
+
+    def test_full_countries_in_forked_process(self):
+        subset = Subset(max_rows_per_country=1)
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(write_fd)
+            # Wait for the parent to fill the country
+            os.read(read_fd, 1)
+            skipped = subset.skip('test', 1, country='fr') and not subset.skip('test', 2, country='de')
+            os._exit(0 if skipped and subset.country_rows['fr'] == 0 else 1)
+
+        os.close(read_fd)
+        self.assertTrue(subset.accept_row('fr', 'fr'))
+        os.write(write_fd, b'x')
+        os.close(write_fd)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def test_shared_country_set(self):
+        countries = SharedCountrySet()
+        countries.add('za')
+        countries.add('xyz')
+        countries.add(None)
+        self.assertIn('za', countries)
+        self.assertNotIn('zb', countries)
+        self.assertNotIn('xyz', countries)
+        self.assertNotIn(None, countries)
+        self.assertNotIn('Z1', countries)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+from geodata.training_data_writer import *
+
+
+rows = [
+    ('en', 'us', '123 Main St'),
+    ('de', 'de', None),
+    ('', None, 'Platz der Republik 1'),
+    (u'fr', 'fr', u'1 Rue de l\'\xc9glise'.encode('utf-8')),
+    ('en', 'gb', 10),
+]
+
+
+class TestShardedTSVWriter(unittest.TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def unsharded(self, rows):
+        filename = os.path.join(self.out_dir, 'unsharded.tsv')
+        writer = TSVWriter(filename)
+        writer.writerows(rows)
+        writer.close()
+        return open(filename).read()
+
+    def sharded(self, rows, **kw):
+        filename = os.path.join(self.out_dir, 'sharded.tsv')
+        writer = ShardedTSVWriter(filename, **kw)
+        writer.writerows(rows)
+        writer.close()
+        return b''.join(training_data_lines(filename))
+
+    def test_matches_unsharded(self):
+        expected = self.unsharded(rows * 10)
+        for codec in sorted(CODECS):
+            self.assertEqual(self.sharded(rows * 10, max_rows=7, codec=codec), expected)
+        self.assertEqual(self.sharded(rows * 10, max_bytes=100, block_size=10), expected)
+
+    def test_embedded_tab(self):
+        bad_rows = [('en', 'us', '123\tMain St')]
+        self.assertRaises(csv.Error, self.unsharded, bad_rows)
+        self.assertRaises(csv.Error, self.sharded, bad_rows)
+
+    def test_deduping(self):
+        filename = os.path.join(self.out_dir, 'deduped.tsv')
+        writer = DedupingWriter(ShardedTSVWriter(filename, max_rows=3), initial_capacity=100)
+        writer.writerows(rows + rows)
+        writer.writerow(('en', 'us', '123  Main St '))
+        writer.close()
+        self.assertEqual(writer.duplicates, len(rows) + 1)
+        self.assertEqual(writer.rows_written(), len(rows))
+        self.assertEqual(b''.join(training_data_lines(filename)), self.unsharded(rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
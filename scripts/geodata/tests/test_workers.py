@@ -0,0 +1,46 @@
+import os
+import unittest
+
+from geodata.workers import *
+
+
+class Squares(object):
+    def __init__(self, result_size=0):
+        self.result_size = result_size
+        self.count = 0
+
+    def square(self, x):
+        self.count += 1
+        return x * x
+
+    def worker_finished(self):
+        # Padded to more than a pipe buffer, the pool must read it before joining
+        return (os.getpid(), self.count, b'x' * self.result_size)
+
+
+class TestForkedWorkerPool(unittest.TestCase):
+    num_workers = 3
+
+    def check_teardown_results(self, pool, num_items):
+        self.assertEqual(len(pool.teardown_results), self.num_workers)
+        self.assertEqual(len(set([pid for pid, count, padding in pool.teardown_results])), self.num_workers)
+        self.assertEqual(sum([count for pid, count, padding in pool.teardown_results]), num_items)
+
+    def test_imap(self):
+        pool = ForkedWorkerPool(Squares(result_size=1 << 20), self.num_workers)
+        self.assertEqual(list(pool.imap('square', range(100), chunk_size=7)), [x * x for x in range(100)])
+        self.check_teardown_results(pool, 100)
+
+    def test_imap_unordered(self):
+        pool = ForkedWorkerPool(Squares(), self.num_workers)
+        self.assertEqual(sorted(pool.imap_unordered('square', range(20))), [x * x for x in range(20)])
+        self.check_teardown_results(pool, 20)
+
+    def test_no_teardown(self):
+        pool = ForkedWorkerPool(Squares(), self.num_workers, teardown_method=None)
+        self.assertEqual(list(pool.imap('square', range(10))), [x * x for x in range(10)])
+        self.assertEqual(pool.teardown_results, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
+import os
 import six
 
-from geodata.text import _normalize
-from geodata.text.tokenize import tokenize_raw
+from geodata.caching import LRUCache
+from geodata.text import _normalize, _tokenize
+from geodata.text.tokenize import tokenize_raw, array_from_bytes
 from geodata.text.token_types import token_types
 
 from geodata.encoding import safe_decode
@@ -46,6 +48,60 @@ TOKEN_OPTIONS_DROP_PERIODS = NORMALIZE_TOKEN_DELETE_FINAL_PERIOD | \
 DEFAULT_TOKEN_OPTIONS_NUMERIC = (DEFAULT_TOKEN_OPTIONS | NORMALIZE_TOKEN_SPLIT_ALPHA_FROM_NUMERIC)
 
 
+DEFAULT_NORMALIZE_CACHE_SIZE = 100000
+
+# Opt-in memo for normalize_string and normalized_tokens, see enable_cache
+normalize_cache = None
+normalize_cache_pid = None
+
+
+def enable_cache(size=DEFAULT_NORMALIZE_CACHE_SIZE):
+    '''
+    Memoizes normalize_string and normalized_tokens for the rest of the
+    process in an LRU cache of at most size entries.
+
+    Results are shared between callers, so while the cache is enabled
+    normalized_tokens returns a tuple of (token, token_type) tuples instead
+    of a list.
+    '''
+    global normalize_cache, normalize_cache_pid
+    normalize_cache = LRUCache(size, name='normalize')
+    normalize_cache_pid = os.getpid()
+
+
+def disable_cache():
+    global normalize_cache, normalize_cache_pid
+    normalize_cache = None
+    normalize_cache_pid = None
+
+
+def process_cache():
+    '''The memo for the current process, or None if caching is disabled'''
+    global normalize_cache_pid
+    if normalize_cache is not None and normalize_cache_pid != os.getpid():
+        # Inherited on fork. The entries are still valid, but the stats
+        # should only count this process' lookups
+        normalize_cache.reset_stats()
+        normalize_cache_pid = os.getpid()
+    return normalize_cache
+
+
+def cache_stats():
+    cache = process_cache()
+    if cache is None:
+        return {}
+    return {'normalize': cache.stats()}
+
+
+def normalizer_version():
+    '''
+    Identifies the build of the _normalize extension (and the data compiled
+    into it), for keying files derived from its output
+    '''
+    st = os.stat(_normalize.__file__)
+    return '{}:{}'.format(st.st_size, int(st.st_mtime))
+
+
 def remove_parens(tokens):
     new_tokens = []
     open_parens = 0
@@ -62,14 +118,30 @@ def remove_parens(tokens):
 
 def normalize_string(s, string_options=DEFAULT_STRING_OPTIONS):
     s = safe_decode(s)
+
+    cache = process_cache()
+    if cache is not None:
+        key = (s, string_options)
+        normalized = cache.get(key)
+        if normalized is not None:
+            return normalized
+
     if string_options & _normalize.NORMALIZE_STRING_LATIN_ASCII:
         normalized = _normalize.normalize_string_latin(s, string_options)
     else:
         normalized = _normalize.normalize_string_utf8(s, string_options)
 
+    if cache is not None and normalized is not None:
+        cache[key] = normalized
+
     return normalized
 
 
+def normalize_strings(strings, string_options=DEFAULT_STRING_OPTIONS):
+    '''Batch version of normalize_string, with None where normalization failed'''
+    return _normalize.normalize_strings([safe_decode(s) for s in strings], string_options)
+
+
 def normalize_token(s, t, token_options=DEFAULT_TOKEN_OPTIONS):
     return _normalize.normalize_token(s, t, token_options)
 
@@ -105,12 +177,27 @@ def normalized_tokens(s, string_options=DEFAULT_STRING_OPTIONS,
     Usage:
         normalized_tokens(u'St.-Barthélemy')
     '''
+    cache = process_cache()
+    if cache is None:
+        return normalized_tokens_uncached(s, string_options=string_options, token_options=token_options,
+                                          strip_parentheticals=strip_parentheticals, whitespace=whitespace)
+
+    key = (safe_decode(s), string_options, token_options, strip_parentheticals, whitespace)
+    tokens = cache.get(key)
+    if tokens is None:
+        tokens = tuple(normalized_tokens_uncached(s, string_options=string_options, token_options=token_options,
+                                                  strip_parentheticals=strip_parentheticals, whitespace=whitespace))
+        cache[key] = tokens
+    return tokens
+
+
+def normalized_tokens_uncached(s, string_options=DEFAULT_STRING_OPTIONS,
+                               token_options=DEFAULT_TOKEN_OPTIONS,
+                               strip_parentheticals=True, whitespace=False):
     normalized = normalize_string(s, string_options=string_options)
 
     # Tuples of (offset, len, type)
     raw_tokens = tokenize_raw(normalized)
-    tokens = []
-    last_end = 0
 
     if not whitespace:
         tokens = [(_normalize.normalize_token(normalized, t, token_options),
@@ -122,3 +209,60 @@ def normalized_tokens(s, string_options=DEFAULT_STRING_OPTIONS,
         return remove_parens(tokens)
     else:
         return tokens
+
+
+def normalized_tokens_many(strings, string_options=DEFAULT_STRING_OPTIONS,
+                           token_options=DEFAULT_TOKEN_OPTIONS,
+                           strip_parentheticals=True, whitespace=False):
+    '''
+    Batch version of normalized_tokens. String normalization, tokenization
+    and token normalization for all the strings each happen in one call to
+    the C extensions, which avoids the per-string and per-token overhead of
+    crossing into C.
+
+    Returns one list of (token, token_type) per input string.
+
+    Usage:
+        normalized_tokens_many([u'St.-Barthélemy', u'Rue de la Paix'])
+    '''
+    normalized = [n if n is not None else u'' for n in normalize_strings(strings, string_options=string_options)]
+    offsets, lengths, types, string_indices = _tokenize.tokenize_many(normalized)
+    token_strings = _normalize.normalize_tokens_many(normalized, offsets, lengths, types, string_indices, token_options)
+
+    offsets = array_from_bytes('I', offsets)
+    lengths = array_from_bytes('I', lengths)
+    types = array_from_bytes('H', types)
+    string_indices = array_from_bytes('I', string_indices)
+
+    # Parentheticals are stripped here on the type ids, with the same
+    # result as remove_parens, which compares EnumValues and is much slower
+    punct_open = token_types.PUNCT_OPEN.value
+    punct_close = token_types.PUNCT_CLOSE.value
+    whitespace_token = (six.u(' '), token_types.WHITESPACE)
+    from_id = token_types.from_id
+
+    all_tokens = [[] for s in strings]
+    last_ends = [0] * len(strings)
+    open_parens = [0] * len(strings)
+
+    for t_norm, start, length, token_type, i in zip(token_strings, offsets, lengths, types, string_indices):
+        tokens = all_tokens[i]
+        if whitespace:
+            if last_ends[i] < start and (not strip_parentheticals or open_parens[i] <= 0):
+                tokens.append(whitespace_token)
+            last_ends[i] = start + length
+
+        if strip_parentheticals:
+            if token_type == punct_open:
+                open_parens[i] += 1
+                continue
+            elif token_type == punct_close:
+                if open_parens[i] > 0:
+                    open_parens[i] -= 1
+                continue
+            elif open_parens[i] > 0:
+                continue
+
+        tokens.append((t_norm, from_id(token_type)))
+
+    return all_tokens
@@ -1,10 +1,44 @@
 import six
 
-from collections import *
 from marisa_trie import BytesTrie
 from geodata.encoding import safe_encode, safe_decode
 
-SENTINEL = None
+# Key under which a TokenTrie node stores the phrase ending there
+PHRASE_END = None
+
+
+class TokenTrie(object):
+    '''
+    Trie over the space-separated tokens (rather than the characters) of a
+    PhraseFilter's keys. Nodes are dicts of token => child node, and a node
+    where a phrase ends stores the full key under PHRASE_END, which is used
+    to look up the phrase's values in the PhraseFilter's BytesTrie.
+    '''
+    def __init__(self, keys):
+        self.root = {}
+        for key in keys:
+            node = self.root
+            for t in key.split(u' '):
+                node = node.setdefault(t, {})
+            node[PHRASE_END] = key
+
+    def longest_match(self, token_string, start, end):
+        '''
+        Longest phrase starting at token index start, as (end index, key),
+        or (None, None) if no phrase starts there
+        '''
+        node = self.root
+        match_end = None
+        match_key = None
+        for i in xrange(start, end):
+            node = node.get(token_string(i))
+            if node is None:
+                break
+            key = node.get(PHRASE_END)
+            if key is not None:
+                match_end = i + 1
+                match_key = key
+        return match_end, match_key
 
 
 class PhraseFilter(object):
@@ -17,59 +51,40 @@ class PhraseFilter(object):
     serialize = staticmethod(safe_encode)
     deserialize = staticmethod(safe_decode)
 
-    def filter(self, tokens):
-        def return_item(item):
-            return False, item, []
+    token_trie = None
+
+    def get_token_trie(self):
+        if self.token_trie is None:
+            self.token_trie = TokenTrie(self.trie.iterkeys())
+        return self.token_trie
 
+    def filter(self, tokens):
+        '''
+        Yields (True, phrase_tokens, data) for the longest dictionary phrases
+        in tokens, and (False, token, []) for tokens outside any phrase.
+
+        tokens is a sequence of (token, token_type) tuples or a TokenView.
+        Phrases are matched leftmost-longest in a single pass using a trie
+        over whole tokens, so no candidate strings are joined and nothing is
+        re-queried after a failed match.
+        '''
         if not tokens:
             return
 
-        ent = []
-        ent_tokens = []
-
-        queue = deque(tokens + [(SENTINEL,) * 2])
-        skip_until = 0
+        token_string = getattr(tokens, 'token', None)
+        if token_string is None:
+            token_string = lambda i: tokens[i][0]
 
+        token_trie = self.get_token_trie()
         trie = self.trie
-
-        while queue:
-            item = queue.popleft()
-            t, c = item
-
-            if t is not SENTINEL and trie.has_keys_with_prefix(u' '.join(ent_tokens + [t])):
-                ent.append(item)
-                ent_tokens.append(item[0])
-            elif ent_tokens:
-                res = trie.get(u' '.join(ent_tokens)) or None
-                if res is not None:
-                    yield (True, ent, map(self.deserialize, res))
-                    queue.appendleft(item)
-                    ent = []
-                    ent_tokens = []
-                elif len(ent_tokens) == 1:
-                    yield return_item(ent[0])
-                    ent = []
-                    ent_tokens = []
-                    queue.appendleft(item)
-                else:
-                    have_phrase = False
-
-                    for i in xrange(len(ent) - 1, 0, -1):
-                        remainder = ent[i:]
-                        res = trie.get(u' '.join([e[0] for e in ent[:i]])) or None
-                        if res is not None:
-                            yield (True, ent[:i], map(self.deserialize, res))
-                            have_phrase = True
-                            break
-
-                    if not have_phrase:
-                        yield return_item(ent[0])
-
-                    todos = list(remainder)
-                    todos.append(item)
-                    queue.extendleft(reversed(todos))
-
-                    ent = []
-                    ent_tokens = []
-            elif t is not SENTINEL:
-                yield return_item(item)
+        num_tokens = len(tokens)
+
+        i = 0
+        while i < num_tokens:
+            end, key = token_trie.longest_match(token_string, i, num_tokens)
+            if key is not None:
+                yield (True, tokens[i:end], map(self.deserialize, trie.get(key)))
+                i = end
+            else:
+                yield (False, tokens[i], [])
+                i += 1
@@ -234,10 +234,252 @@ exit_decref_unistr:
     return 0;
 }
 
+static char *normalize_string_with_options(char *input, uint64_t options) {
+    if (options & NORMALIZE_STRING_LATIN_ASCII) {
+        return normalize_string_latin(input, strlen(input), options);
+    } else {
+        return normalize_string_utf8(input, options);
+    }
+}
+
+
+/*
+Normalizes every string in a sequence in one call, choosing the Latin-ASCII
+or UTF-8 normalizer from the options the same way normalize_string does.
+Returns a list of unicode strings, with None where normalization failed.
+*/
+static PyObject *py_normalize_strings(PyObject *self, PyObject *args)
+{
+    PyObject *arg1;
+    uint64_t options;
+    if (!PyArg_ParseTuple(args, "OK:normalize_strings", &arg1, &options)) {
+        return 0;
+    }
+
+    PyObject *seq = PySequence_Fast(arg1, "Parameter must be a sequence of strings");
+    if (seq == NULL) {
+        return 0;
+    }
+
+    Py_ssize_t num_strings = PySequence_Fast_GET_SIZE(seq);
+
+    PyObject *result = PyList_New(num_strings);
+    if (result == NULL) {
+        goto exit_decref_seq;
+    }
+
+    for (Py_ssize_t i = 0; i < num_strings; i++) {
+        PyObject *unistr = PyUnicode_FromObject(PySequence_Fast_GET_ITEM(seq, i));
+        if (unistr == NULL) {
+            PyErr_SetString(PyExc_TypeError,
+                            "Parameter could not be converted to unicode in scanner");
+            goto exit_decref_result;
+        }
+
+        #ifdef IS_PY3K
+            char *input = PyUnicode_AsUTF8(unistr);
+        #else
+            PyObject *str = PyUnicode_AsEncodedString(unistr, "utf-8", "strict");
+            if (str == NULL) {
+                PyErr_SetString(PyExc_TypeError,
+                                "Parameter could not be utf-8 encoded");
+                Py_DECREF(unistr);
+                goto exit_decref_result;
+            }
+            char *input = PyBytes_AsString(str);
+        #endif
+
+        char *normalized = NULL;
+        if (input != NULL) {
+            normalized = normalize_string_with_options(input, options);
+        }
+
+        #ifndef IS_PY3K
+        Py_XDECREF(str);
+        #endif
+        Py_DECREF(unistr);
+
+        PyObject *item;
+        if (normalized == NULL) {
+            Py_INCREF(Py_None);
+            item = Py_None;
+        } else {
+            item = PyUnicode_DecodeUTF8((const char *)normalized, strlen(normalized), "strict");
+            free(normalized);
+            if (item == NULL) {
+                PyErr_SetString(PyExc_ValueError,
+                                "Result could not be utf-8 decoded");
+                goto exit_decref_result;
+            }
+        }
+
+        PyList_SET_ITEM(result, i, item);
+    }
+
+    Py_DECREF(seq);
+    return result;
+
+exit_decref_result:
+    Py_DECREF(result);
+exit_decref_seq:
+    Py_DECREF(seq);
+    return 0;
+}
+
+
+/*
+Normalizes every token of a batch of strings in one call. The tokens are
+given as the four buffers returned by _tokenize.tokenize_many for the same
+strings: offsets and lengths (uint32) into each UTF-8 encoded string, token
+types (uint16) and the index of the string each token is in (uint32), with
+the indices in ascending order. Returns a list of normalized token strings,
+one per token, as normalize_token would return for each.
+*/
+static PyObject *py_normalize_tokens_many(PyObject *self, PyObject *args)
+{
+    PyObject *arg1;
+    PyObject *offsets_arg, *lengths_arg, *types_arg, *indices_arg;
+    uint64_t options;
+    if (!PyArg_ParseTuple(args, "OOOOOK:normalize_tokens_many", &arg1, &offsets_arg, &lengths_arg,
+                          &types_arg, &indices_arg, &options)) {
+        return 0;
+    }
+
+    char *offsets_buf, *lengths_buf, *types_buf, *indices_buf;
+    Py_ssize_t offsets_size, lengths_size, types_size, indices_size;
+    if (PyBytes_AsStringAndSize(offsets_arg, &offsets_buf, &offsets_size) < 0 ||
+        PyBytes_AsStringAndSize(lengths_arg, &lengths_buf, &lengths_size) < 0 ||
+        PyBytes_AsStringAndSize(types_arg, &types_buf, &types_size) < 0 ||
+        PyBytes_AsStringAndSize(indices_arg, &indices_buf, &indices_size) < 0) {
+        return 0;
+    }
+
+    Py_ssize_t n = offsets_size / (Py_ssize_t)sizeof(uint32_t);
+    if (offsets_size != n * (Py_ssize_t)sizeof(uint32_t) ||
+        lengths_size != n * (Py_ssize_t)sizeof(uint32_t) ||
+        types_size != n * (Py_ssize_t)sizeof(uint16_t) ||
+        indices_size != n * (Py_ssize_t)sizeof(uint32_t)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Token buffers must all have the same number of tokens");
+        return 0;
+    }
+
+    uint32_t *offsets = (uint32_t *)offsets_buf;
+    uint32_t *lengths = (uint32_t *)lengths_buf;
+    uint16_t *types = (uint16_t *)types_buf;
+    uint32_t *string_indices = (uint32_t *)indices_buf;
+
+    PyObject *seq = PySequence_Fast(arg1, "Parameter must be a sequence of strings");
+    if (seq == NULL) {
+        return 0;
+    }
+
+    Py_ssize_t num_strings = PySequence_Fast_GET_SIZE(seq);
+
+    PyObject *result = PyList_New(n);
+    char_array *token_buffer = char_array_new();
+    if (result == NULL || token_buffer == NULL) {
+        if (result != NULL) PyErr_NoMemory();
+        goto exit_destroy;
+    }
+
+    // Each string is encoded once, when its first token is reached
+    Py_ssize_t current = -1;
+    PyObject *unistr = NULL;
+    #ifndef IS_PY3K
+    PyObject *str = NULL;
+    #endif
+    char *input = NULL;
+    size_t input_len = 0;
+
+    for (Py_ssize_t j = 0; j < n; j++) {
+        Py_ssize_t i = (Py_ssize_t)string_indices[j];
+        if (i != current) {
+            if (i < current || i >= num_strings) {
+                PyErr_SetString(PyExc_ValueError,
+                                "Token string indices must be ascending and within the sequence");
+                goto exit_release_input;
+            }
+
+            #ifndef IS_PY3K
+            Py_CLEAR(str);
+            #endif
+            Py_CLEAR(unistr);
+            current = i;
+
+            unistr = PyUnicode_FromObject(PySequence_Fast_GET_ITEM(seq, i));
+            if (unistr == NULL) {
+                PyErr_SetString(PyExc_TypeError,
+                                "Parameter could not be converted to unicode in scanner");
+                goto exit_release_input;
+            }
+
+            #ifdef IS_PY3K
+                input = PyUnicode_AsUTF8(unistr);
+            #else
+                str = PyUnicode_AsEncodedString(unistr, "utf-8", "strict");
+                if (str == NULL) {
+                    PyErr_SetString(PyExc_TypeError,
+                                    "Parameter could not be utf-8 encoded");
+                    goto exit_release_input;
+                }
+                input = PyBytes_AsString(str);
+            #endif
+
+            if (input == NULL) {
+                goto exit_release_input;
+            }
+            input_len = strlen(input);
+        }
+
+        if ((size_t)offsets[j] + (size_t)lengths[j] > input_len) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Token is out of range of its string");
+            goto exit_release_input;
+        }
+
+        token_t token = (token_t){(size_t)offsets[j], (size_t)lengths[j], types[j]};
+
+        char_array_clear(token_buffer);
+        add_normalized_token(token_buffer, input, token, options);
+        char *token_str = char_array_get_string(token_buffer);
+
+        PyObject *token_unicode = PyUnicode_DecodeUTF8((const char *)token_str, token_buffer->n - 1, "strict");
+        if (token_unicode == NULL) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Error decoding token");
+            goto exit_release_input;
+        }
+
+        PyList_SET_ITEM(result, j, token_unicode);
+    }
+
+    #ifndef IS_PY3K
+    Py_XDECREF(str);
+    #endif
+    Py_XDECREF(unistr);
+    char_array_destroy(token_buffer);
+    Py_DECREF(seq);
+    return result;
+
+exit_release_input:
+    #ifndef IS_PY3K
+    Py_XDECREF(str);
+    #endif
+    Py_XDECREF(unistr);
+exit_destroy:
+    if (token_buffer != NULL) char_array_destroy(token_buffer);
+    Py_XDECREF(result);
+    Py_DECREF(seq);
+    return 0;
+}
+
 static PyMethodDef normalize_methods[] = {
     {"normalize_string_utf8", (PyCFunction)py_normalize_string_utf8, METH_VARARGS, "normalize_string_utf8(input, options)"},
     {"normalize_string_latin", (PyCFunction)py_normalize_string_latin, METH_VARARGS, "normalize_string_latin(input, options)"},
     {"normalize_token", (PyCFunction)py_normalize_token, METH_VARARGS, "normalize_token(input, options)"},
+    {"normalize_strings", (PyCFunction)py_normalize_strings, METH_VARARGS, "normalize_strings(inputs, options)"},
+    {"normalize_tokens_many", (PyCFunction)py_normalize_tokens_many, METH_VARARGS, "normalize_tokens_many(inputs, offsets, lengths, types, string_indices, options)"},
     {NULL, NULL},
 };
 
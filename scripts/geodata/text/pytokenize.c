@@ -99,8 +99,130 @@ error_decref_unistr:
     return 0;
 }
 
+/*
+Tokenizes every string in a sequence in one call. Returns a tuple of four
+byte strings holding flat native-endian arrays, one entry per token:
+offsets (uint32), lengths (uint32), types (uint16) and the index of the
+string each token came from (uint32). Offsets and lengths are in bytes of
+the UTF-8 encoded string, as in tokenize.
+*/
+static PyObject *py_tokenize_many(PyObject *self, PyObject *args)
+{
+    PyObject *arg1;
+    if (!PyArg_ParseTuple(args, "O:tokenize_many", &arg1)) {
+        return 0;
+    }
+
+    PyObject *seq = PySequence_Fast(arg1, "Parameter must be a sequence of strings");
+    if (seq == NULL) {
+        return 0;
+    }
+
+    Py_ssize_t num_strings = PySequence_Fast_GET_SIZE(seq);
+
+    token_array *tokens = token_array_new();
+    uint32_array *string_indices = uint32_array_new();
+    if (tokens == NULL || string_indices == NULL) {
+        PyErr_NoMemory();
+        goto error_destroy_arrays;
+    }
+
+    for (Py_ssize_t i = 0; i < num_strings; i++) {
+        PyObject *unistr = PyUnicode_FromObject(PySequence_Fast_GET_ITEM(seq, i));
+        if (unistr == NULL) {
+            PyErr_SetString(PyExc_TypeError,
+                            "Parameter could not be converted to unicode in scanner");
+            goto error_destroy_arrays;
+        }
+
+        #ifdef IS_PY3K
+            char *input = PyUnicode_AsUTF8(unistr);
+        #else
+            PyObject *str = PyUnicode_AsEncodedString(unistr, "utf-8", "strict");
+            if (str == NULL) {
+                PyErr_SetString(PyExc_TypeError,
+                                "Parameter could not be utf-8 encoded");
+                Py_DECREF(unistr);
+                goto error_destroy_arrays;
+            }
+            char *input = PyBytes_AsString(str);
+        #endif
+
+        if (input == NULL) {
+            #ifndef IS_PY3K
+            Py_XDECREF(str);
+            #endif
+            Py_DECREF(unistr);
+            goto error_destroy_arrays;
+        }
+
+        size_t num_before = tokens->n;
+        tokenize_add_tokens(tokens, (const char *)input, strlen(input), false);
+        for (size_t j = num_before; j < tokens->n; j++) {
+            uint32_array_push(string_indices, (uint32_t)i);
+        }
+
+        #ifndef IS_PY3K
+        Py_XDECREF(str);
+        #endif
+        Py_DECREF(unistr);
+    }
+
+    size_t n = tokens->n;
+
+    uint32_t *offsets = malloc(n * sizeof(uint32_t) + 1);
+    uint32_t *lengths = malloc(n * sizeof(uint32_t) + 1);
+    uint16_t *types = malloc(n * sizeof(uint16_t) + 1);
+    if (offsets == NULL || lengths == NULL || types == NULL) {
+        PyErr_NoMemory();
+        goto error_free_buffers;
+    }
+
+    for (size_t j = 0; j < n; j++) {
+        token_t token = tokens->a[j];
+        offsets[j] = (uint32_t)token.offset;
+        lengths[j] = (uint32_t)token.len;
+        types[j] = token.type;
+    }
+
+    PyObject *offsets_bytes = PyBytes_FromStringAndSize((const char *)offsets, (Py_ssize_t)(n * sizeof(uint32_t)));
+    PyObject *lengths_bytes = PyBytes_FromStringAndSize((const char *)lengths, (Py_ssize_t)(n * sizeof(uint32_t)));
+    PyObject *types_bytes = PyBytes_FromStringAndSize((const char *)types, (Py_ssize_t)(n * sizeof(uint16_t)));
+    PyObject *indices_bytes = PyBytes_FromStringAndSize((const char *)string_indices->a, (Py_ssize_t)(n * sizeof(uint32_t)));
+
+    PyObject *result = NULL;
+    if (offsets_bytes != NULL && lengths_bytes != NULL && types_bytes != NULL && indices_bytes != NULL) {
+        result = PyTuple_Pack(4, offsets_bytes, lengths_bytes, types_bytes, indices_bytes);
+    }
+
+    Py_XDECREF(offsets_bytes);
+    Py_XDECREF(lengths_bytes);
+    Py_XDECREF(types_bytes);
+    Py_XDECREF(indices_bytes);
+
+    free(offsets);
+    free(lengths);
+    free(types);
+    token_array_destroy(tokens);
+    uint32_array_destroy(string_indices);
+    Py_DECREF(seq);
+
+    return result;
+
+error_free_buffers:
+    free(offsets);
+    free(lengths);
+    free(types);
+error_destroy_arrays:
+    if (tokens != NULL) token_array_destroy(tokens);
+    if (string_indices != NULL) uint32_array_destroy(string_indices);
+    Py_DECREF(seq);
+    return 0;
+}
+
 static PyMethodDef tokenize_methods[] = {
     {"tokenize", (PyCFunction)py_tokenize, METH_VARARGS, "tokenize(text)"},
+    {"tokenize_many", (PyCFunction)py_tokenize_many, METH_VARARGS, "tokenize_many(texts)"},
     {NULL, NULL},
 };
 
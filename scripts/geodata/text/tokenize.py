@@ -1,3 +1,7 @@
+import six
+
+from array import array
+
 from geodata.encoding import safe_encode, safe_decode
 from geodata.text import _tokenize
 from geodata.text.token_types import token_types
@@ -12,3 +16,130 @@ def tokenize(s):
     s = safe_encode(s)
     return [(safe_decode(s[start:start + length]), token_types.from_id(token_type))
             for start, length, token_type in _tokenize.tokenize(u)]
+
+
+def array_from_bytes(typecode, b):
+    a = array(typecode)
+    if hasattr(a, 'frombytes'):
+        a.frombytes(b)
+    else:
+        a.fromstring(b)
+    return a
+
+
+def tokenize_many_raw(strings):
+    '''
+    Tokenizes a sequence of strings in one call to the C tokenizer.
+
+    Returns arrays of (offsets, lengths, types, string_indices) with one
+    entry per token, offsets/lengths being into each UTF-8 encoded string
+    '''
+    offsets, lengths, types, string_indices = _tokenize.tokenize_many([safe_decode(s) for s in strings])
+    return (array_from_bytes('I', offsets), array_from_bytes('I', lengths),
+            array_from_bytes('H', types), array_from_bytes('I', string_indices))
+
+
+def tokenize_many(strings):
+    '''Batch version of tokenize, returns one list of (token, token_type) per string'''
+    encoded = [safe_encode(s) for s in strings]
+    offsets, lengths, types, string_indices = tokenize_many_raw(encoded)
+    from_id = token_types.from_id
+    tokens = [[] for s in encoded]
+    for start, length, token_type, i in zip(offsets, lengths, types, string_indices):
+        tokens[i].append((encoded[i][start:start + length].decode('utf-8'), from_id(token_type)))
+    return tokens
+
+
+WORD_TOKEN_TYPE_IDS = frozenset([t.value for t in token_types.WORD_TOKEN_TYPES])
+
+
+class TokenView(object):
+    '''
+    Tokens of a string as flat arrays of byte offsets, lengths and token type
+    ids into the UTF-8 encoded string, as returned by the tokenizer.
+
+    Indexing returns (token, token_type) like tokenize, but token strings
+    are only decoded for the tokens which are actually accessed. Callers
+    which only look at token types, or keep a subset of the tokens, never
+    create the other strings.
+    '''
+    __slots__ = ('s', 'offsets', 'lengths', 'types')
+
+    def __init__(self, s, offsets, lengths, types):
+        self.s = safe_encode(s)
+        self.offsets = offsets
+        self.lengths = lengths
+        self.types = types
+
+    def __len__(self):
+        return len(self.types)
+
+    def token(self, i):
+        start = self.offsets[i]
+        return safe_decode(self.s[start:start + self.lengths[i]])
+
+    def token_type(self, i):
+        return token_types.from_id(self.types[i])
+
+    def raw(self, i):
+        '''(offset, length, type) as returned by tokenize_raw'''
+        return (self.offsets[i], self.lengths[i], self.types[i])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in six.moves.range(*i.indices(len(self)))]
+        return (self.token(i), self.token_type(i))
+
+    def __iter__(self):
+        for i in six.moves.range(len(self)):
+            yield self[i]
+
+    def strings(self):
+        return [self.token(i) for i in six.moves.range(len(self))]
+
+    def take(self, indices):
+        '''New view of the same string with only the tokens at indices'''
+        offsets, lengths, types = self.offsets, self.lengths, self.types
+        return TokenView(self.s,
+                         array('I', [offsets[i] for i in indices]),
+                         array('I', [lengths[i] for i in indices]),
+                         array('H', [types[i] for i in indices]))
+
+    def with_types(self, type_ids):
+        return self.take([i for i, t in enumerate(self.types) if t in type_ids])
+
+    def words(self):
+        return self.with_types(WORD_TOKEN_TYPE_IDS)
+
+    def without_parentheticals(self):
+        '''Drops parentheses and the tokens inside them, as in normalize.remove_parens'''
+        punct_open = token_types.PUNCT_OPEN.value
+        punct_close = token_types.PUNCT_CLOSE.value
+
+        indices = []
+        open_parens = 0
+        for i, t in enumerate(self.types):
+            if t == punct_open:
+                open_parens += 1
+            elif t == punct_close:
+                if open_parens > 0:
+                    open_parens -= 1
+            elif open_parens <= 0:
+                indices.append(i)
+        return self.take(indices)
+
+
+def token_view(s):
+    '''
+    TokenView of a string, without creating a Python object per token
+    (unless the extension was built without tokenize_many)
+    '''
+    s = safe_encode(s)
+    if not hasattr(_tokenize, 'tokenize_many'):
+        raw_tokens = _tokenize.tokenize(safe_decode(s))
+        return TokenView(s, array('I', [t[0] for t in raw_tokens]), array('I', [t[1] for t in raw_tokens]),
+                         array('H', [t[2] for t in raw_tokens]))
+
+    offsets, lengths, types, string_indices = _tokenize.tokenize_many([safe_decode(s)])
+    return TokenView(s, array_from_bytes('I', offsets), array_from_bytes('I', lengths),
+                     array_from_bytes('H', types))
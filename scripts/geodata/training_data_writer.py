@@ -0,0 +1,411 @@
+'''
+Output layer for the training data builders
+
+By default a builder writes one uncompressed TSV, same as always. With shard
+options, rows go to a ShardedTSVWriter instead, which:
+
+- buffers rows into large blocks rather than writing row by row
+- compresses blocks in a background thread (zlib and bz2 release the GIL,
+  so compression overlaps with formatting)
+- starts a new shard every max_rows rows or max_bytes uncompressed bytes
+- writes a JSON manifest listing each shard with its row count, sizes and
+  SHA-1, so consumers can read (and verify) the shards in parallel
+
+Usage:
+
+    writer = training_data_writer(os.path.join(out_dir, 'formatted_addresses_tagged.tsv'),
+                                  shard_options={'max_rows': 10000000})
+    writer.writerow((language, country, formatted_address))
+    writer.close()
+
+which writes formatted_addresses_tagged.00000.tsv.gz, ... and
+formatted_addresses_tagged.manifest.json.
+
+With dedupe options, rows which have already been written (after
+normalizing whitespace) are dropped, see DedupingWriter.
+'''
+import bz2
+import csv
+import gzip
+import hashlib
+import os
+import re
+import threading
+import ujson as json
+import zlib
+
+from six.moves import queue
+
+# Registers the tsv_no_quote dialect
+import geodata.csv_utils
+
+from geodata.encoding import safe_encode
+from geodata.math.bloom import ScalableBloomFilter
+
+DEFAULT_CODEC = 'gzip'
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_COMPRESSION_LEVEL = 6
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+DEFAULT_DEDUPE_ERROR_RATE = 0.001
+DEFAULT_DEDUPE_INITIAL_CAPACITY = 10000000
+DEFAULT_DEDUPE_MAX_MEMORY = 4 * 1024 * 1024 * 1024
+
+
+class IdentityCompressor(object):
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+def gzip_compressor():
+    # wbits offset by 16 writes a gzip header/trailer so the shards can be read with zcat, gzip.open, etc.
+    return zlib.compressobj(DEFAULT_COMPRESSION_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+
+CODECS = {
+    'gzip': (gzip_compressor, '.gz'),
+    'bz2': (bz2.BZ2Compressor, '.bz2'),
+    'none': (IdentityCompressor, ''),
+}
+
+
+class TSVWriter(object):
+    '''Plain, unsharded output, with the same interface as ShardedTSVWriter'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, 'w')
+        self.writer = csv.writer(self.f, 'tsv_no_quote')
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+
+    def writelines(self, lines):
+        self.f.writelines(lines)
+
+    def close(self):
+        self.f.close()
+
+
+class ShardedTSVWriter(object):
+    def __init__(self, filename, max_rows=None, max_bytes=None, codec=DEFAULT_CODEC,
+                 block_size=DEFAULT_BLOCK_SIZE, max_pending_blocks=4):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec {}, options: {}'.format(codec, ', '.join(sorted(CODECS))))
+
+        self.out_dir = os.path.dirname(filename)
+        self.prefix = os.path.basename(filename)
+        if self.prefix.endswith('.tsv'):
+            self.prefix = self.prefix[:-len('.tsv')]
+
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.compressor_class, self.extension = CODECS[codec]
+        self.block_size = block_size
+
+        # Filled in by the compression thread as each shard is closed
+        self.shards = []
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=max_pending_blocks)
+        self.thread = threading.Thread(target=self.compress_shards)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.block = []
+        self.block_bytes = 0
+        self.block_rows = 0
+
+        self.num_shards = 0
+        self.shard_rows = 0
+        self.shard_bytes = 0
+        self.shard_open = False
+
+        # Rows are formatted by csv.writer exactly as in TSVWriter, so shards
+        # concatenate to the unsharded file. It calls self.write once per row.
+        self.writer = csv.writer(self, 'tsv_no_quote')
+
+    def shard_filename(self, shard_num):
+        return '{}.{:05d}.tsv{}'.format(self.prefix, shard_num, self.extension)
+
+    def manifest_filename(self):
+        return os.path.join(self.out_dir, self.prefix + MANIFEST_SUFFIX)
+
+    def compress_shards(self):
+        f = compressor = checksum = entry = None
+        while True:
+            op, value, num_rows = self.queue.get()
+            if op == 'stop':
+                break
+            # After an error keep draining the queue so the writer never blocks
+            if self.error is not None:
+                continue
+
+            try:
+                if op == 'open':
+                    f = open(os.path.join(self.out_dir, value), 'wb')
+                    compressor = self.compressor_class()
+                    checksum = hashlib.sha1()
+                    entry = {'filename': value, 'rows': 0, 'bytes': 0, 'compressed_bytes': 0}
+                    continue
+                elif op == 'write':
+                    entry['rows'] += num_rows
+                    entry['bytes'] += len(value)
+                    data = compressor.compress(value)
+                else:
+                    data = compressor.flush()
+
+                if data:
+                    f.write(data)
+                    checksum.update(data)
+                    entry['compressed_bytes'] += len(data)
+
+                if op == 'close':
+                    f.close()
+                    entry['sha1'] = checksum.hexdigest()
+                    self.shards.append(entry)
+            except Exception as e:
+                self.error = e
+
+    def put(self, op, value=None, num_rows=0):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((op, value, num_rows))
+
+    def flush_block(self):
+        if self.block:
+            self.put('write', b''.join(self.block), self.block_rows)
+            self.block = []
+            self.block_bytes = 0
+            self.block_rows = 0
+
+    def close_shard(self):
+        self.flush_block()
+        self.put('close')
+        self.shard_open = False
+
+    def writeline(self, line):
+        if not self.shard_open:
+            self.put('open', self.shard_filename(self.num_shards))
+            self.num_shards += 1
+            self.shard_rows = 0
+            self.shard_bytes = 0
+            self.shard_open = True
+
+        self.block.append(line)
+        self.block_bytes += len(line)
+        self.block_rows += 1
+        self.shard_rows += 1
+        self.shard_bytes += len(line)
+
+        if (self.max_rows and self.shard_rows >= self.max_rows) or (self.max_bytes and self.shard_bytes >= self.max_bytes):
+            self.close_shard()
+        elif self.block_bytes >= self.block_size:
+            self.flush_block()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.writeline(line)
+
+    write = writeline
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def close(self):
+        if self.shard_open:
+            self.close_shard()
+        self.queue.put(('stop', None, 0))
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+        manifest = {
+            'codec': self.codec,
+            'rows': sum((s['rows'] for s in self.shards)),
+            'shards': self.shards,
+        }
+        with open(self.manifest_filename(), 'w') as f:
+            f.write(json.dumps(manifest, indent=2))
+
+        return manifest
+
+
+# Whitespace other than the field separator
+whitespace_regex = re.compile('[^\S\t]+')
+
+
+class DedupingWriter(object):
+    '''
+    Wraps a TSVWriter or ShardedTSVWriter and drops rows it has (probably)
+    written before. Seen rows are kept in a ScalableBloomFilter, so a
+    unique row is wrongly dropped with probability at most error_rate,
+    and memory stays under max_memory bytes (beyond which only recent
+    rows are deduplicated).
+    '''
+    def __init__(self, writer, error_rate=DEFAULT_DEDUPE_ERROR_RATE,
+                 initial_capacity=DEFAULT_DEDUPE_INITIAL_CAPACITY,
+                 max_memory=DEFAULT_DEDUPE_MAX_MEMORY):
+        self.writer = writer
+        self.seen = ScalableBloomFilter(initial_capacity=initial_capacity, error_rate=error_rate,
+                                        max_memory=max_memory)
+        self.rows = 0
+        self.duplicates = 0
+
+    def is_duplicate(self, key):
+        self.rows += 1
+        if self.seen.add(whitespace_regex.sub(b' ', key).strip()):
+            self.duplicates += 1
+            return True
+        return False
+
+    def writerow(self, row):
+        if not self.is_duplicate(b'\t'.join([safe_encode(f) if f is not None else b'' for f in row])):
+            self.writer.writerow(row)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def writelines(self, lines):
+        for line in lines:
+            if not self.is_duplicate(line):
+                self.writer.writelines((line,))
+
+    def rows_written(self):
+        return self.rows - self.duplicates
+
+    def dedupe_ratio(self):
+        if not self.rows:
+            return 0.0
+        return float(self.duplicates) / self.rows
+
+    def close(self):
+        print('dropped {} duplicates of {} rows ({:.2%}), bloom filter size={}MB'.format(
+              self.duplicates, self.rows, self.dedupe_ratio(), self.seen.memory() // (1024 * 1024)))
+        return self.writer.close()
+
+
+def training_data_writer(filename, shard_options=None, dedupe_options=None):
+    '''
+    Writer for one training set. shard_options, if given, is a dict of
+    keyword arguments for ShardedTSVWriter, and dedupe_options for
+    DedupingWriter.
+    '''
+    if shard_options is None:
+        writer = TSVWriter(filename)
+    else:
+        writer = ShardedTSVWriter(filename, **shard_options)
+
+    if dedupe_options is not None:
+        writer = DedupingWriter(writer, **dedupe_options)
+    return writer
+
+
+def read_manifest(filename):
+    '''
+    Manifest for a training set written with shards, or None. filename
+    is the unsharded name, e.g. out_dir/formatted_addresses_tagged.tsv
+    '''
+    prefix = filename[:-len('.tsv')] if filename.endswith('.tsv') else filename
+    manifest_filename = prefix + MANIFEST_SUFFIX
+    if not os.path.exists(manifest_filename):
+        return None
+    return json.load(open(manifest_filename))
+
+
+def training_data_exists(filename):
+    return os.path.exists(filename) or read_manifest(filename) is not None
+
+
+def training_data_size(filename):
+    '''Uncompressed size in bytes of a training set, sharded or not'''
+    if os.path.exists(filename):
+        return os.path.getsize(filename)
+    manifest = read_manifest(filename)
+    return sum((shard['bytes'] for shard in manifest['shards']))
+
+
+def training_data_lines(filename):
+    '''
+    Lines of a training set, from the plain TSV if there is one,
+    otherwise from its shards in order
+    '''
+    if os.path.exists(filename):
+        for line in open(filename):
+            yield line
+        return
+
+    manifest = read_manifest(filename)
+    if manifest is None:
+        raise IOError('No such training data: {}'.format(filename))
+
+    out_dir = os.path.dirname(filename)
+    for shard in manifest['shards']:
+        path = os.path.join(out_dir, shard['filename'])
+        if manifest['codec'] == 'gzip':
+            f = gzip.open(path)
+        elif manifest['codec'] == 'bz2':
+            f = bz2.BZ2File(path)
+        else:
+            f = open(path)
+        for line in f:
+            yield line
+        f.close()
+
+
+def add_shard_arguments(parser):
+    parser.add_argument('--shard-rows',
+                        type=int,
+                        default=None,
+                        help='Write compressed shards of at most this many rows plus a manifest, instead of one TSV')
+
+    parser.add_argument('--shard-bytes',
+                        type=int,
+                        default=None,
+                        help='Write compressed shards of at most this many uncompressed bytes plus a manifest, instead of one TSV')
+
+    parser.add_argument('--compression',
+                        default=DEFAULT_CODEC,
+                        choices=sorted(CODECS),
+                        help='Compression for shards')
+
+
+def shard_options_from_args(args):
+    if not (args.shard_rows or args.shard_bytes):
+        return None
+    return {'max_rows': args.shard_rows, 'max_bytes': args.shard_bytes, 'codec': args.compression}
+
+
+def add_dedupe_arguments(parser):
+    parser.add_argument('--dedupe',
+                        action='store_true',
+                        default=False,
+                        help='Drop duplicate rows using a bloom filter')
+
+    parser.add_argument('--dedupe-error-rate',
+                        type=float,
+                        default=DEFAULT_DEDUPE_ERROR_RATE,
+                        help='Maximum probability of dropping a row which is not a duplicate')
+
+    parser.add_argument('--dedupe-max-memory',
+                        type=int,
+                        default=DEFAULT_DEDUPE_MAX_MEMORY,
+                        help='Maximum bytes for the dedupe bloom filter, beyond which only recent rows are deduped')
+
+
+def dedupe_options_from_args(args):
+    if not args.dedupe:
+        return None
+    return {'error_rate': args.dedupe_error_rate, 'max_memory': args.dedupe_max_memory}
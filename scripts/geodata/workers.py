@@ -0,0 +1,300 @@
+'''
+Fork-based worker pools for the training data builders
+
+The builders hold several large read-only structures (reverse geocoding
+indexes, gazetteers, configs) which take minutes and many GB to load. Rather
+than loading them in every worker, the parent loads them once and forks, so
+the workers share those pages copy-on-write. Only the input records and the
+output rows cross the process boundary.
+'''
+import multiprocessing
+import multiprocessing.util
+import random
+import time
+
+from six.moves import queue
+from collections import defaultdict, deque, OrderedDict
+from itertools import islice
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# Set in each worker process by the pool initializer
+_worker_obj = None
+
+
+def batch_iter(iterable, batch_size):
+    source_iter = iter(iterable)
+    while True:
+        batch = list(islice(source_iter, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def _teardown_worker(obj, teardown_method, results):
+    result = None
+    try:
+        result = getattr(obj, teardown_method)()
+    finally:
+        # The parent waits for one result per worker
+        results.put(result)
+
+
+def _init_worker(obj, setup_method, teardown_method=None, teardown_results=None):
+    global _worker_obj
+    _worker_obj = obj
+
+    # Every worker inherits the parent's random state at fork time,
+    # so reseed or they'll all produce the same samples
+    random.seed()
+
+    if setup_method and hasattr(obj, setup_method):
+        getattr(obj, setup_method)()
+
+    # Runs when the worker exits after pool.close(), not on terminate()
+    if teardown_method and hasattr(obj, teardown_method):
+        multiprocessing.util.Finalize(obj, _teardown_worker, args=(obj, teardown_method, teardown_results), exitpriority=10)
+
+
+def _call_worker(args):
+    method_name, chunk, kw = args
+    method = getattr(_worker_obj, method_name)
+    return [method(item, **kw) for item in chunk]
+
+
+class ForkedWorkerPool(object):
+    '''
+    Pool of processes which each inherit obj at fork time and call one
+    of its methods on chunks of input.
+
+    setup_method, if obj has it, is called once in each worker after the
+    fork, e.g. to reopen file handles which can't be shared across processes.
+    teardown_method, if obj has it, is called as each worker exits, e.g. to
+    return per-process stats. After imap or imap_unordered has finished,
+    teardown_results holds what it returned in each worker, in no
+    particular order.
+
+    Usage:
+        pool = ForkedWorkerPool(osm_formatter, num_workers=8)
+        for rows in pool.imap('training_data_rows', records, tag_components=True):
+            ...
+    '''
+    pending_chunks_per_worker = 4
+    poll_interval = 1.0
+
+    def __init__(self, obj, num_workers, setup_method='reopen_indexes', teardown_method='worker_finished'):
+        self.obj = obj
+        self.num_workers = num_workers
+        self.setup_method = setup_method
+        self.teardown_method = teardown_method
+        self.teardown_results = []
+
+    def start_pool(self):
+        self.teardown_results = []
+        self.teardown_queue = multiprocessing.Queue()
+        return multiprocessing.Pool(self.num_workers, initializer=_init_worker,
+                                    initargs=(self.obj, self.setup_method, self.teardown_method, self.teardown_queue))
+
+    def finish_pool(self, pool, completed):
+        if completed:
+            pool.close()
+            self.collect_teardown_results(pool)
+        else:
+            pool.terminate()
+        pool.join()
+
+    def collect_teardown_results(self, pool):
+        '''
+        Reads each worker's teardown result as it exits. This has to happen
+        before joining the pool, a worker can't exit until its result has
+        been read if the result doesn't fit in the pipe buffer.
+        '''
+        if not (self.teardown_method and hasattr(self.obj, self.teardown_method)):
+            return
+
+        while len(self.teardown_results) < self.num_workers:
+            try:
+                self.teardown_results.append(self.teardown_queue.get(timeout=self.poll_interval))
+            except queue.Empty:
+                # Workers which died without tearing down never send a result
+                if not any(p.is_alive() for p in pool._pool) and self.teardown_queue.empty():
+                    break
+
+    def imap(self, method_name, iterable, chunk_size=DEFAULT_CHUNK_SIZE, **kw):
+        '''
+        Generator of getattr(obj, method_name)(item, **kw) for each item in
+        iterable, in input order.
+
+        At most max_pending_chunks are in flight at a time so the parent
+        doesn't read the whole input into memory ahead of the workers.
+        '''
+        pool = self.start_pool()
+        max_pending_chunks = self.num_workers * self.pending_chunks_per_worker
+        pending = deque()
+
+        completed = False
+        try:
+            for chunk in batch_iter(iterable, chunk_size):
+                pending.append(pool.apply_async(_call_worker, ((method_name, chunk, kw),)))
+                if len(pending) >= max_pending_chunks:
+                    for result in pending.popleft().get():
+                        yield result
+
+            while pending:
+                for result in pending.popleft().get():
+                    yield result
+            completed = True
+        finally:
+            self.finish_pool(pool, completed)
+
+    def imap_unordered(self, method_name, iterable, **kw):
+        '''
+        Generator of getattr(obj, method_name)(item, **kw) for each item in
+        iterable, in order of completion, one item per task.
+
+        Meant for a modest number of long-running tasks (e.g. one per input
+        file), so the whole iterable is submitted up front and workers pick
+        up tasks in the order given.
+        '''
+        pool = self.start_pool()
+
+        completed = False
+        try:
+            tasks = ((method_name, [item], kw) for item in iterable)
+            for chunk_results in pool.imap_unordered(_call_worker, tasks, chunksize=1):
+                for result in chunk_results:
+                    yield result
+            completed = True
+        finally:
+            self.finish_pool(pool, completed)
+
+
+def _run_stage(stage, setup):
+    # Same as the pool workers, don't repeat the parent's random stream
+    random.seed()
+    if setup is not None:
+        setup()
+    stage.func(*stage.args, **stage.kwargs)
+
+
+class Stage(object):
+    def __init__(self, name, func, args=(), kwargs=None, depends_on=(), resources=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.depends_on = tuple(depends_on)
+        self.resources = resources or {}
+
+
+class StageScheduler(object):
+    '''
+    Runs a DAG of independent builder stages, each in its own forked process.
+
+    Indexes loaded by the parent before run() is called are shared with every
+    stage copy-on-write. A stage starts once all of its dependencies have
+    finished, fewer than max_parallel stages are running and starting it
+    wouldn't take any resource over its limit, e.g. at most one
+    memory-heavy stage at a time:
+
+        scheduler = StageScheduler(max_parallel=4, resource_limits={'memory': 1})
+        scheduler.add_stage('toponyms', build_toponym_training_data, args=(country_rtree, borders_file, out_dir))
+        scheduler.add_stage('addresses', osm_formatter.build_training_data, args=(address_file, out_dir),
+                            resources={'memory': 1})
+        timings = scheduler.run()
+
+    Stages must be added after their dependencies, so the graph can't have
+    cycles. With max_parallel=1 the stages run in order in this process.
+    '''
+    poll_interval = 1.0
+
+    def __init__(self, max_parallel=1, resource_limits=None, setup=None):
+        self.max_parallel = max_parallel
+        self.resource_limits = resource_limits or {}
+        self.setup = setup
+        self.stages = OrderedDict()
+
+    def add_stage(self, name, func, args=(), kwargs=None, depends_on=(), resources=None):
+        if name in self.stages:
+            raise ValueError('Stage {} already exists'.format(name))
+        for dep in depends_on:
+            if dep not in self.stages:
+                raise ValueError('Stage {} depends on unknown stage {}'.format(name, dep))
+        self.stages[name] = Stage(name, func, args=args, kwargs=kwargs, depends_on=depends_on, resources=resources)
+
+    def resources_available(self, stage, in_use):
+        for resource, amount in stage.resources.iteritems():
+            limit = self.resource_limits.get(resource)
+            used = in_use.get(resource, 0)
+            # A stage needing more than the whole limit can still run on its own
+            if limit is not None and used > 0 and used + amount > limit:
+                return False
+        return True
+
+    def log_finished(self, name, elapsed):
+        print('Finished stage {} in {:.1f}s ({} of {})'.format(name, elapsed, len(self.timings), len(self.stages)))
+
+    def run(self):
+        '''
+        Runs all stages and returns an OrderedDict of stage name => seconds,
+        in order of completion. Raises RuntimeError if any stage fails, after
+        letting the stages already running finish.
+        '''
+        self.timings = OrderedDict()
+        if self.max_parallel <= 1:
+            for name, stage in self.stages.iteritems():
+                print('Starting stage {}'.format(name))
+                start = time.time()
+                stage.func(*stage.args, **stage.kwargs)
+                self.timings[name] = time.time() - start
+                self.log_finished(name, self.timings[name])
+            return self.timings
+
+        waiting = list(self.stages.values())
+        running = OrderedDict()
+        in_use = defaultdict(int)
+        failed = []
+
+        while running or (waiting and not failed):
+            if not failed:
+                for stage in list(waiting):
+                    if len(running) >= self.max_parallel:
+                        break
+                    if not all(dep in self.timings for dep in stage.depends_on):
+                        continue
+                    if not self.resources_available(stage, in_use):
+                        continue
+
+                    print('Starting stage {}'.format(stage.name))
+                    process = multiprocessing.Process(target=_run_stage, args=(stage, self.setup), name=stage.name)
+                    process.start()
+                    running[stage.name] = (stage, process, time.time())
+                    for resource, amount in stage.resources.iteritems():
+                        in_use[resource] += amount
+                    waiting.remove(stage)
+
+            if not running:
+                # Everything left depends on something which can never finish
+                break
+
+            time.sleep(self.poll_interval)
+
+            for name, (stage, process, start) in running.items():
+                if process.is_alive():
+                    continue
+                process.join()
+                del running[name]
+                for resource, amount in stage.resources.iteritems():
+                    in_use[resource] -= amount
+
+                if process.exitcode != 0:
+                    print('Stage {} failed with exit code {}'.format(name, process.exitcode))
+                    failed.append(name)
+                else:
+                    self.timings[name] = time.time() - start
+                    self.log_finished(name, self.timings[name])
+
+        if failed:
+            raise RuntimeError('Stages failed: {}. Not run: {}'.format(', '.join(failed), ', '.join([s.name for s in waiting])))
+
+        return self.timings
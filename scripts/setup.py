@@ -35,7 +35,8 @@ def main():
                                          'transliterate.c',
                                          'file_utils.c',
                                          'trie.c',
-                                         'trie_search.c',)
+                                         'trie_search.c',
+                                         'numex.c',)
                                ] + ['geodata/text/pynormalize.c'],
                       include_dirs=[PROJECT_DIR],
                       extra_compile_args=['-std=gnu99', '-DHAVE_CONFIG_H',